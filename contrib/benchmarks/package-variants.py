@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# Scaling benchmark of the package calculation.
+#
+# Generates a synthetic recipe tree where a chain of libraries is built in
+# many variants and measures how long it takes to calculate all packages. The
+# root recipe depends on N applications. Each application sets a different
+# OPT value and one of a few ARCH values, so every library of the chain exists
+# in N variants and the common 'libc' and 'toolchain' recipes are reused
+# heavily.
+#
+# Usage:
+#
+#   contrib/benchmarks/package-variants.py -n 50 -n 100 -n 200 -d 8
+
+import argparse
+import os
+import sys
+import textwrap
+import time
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "..", "pym"))
+
+from bob.input import RecipeSet
+
+def writeRecipe(name, content):
+    with open(os.path.join("recipes", name+".yaml"), "w") as f:
+        f.write(textwrap.dedent(content))
+
+def generateTree(variants, depth, archs):
+    os.mkdir("recipes")
+    with open("config.yaml", "w") as f:
+        f.write("bobMinimumVersion: \"0.16\"\n")
+    writeRecipe("root", "root: True\ndepends:\n" +
+        "".join("    - app-{}\n".format(i) for i in range(variants)) +
+        "buildScript: \"true\"\npackageScript: \"true\"\n")
+    for i in range(variants):
+        writeRecipe("app-{}".format(i), """\
+            environment:
+                ARCH: "arch-{ARCH}"
+                OPT: "opt-{OPT}"
+            depends:
+                - lib-{TOP}
+            buildVars: [ARCH, OPT]
+            buildScript: "true"
+            packageScript: "true"
+            """.format(ARCH=i % archs, OPT=i, TOP=depth-1))
+    for i in range(depth):
+        writeRecipe("lib-{}".format(i), """\
+            depends:
+                - libc
+                - {PREV}
+            buildVars: [ARCH, OPT]
+            buildScript: "true"
+            packageScript: "true"
+            """.format(PREV="lib-{}".format(i-1) if i else "toolchain"))
+    writeRecipe("libc", """\
+        depends:
+            - name: toolchain
+              use: [tools]
+        buildTools: [cc]
+        buildVars: [ARCH]
+        buildScript: "true"
+        packageScript: "true"
+        """)
+    writeRecipe("toolchain", """\
+        packageVars: [ARCH]
+        packageScript: "true"
+        provideTools:
+            cc: "bin"
+        """)
+
+def measure(variants, depth, archs):
+    oldCwd = os.getcwd()
+    with TemporaryDirectory() as tmp:
+        try:
+            os.chdir(tmp)
+            generateTree(variants, depth, archs)
+            recipes = RecipeSet()
+            recipes.parse()
+            start = time.perf_counter()
+            packages = recipes.generatePackages(lambda s, t: "unused")
+            packages.getRootPackage()
+            return time.perf_counter() - start
+        finally:
+            os.chdir(oldCwd)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measure package calculation time.")
+    parser.add_argument('-n', dest='variants', type=int, action='append',
+        help="Number of variants (may be given multiple times)")
+    parser.add_argument('-d', dest='depth', type=int, default=8,
+        help="Length of library chain (default: %(default)s)")
+    parser.add_argument('-a', dest='archs', type=int, default=4,
+        help="Number of different architectures (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    print("{:>8}  {:>10}".format("variants", "seconds"))
+    for n in (args.variants or [25, 50, 100, 200]):
+        print("{:>8}  {:>10.3f}".format(n, measure(n, args.depth, args.archs)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
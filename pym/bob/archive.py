@@ -20,7 +20,8 @@ concurrent uploads the artifact must appear atomically for unrelated readers.
 """
 
 from . import BOB_VERSION
-from .errors import BuildError
+from .audit import Audit, exportAudit, isStoredAudit
+from .errors import BuildError, ParseError
 from .tty import stepAction, stepMessage, \
     SKIPPED, EXECUTED, WARNING, INFO, TRACE, ERROR, IMPORTANT
 from .utils import asHexStr, removePath, isWindows
@@ -33,19 +34,30 @@ import concurrent.futures.process
 import gzip
 import hashlib
 import http.client
+import io
+import json
 import os
 import os.path
+import shutil
 import signal
+import sqlite3
 import ssl
+import stat
 import subprocess
 import tarfile
 import textwrap
+import threading
+import time
 import urllib.parse
+import zlib
 
 ARCHIVE_GENERATION = '-1'
 ARTIFACT_SUFFIX = ".tgz"
 BUILDID_SUFFIX = ".buildid"
 FINGERPRINT_SUFFIX = ".fprnt"
+AUDIT_SUFFIX = ".audit.json.gz"
+MANIFEST_SUFFIX = ".manifest"
+BLOB_SUFFIX = ".blob"
 
 def buildIdToName(bid):
     return asHexStr(bid) + ARCHIVE_GENERATION
@@ -63,6 +75,193 @@ def writeFileOrHandle(name, fileobj, content):
     with open(name, "wb") as f:
         f.write(content)
 
+def setSigIntHandler(handler):
+    # Transfers of some backends run in threads of the main process. Signal
+    # handlers can only be changed in the main thread. Such transfers are not
+    # interrupted by ctrl+c but finish normally.
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, handler)
+
+class CountingReader:
+    """Count the bytes that are read from a file object."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=-1):
+        ret = self.fileobj.read(size)
+        self.count += len(ret)
+        return ret
+
+
+class PeekReader:
+    """Read ahead the first bytes of a file object without consuming them."""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.head = fileobj.read(size)
+
+    def read(self, size=-1):
+        head = self.head
+        if not head:
+            return self.fileobj.read(size)
+        if size < 0:
+            self.head = b''
+            return head + self.fileobj.read()
+        self.head = head[size:]
+        head = head[:size]
+        if len(head) < size:
+            head += self.fileobj.read(size - len(head))
+        return head
+
+# Name, default level and valid range of the artifact compression codecs. The
+# gzip format is understood by all Bob versions and is still written as
+# 'bob-archive-vsn' 1. Other codecs are written as version 2.
+ARTIFACT_CODECS = {
+    "gzip" : (6, 0, 9),
+    "zstd" : (3, 1, 22),
+    "lz4"  : (0, 0, 16),
+}
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+GZIP_MAGIC = b'\x1f\x8b'
+
+def importCodec(codec):
+    try:
+        if codec == "zstd":
+            import zstandard
+            return zstandard
+        elif codec == "lz4":
+            import lz4.frame
+            return lz4.frame
+    except ImportError:
+        pass
+    raise BuildError("{} Python3 library not installed!".format(
+        "zstandard" if codec == "zstd" else codec))
+
+class CodecReader:
+    """Report decompression errors like errors of the tar stream."""
+
+    def __init__(self, fileobj, error):
+        self.fileobj = fileobj
+        self.error = error
+
+    def read(self, size=-1):
+        try:
+            return self.fileobj.read(size)
+        except self.error as e:
+            raise tarfile.ReadError(str(e))
+
+class ArtifactWriter:
+    """Compressed output stream of a binary artifact.
+
+    Writes to the file object or, if not given, to the file ``name``. A
+    passed file object is not closed.
+    """
+
+    def __init__(self, name, fileobj, codec, level):
+        self.__name = name
+        self.__fileobj = fileobj
+        self.__codec = codec
+        self.__level = level
+        self.__file = None
+
+    def getVersion(self):
+        return "1" if self.__codec == "gzip" else "2"
+
+    def __enter__(self):
+        if self.__codec == "gzip":
+            self.__file = gzip.open(self.__name or self.__fileobj, 'wb', self.__level)
+        elif self.__codec == "lz4":
+            self.__file = importCodec("lz4").open(self.__name or self.__fileobj,
+                'wb', compression_level=self.__level)
+        else:
+            zstandard = importCodec("zstd")
+            if self.__fileobj is None:
+                self.__fileobj = self.__ownFile = open(self.__name, 'wb')
+            else:
+                self.__ownFile = None
+            try:
+                # compress with as many threads as there are CPUs
+                self.__file = zstandard.ZstdCompressor(level=self.__level,
+                    threads=-1).stream_writer(self.__fileobj, closefd=False)
+            except:
+                if self.__ownFile is not None: self.__ownFile.close()
+                raise
+        return self.__file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.__file.close()
+        finally:
+            if self.__codec == "zstd" and self.__ownFile is not None:
+                self.__ownFile.close()
+        return False
+
+def openDecompressor(fileobj, files):
+    """Wrap ``fileobj`` in a reader that decompresses the stream.
+
+    The codec is detected by the magic number at the start of the stream.
+    Returns the reader and whether the codec was recognized. Otherwise the
+    stream is passed through unchanged. Opened readers are added to ``files``
+    and must be closed by the caller.
+    """
+    fileobj = PeekReader(fileobj, 4)
+    if fileobj.head == ZSTD_MAGIC:
+        zstandard = importCodec("zstd")
+        fileobj = zstandard.ZstdDecompressor().stream_reader(fileobj,
+            closefd=False)
+        files.append(fileobj)
+        return (CodecReader(fileobj, zstandard.ZstdError), True)
+    elif fileobj.head == LZ4_MAGIC:
+        fileobj = importCodec("lz4").LZ4FrameFile(fileobj, 'rb')
+        files.append(fileobj)
+        return (CodecReader(fileobj, (RuntimeError, EOFError)), True)
+    elif fileobj.head[:2] == GZIP_MAGIC:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+        files.append(fileobj)
+        return (CodecReader(fileobj, (EOFError, zlib.error)), True)
+    else:
+        return (fileobj, False)
+
+class ArtifactReader:
+    """Open a binary artifact for sequential reading.
+
+    The compression is detected by the magic number at the start of the
+    stream. Yields a :class:`tarfile.TarFile` in stream mode.
+    """
+
+    def __init__(self, name, fileobj):
+        self.__name = name
+        self.__fileobj = fileobj
+        self.__files = []
+
+    def __enter__(self):
+        try:
+            fileobj = self.__fileobj
+            if fileobj is None:
+                fileobj = open(self.__name, 'rb')
+                self.__files.append(fileobj)
+            (fileobj, known) = openDecompressor(fileobj, self.__files)
+            self.__tar = tarfile.open(None, "r|" if known else "r|*",
+                                      fileobj=fileobj, errorlevel=1)
+            return self.__tar
+        except:
+            self.__close()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.__tar.close()
+        finally:
+            self.__close()
+        return False
+
+    def __close(self):
+        for f in reversed(self.__files): f.close()
+        self.__files = []
 
 class DummyArchive:
     """Archive that does nothing"""
@@ -91,6 +290,9 @@ class DummyArchive:
     async def downloadPackage(self, step, buildId, audit, content):
         return False
 
+    async def queryPackages(self, buildIds):
+        return set()
+
     def upload(self, step, buildIdFile, tgzFile):
         return ""
 
@@ -115,6 +317,9 @@ class DummyArchive:
     def uploadJenkinsFingerprint(self, step, keyFile, fingerprintFile):
         return ""
 
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        return ""
+
 class ArtifactNotFoundError(Exception):
     pass
 
@@ -139,10 +344,34 @@ class BaseArchive:
         self.__useJenkins = "nojenkins" not in flags
         self.__wantDownload = False
         self.__wantUpload = False
+        self.__auditSidecar = spec.get("auditSidecar", False)
+        self.__compression = spec.get("compression", "gzip")
+        (level, minLevel, maxLevel) = ARTIFACT_CODECS[self.__compression]
+        self.__compressionLevel = spec.get("compressionLevel", level)
+        if not (minLevel <= self.__compressionLevel <= maxLevel):
+            raise BuildError("Invalid {} compression level: {}".format(
+                self.__compression, self.__compressionLevel),
+                help="Valid levels are {} to {}.".format(minLevel, maxLevel))
+        if self.__compression != "gzip" and self.__useUpload:
+            importCodec(self.__compression)
+        # GNU tar detects gzip and zstd when extracting but not lz4
+        if self.__compression == "lz4" and self.__useJenkins and self.__useDownload:
+            raise BuildError("lz4 compressed artifacts cannot be extracted on Jenkins!",
+                help="Add the 'nojenkins' flag to the archive or use zstd.")
 
     def _ignoreErrors(self):
         return self.__ignoreErrors
 
+    def _auditSidecar(self):
+        return self.__auditSidecar
+
+    def _getCompression(self):
+        return (self.__compression, self.__compressionLevel)
+
+    def _getExecutor(self):
+        """Executor of the transfers. Defaults to the process pool."""
+        return None
+
     def wantDownload(self, enable):
         self.__wantDownload = enable
 
@@ -162,7 +391,7 @@ class BaseArchive:
         return self.__wantUpload and self.__useUpload and self.__useJenkins
 
     def __extractPackage(self, tar, audit, content):
-        if tar.pax_headers.get('bob-archive-vsn', "0") != "1":
+        if tar.pax_headers.get('bob-archive-vsn', "0") not in ("1", "2"):
             raise BuildError("Unsupported binary artifact")
 
         f = tar.next()
@@ -200,9 +429,10 @@ class BaseArchive:
         details = " from {}".format(self._remoteName(buildId, suffix))
         with stepAction(step, "DOWNLOAD", content, details=details) as a:
             try:
-                ret, msg, kind = await loop.run_in_executor(None, BaseArchive._downloadPackage,
+                ret, msg, kind, size = await loop.run_in_executor(self._getExecutor(), type(self)._downloadPackage,
                     self, buildId, suffix, audit, content)
                 if not ret: a.fail(msg, kind)
+                a.addBytesTransferred(size)
                 return ret
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Download of package interrupted.")
@@ -210,20 +440,22 @@ class BaseArchive:
     def _downloadPackage(self, buildId, suffix, audit, content):
         # Set default signal handler so that KeyboardInterrupt is raised.
         # Needed to gracefully handle ctrl+c.
-        signal.signal(signal.SIGINT, signal.default_int_handler)
+        setSigIntHandler(signal.default_int_handler)
 
         try:
             with self._openDownloadFile(buildId, suffix) as (name, fileobj):
-                with tarfile.open(name, "r|*", fileobj=fileobj, errorlevel=1) as tar:
+                if fileobj is not None: fileobj = CountingReader(fileobj)
+                with ArtifactReader(name, fileobj) as tar:
                     removePath(audit)
                     removePath(content)
                     os.makedirs(content)
                     self.__extractPackage(tar, audit, content)
-            return (True, None, None)
+                size = fileobj.count if fileobj is not None else os.path.getsize(name)
+            return (True, None, None, size)
         except ArtifactNotFoundError:
-            return (False, "not found", WARNING)
+            return (False, "not found", WARNING, 0)
         except ArtifactDownloadError as e:
-            return (False, e.reason, WARNING)
+            return (False, e.reason, WARNING, 0)
         except BuildError as e:
             raise
         except OSError as e:
@@ -233,7 +465,38 @@ class BaseArchive:
         finally:
             # Restore signals to default so that Ctrl+C kills process. Needed
             # to prevent ugly backtraces when user presses ctrl+c.
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            setSigIntHandler(signal.SIG_DFL)
+
+    async def queryPackages(self, buildIds):
+        """Return the subset of ``buildIds`` whose artifacts are in the archive.
+
+        All build-ids are queried in one go. Backends that cannot tell whether
+        an artifact exists report it as present. The same applies if the
+        query fails. The actual download will tell the truth in this case.
+        """
+        if not self.canDownloadLocal() or not buildIds:
+            return set()
+
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._getExecutor(), BaseArchive._queryPackages,
+                self, list(buildIds), ARTIFACT_SUFFIX)
+        except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+            raise BuildError("Query of binary archive interrupted.")
+
+    def _queryPackages(self, buildIds, suffix):
+        # Set default signal handler so that KeyboardInterrupt is raised.
+        # Needed to gracefully handle ctrl+c.
+        setSigIntHandler(signal.default_int_handler)
+        try:
+            return self._queryFiles(buildIds, suffix)
+        finally:
+            # Restore signals to default so that Ctrl+C kills process. Needed
+            # to prevent ugly backtraces when user presses ctrl+c.
+            setSigIntHandler(signal.SIG_DFL)
+
+    def _queryFiles(self, buildIds, suffix):
+        return set(buildIds)
 
     async def downloadLocalLiveBuildId(self, step, liveBuildId):
         if not self.canDownloadLocal():
@@ -242,7 +505,7 @@ class BaseArchive:
         loop = asyncio.get_event_loop()
         with stepAction(step, "MAP-SRC", self._remoteName(liveBuildId, BUILDID_SUFFIX), (INFO,TRACE)) as a:
             try:
-                ret, msg, kind = await loop.run_in_executor(None,
+                ret, msg, kind = await loop.run_in_executor(self._getExecutor(),
                     BaseArchive._downloadLocalFile, self, liveBuildId, BUILDID_SUFFIX)
                 if ret is None: a.fail(msg, kind)
                 return ret
@@ -252,7 +515,7 @@ class BaseArchive:
     def _downloadLocalFile(self, key, suffix):
         # Set default signal handler so that KeyboardInterrupt is raised.
         # Needed to gracefully handle ctrl+c.
-        signal.signal(signal.SIGINT, signal.default_int_handler)
+        setSigIntHandler(signal.default_int_handler)
 
         try:
             with self._openDownloadFile(key, suffix) as (name, fileobj):
@@ -269,7 +532,7 @@ class BaseArchive:
         finally:
             # Restore signals to default so that Ctrl+C kills process. Needed
             # to prevent ugly backtraces when user presses ctrl+c.
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            setSigIntHandler(signal.SIG_DFL)
 
     def _openUploadFile(self, buildId, suffix):
         raise ArtifactUploadError("not implemented")
@@ -287,37 +550,58 @@ class BaseArchive:
         details = " to {}".format(self._remoteName(buildId, suffix))
         with stepAction(step, "UPLOAD", content, details=details) as a:
             try:
-                msg, kind = await loop.run_in_executor(None, BaseArchive._uploadPackage,
+                msg, kind, size = await loop.run_in_executor(self._getExecutor(), type(self)._uploadPackage,
                     self, buildId, suffix, audit, content)
                 a.setResult(msg, kind)
+                a.addBytesTransferred(size)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of package interrupted.")
 
     def _uploadPackage(self, buildId, suffix, audit, content):
         # Set default signal handler so that KeyboardInterrupt is raised.
         # Needed to gracefully handle ctrl+c.
-        signal.signal(signal.SIGINT, signal.default_int_handler)
+        setSigIntHandler(signal.default_int_handler)
 
         try:
+            # Archives always hold self-contained audit trails
+            auditData = exportAudit(audit)
+            # The sidecar is uploaded first. Whenever the artifact is visible
+            # in the archive, its audit trail can be read without it.
+            if self.__auditSidecar:
+                try:
+                    with self._openUploadFile(buildId, AUDIT_SUFFIX) as (name, fileobj):
+                        writeFileOrHandle(name, fileobj, auditData)
+                except ArtifactExistsError:
+                    pass
             with self._openUploadFile(buildId, suffix) as (name, fileobj):
-                pax = { 'bob-archive-vsn' : "1" }
-                with gzip.open(name or fileobj, 'wb', 6) as gzf:
-                    with tarfile.open(name, "w", fileobj=gzf,
+                writer = ArtifactWriter(name, fileobj, self.__compression,
+                                        self.__compressionLevel)
+                pax = { 'bob-archive-vsn' : writer.getVersion() }
+                with writer as f:
+                    with tarfile.open(name, "w", fileobj=f,
                                       format=tarfile.PAX_FORMAT, pax_headers=pax) as tar:
-                        tar.add(audit, "meta/" + os.path.basename(audit))
+                        info = tar.gettarinfo(audit, "meta/audit.json.gz")
+                        info.size = len(auditData)
+                        tar.addfile(info, io.BytesIO(auditData))
                         tar.add(content, arcname="content")
+                size = fileobj.tell() if fileobj is not None else os.path.getsize(name)
         except ArtifactExistsError:
-            return ("skipped ({} exists in archive)".format(content), SKIPPED)
+            return ("skipped ({} exists in archive)".format(content), SKIPPED, 0)
         except (ArtifactUploadError, tarfile.TarError, OSError) as e:
             if self.__ignoreErrors:
-                return ("error ("+str(e)+")", ERROR)
+                return ("error ("+str(e)+")", ERROR, 0)
             else:
                 raise BuildError("Cannot upload artifact: " + str(e))
+        except ParseError as e:
+            if self.__ignoreErrors:
+                return ("error ("+e.slogan+")", ERROR, 0)
+            else:
+                raise BuildError("Cannot upload artifact: " + e.slogan)
         finally:
             # Restore signals to default so that Ctrl+C kills process. Needed
             # to prevent ugly backtraces when user presses ctrl+c.
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
-        return ("ok", EXECUTED)
+            setSigIntHandler(signal.SIG_DFL)
+        return ("ok", EXECUTED, size)
 
     async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId):
         if not self.canUploadLocal():
@@ -326,7 +610,7 @@ class BaseArchive:
         loop = asyncio.get_event_loop()
         with stepAction(step, "CACHE-BID", self._remoteName(liveBuildId, BUILDID_SUFFIX), (INFO,TRACE)) as a:
             try:
-                msg, kind = await loop.run_in_executor(None, BaseArchive._uploadLocalFile, self, liveBuildId, BUILDID_SUFFIX, buildId)
+                msg, kind = await loop.run_in_executor(self._getExecutor(), BaseArchive._uploadLocalFile, self, liveBuildId, BUILDID_SUFFIX, buildId)
                 a.setResult(msg, kind)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of build-id interrupted.")
@@ -334,7 +618,7 @@ class BaseArchive:
     def _uploadLocalFile(self, key, suffix, content):
         # Set default signal handler so that KeyboardInterrupt is raised.
         # Needed to gracefully handle ctrl+c.
-        signal.signal(signal.SIGINT, signal.default_int_handler)
+        setSigIntHandler(signal.default_int_handler)
 
         try:
             with self._openUploadFile(key, suffix) as (name, fileobj):
@@ -349,7 +633,7 @@ class BaseArchive:
         finally:
             # Restore signals to default so that Ctrl+C kills process. Needed
             # to prevent ugly backtraces when user presses ctrl+c.
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            setSigIntHandler(signal.SIG_DFL)
         return ("ok", EXECUTED)
 
     async def uploadLocalFingerprint(self, step, key, fingerprint):
@@ -359,7 +643,7 @@ class BaseArchive:
         loop = asyncio.get_event_loop()
         with stepAction(step, "CACHE-FPR", self._remoteName(key, FINGERPRINT_SUFFIX)) as a:
             try:
-                msg, kind = await loop.run_in_executor(None, BaseArchive._uploadLocalFile, self, key, FINGERPRINT_SUFFIX, fingerprint)
+                msg, kind = await loop.run_in_executor(self._getExecutor(), BaseArchive._uploadLocalFile, self, key, FINGERPRINT_SUFFIX, fingerprint)
                 a.setResult(msg, kind)
             except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
                 raise BuildError("Upload of build-id interrupted.")
@@ -371,7 +655,7 @@ class BaseArchive:
         loop = asyncio.get_event_loop()
         with stepAction(step, "MAP-FPRNT", self._remoteName(key, FINGERPRINT_SUFFIX)) as a:
             try:
-                ret, msg, kind = await loop.run_in_executor(None,
+                ret, msg, kind = await loop.run_in_executor(self._getExecutor(),
                     BaseArchive._downloadLocalFile, self, key, FINGERPRINT_SUFFIX)
                 if ret is None: a.fail(msg, kind)
                 return ret
@@ -386,6 +670,9 @@ class LocalArchive(BaseArchive):
         self.__fileMode = spec.get("fileMode")
         self.__dirMode = spec.get("directoryMode")
 
+    def _getBasePath(self):
+        return self.__basePath
+
     def _getPath(self, buildId, suffix):
         packageResultId = buildIdToName(buildId)
         packageResultPath = os.path.join(self.__basePath, packageResultId[0:2],
@@ -404,6 +691,10 @@ class LocalArchive(BaseArchive):
         else:
             raise ArtifactNotFoundError()
 
+    def _queryFiles(self, buildIds, suffix):
+        return set(buildId for buildId in buildIds
+                   if os.path.isfile(self._getPath(buildId, suffix)[1]))
+
     def _openUploadFile(self, buildId, suffix):
         (packageResultPath, packageResultFile) = self._getPath(buildId, suffix)
         if os.path.isfile(packageResultFile):
@@ -490,6 +781,11 @@ class LocalArchive(BaseArchive):
     def uploadJenkinsFingerprint(self, step, keyFile, fingerprintFile):
         return self.__uploadJenkins(step, keyFile, fingerprintFile, FINGERPRINT_SUFFIX)
 
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        if not self._auditSidecar():
+            return ""
+        return self.__uploadJenkins(step, buildIdFile, auditFile, AUDIT_SUFFIX)
+
 class LocalArchiveDownloader:
     def __init__(self, name):
         try:
@@ -535,22 +831,661 @@ class LocalArchiveUploader:
         return False
 
 
+class CacheIndex:
+    """Size and last use of the entries of a local cache directory.
+
+    The index is kept in a SQLite database in the cache directory. It also
+    stores the total size of all entries so that a quota can be enforced
+    without scanning the cache. An existing cache is scanned once when the
+    index is created. The index can be shared by concurrent processes.
+    """
+
+    def __init__(self, path):
+        self.__path = path
+
+    def update(self, scan, added={}, used=(), quota=None, remove=None):
+        """Record added and used entries and enforce the quota.
+
+        The ``scan`` function is called to get the (name, size, mtime) tuples
+        of all entries when the index is created. ``added`` maps the names of
+        new entries to their size. If the total size exceeds the ``quota``,
+        the least recently used entries are passed to ``remove``.
+        """
+        os.makedirs(self.__path, exist_ok=True)
+        db = sqlite3.connect(os.path.join(self.__path, "index.sqlite3"),
+                             timeout=60, isolation_level=None)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value)")
+                db.execute("""CREATE TABLE IF NOT EXISTS entries(
+                    name TEXT PRIMARY KEY, size INTEGER, used REAL)""")
+                db.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries(used)")
+                total = db.execute("SELECT value FROM meta WHERE key='total'").fetchone()
+                if total is None:
+                    db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", scan())
+                    total = db.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()
+                total = total[0]
+
+                now = time.time()
+                for (name, size) in added.items():
+                    old = db.execute("SELECT size FROM entries WHERE name=?", (name,)).fetchone()
+                    if old is not None: total -= old[0]
+                    db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                               (name, size, now))
+                    total += size
+                db.executemany("UPDATE entries SET used=? WHERE name=?",
+                               ((now, name) for name in used))
+
+                if quota is not None and total > quota:
+                    evicted = []
+                    for (name, size) in db.execute("SELECT name, size FROM entries ORDER BY used"):
+                        if total <= quota: break
+                        evicted.append((name,))
+                        total -= size
+                    for (name,) in evicted: remove(name)
+                    db.executemany("DELETE FROM entries WHERE name=?", evicted)
+
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('total', ?)", (total,))
+                db.execute("COMMIT")
+            except:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+
+class BlobCache:
+    """Local cache of uncompressed blobs of the content addressed archive.
+
+    Blobs are named by the hex representation of their SHA1 digest. They are
+    added atomically so that concurrent builds can share the cache. Blobs are
+    handed out as open files. They stay readable even if a concurrent process
+    evicts them. Added and used blobs are recorded in the cache index by
+    :meth:`flush`. If the cache exceeds its quota, the least recently used
+    blobs are removed.
+    """
+
+    def __init__(self, path, quota=None):
+        self.__path = path
+        self.__quota = quota
+        self.__index = CacheIndex(path)
+        self.__added = {}
+        self.__used = set()
+
+    def __getName(self, digest):
+        name = asHexStr(digest)
+        return name[0:2] + "/" + name[2:]
+
+    def __getPath(self, name):
+        return os.path.join(self.__path, *name.split("/"))
+
+    def use(self, digests):
+        """Record the blobs of the hex ``digests`` as used right away.
+
+        Concurrent processes will then evict other blobs first.
+        """
+        names = [ d[0:2] + "/" + d[2:] for d in digests
+                  if isinstance(d, str) and len(d) == 40 ]
+        if not names: return
+        try:
+            self.__index.update(self.__scan, used=names)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def get(self, digest):
+        """Open the cached blob. Returns None if it is not cached."""
+        name = self.__getName(digest)
+        try:
+            ret = open(self.__getPath(name), "rb")
+        except FileNotFoundError:
+            return None
+        self.__used.add(name)
+        return ret
+
+    def add(self, digest, fileobj):
+        """Store the content of ``fileobj`` and return the opened blob.
+
+        The content is verified to match the digest.
+        """
+        name = self.__getName(digest)
+        path = self.__getPath(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        h = hashlib.sha1()
+        size = 0
+        with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tmp:
+            try:
+                while True:
+                    buf = fileobj.read(BLOB_BUFFER_SIZE)
+                    if not buf: break
+                    h.update(buf)
+                    tmp.write(buf)
+                    size += len(buf)
+                tmp.close()
+                if h.digest() != digest:
+                    raise ArtifactDownloadError("corrupt blob " + asHexStr(digest))
+                ret = open(tmp.name, "rb")
+                try:
+                    os.replace(tmp.name, path)
+                except:
+                    ret.close()
+                    raise
+            except:
+                os.unlink(tmp.name)
+                raise
+        self.__added[name] = size
+        return ret
+
+    def flush(self):
+        """Record the added and used blobs in the index and evict old ones."""
+        if not self.__added and not self.__used: return
+        try:
+            self.__index.update(self.__scan, self.__added, self.__used,
+                                self.__quota, self.__remove)
+        except (OSError, sqlite3.Error):
+            pass # The blobs are still cached. Only the quota is not enforced.
+        finally:
+            self.__added = {}
+            self.__used = set()
+
+    def __scan(self):
+        for prefix in os.listdir(self.__path):
+            if len(prefix) != 2 or not os.path.isdir(os.path.join(self.__path, prefix)):
+                continue
+            for entry in os.scandir(os.path.join(self.__path, prefix)):
+                if len(entry.name) != 38 or not entry.is_file(): continue
+                st = entry.stat()
+                yield (prefix + "/" + entry.name, st.st_size, st.st_mtime)
+
+    def __remove(self, name):
+        try:
+            os.unlink(self.__getPath(name))
+        except FileNotFoundError:
+            pass
+
+BLOB_BUFFER_SIZE = 1024 * 1024
+
+class CasArchive(LocalArchive):
+    """Content addressed archive with deduplicated file contents.
+
+    Every artifact is stored as a manifest that lists the files of the
+    workspace. The content of each file and the audit trail are stored
+    separately as compressed blobs that are named by the SHA1 digest of their
+    content. Identical files of different artifacts are thus stored only once.
+    The same applies to the records of the audit trail. Each record is stored
+    as separate blob because the records of the dependencies are shared by
+    many artifacts.
+    Uploads only transfer blobs that are missing in the archive. Downloads
+    take blobs from a local blob cache if possible.
+
+    Blobs and manifests use the same directory layout as the other files in
+    the archive. The manifest is written last so that a complete artifact is
+    never visible partially.
+    """
+
+    def __init__(self, spec):
+        # Jenkins jobs cannot use the content addressed layout
+        spec = spec.copy()
+        spec["flags"] = spec.get("flags", ["upload", "download"]) + ["nojenkins"]
+        super().__init__(spec)
+        cache = spec.get("cache")
+        if cache is None:
+            cache = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                os.path.join(os.path.expanduser("~"), '.cache')), 'bob', 'blobs')
+        quota = spec.get("cacheQuota")
+        self.__cache = BlobCache(os.path.abspath(cache),
+            quota * 1024 * 1024 if quota is not None else None)
+
+    def canDownloadJenkins(self):
+        return False
+
+    def canUploadJenkins(self):
+        return False
+
+    def _queryFiles(self, buildIds, suffix):
+        if suffix == ARTIFACT_SUFFIX: suffix = MANIFEST_SUFFIX
+        return super()._queryFiles(buildIds, suffix)
+
+    def _remoteName(self, buildId, suffix):
+        if suffix == ARTIFACT_SUFFIX: suffix = MANIFEST_SUFFIX
+        return super()._remoteName(buildId, suffix)
+
+    def _downloadPackage(self, buildId, suffix, audit, content):
+        setSigIntHandler(signal.default_int_handler)
+        try:
+            with self._openDownloadFile(buildId, MANIFEST_SUFFIX) as (name, fileobj):
+                manifest = readFileOrHandle(name, fileobj)
+            size = len(manifest)
+            try:
+                manifest = json.loads(gzip.decompress(manifest).decode("ascii"))
+                if manifest.get("version") not in (1, 2):
+                    raise BuildError("Unsupported binary artifact manifest")
+                entries = manifest["files"]
+            except (OSError, EOFError, ValueError, KeyError) as e:
+                raise BuildError("Corrupt binary artifact manifest: " + str(e))
+
+            # Record the use of cached blobs before they are restored
+            blobs = [ e.get("blob") for e in entries if e.get("type") == "f" ]
+            if isinstance(manifest["audit"], dict):
+                blobs.append(manifest["audit"].get("artifact"))
+                blobs.extend(manifest["audit"].get("references", []))
+            else:
+                blobs.append(manifest["audit"])
+            self.__cache.use(blobs)
+
+            removePath(audit)
+            removePath(content)
+            os.makedirs(content)
+            if isinstance(manifest["audit"], dict):
+                size += self.__restoreAudit(manifest["audit"], audit)
+            else:
+                size += self.__restoreBlob(manifest["audit"], audit, 0o644)
+            directories = []
+            for entry in entries:
+                path = self.__checkPath(content, entry["name"])
+                kind = entry["type"]
+                if kind == "d":
+                    os.makedirs(path, exist_ok=True)
+                    directories.append((path, entry))
+                elif kind == "f":
+                    size += self.__restoreBlob(entry["blob"], path, entry["mode"])
+                    os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+                elif kind == "l":
+                    os.symlink(entry["target"], path)
+                else:
+                    raise BuildError("Binary artifact contained unknown file type: " + kind)
+
+            # Directory modes and times are restored last because adding the
+            # files would change them.
+            for (path, entry) in reversed(directories):
+                os.chmod(path, entry["mode"])
+                os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+
+            return (True, None, None, size)
+        except ArtifactNotFoundError:
+            return (False, "not found", WARNING, 0)
+        except ArtifactDownloadError as e:
+            return (False, e.reason, WARNING, 0)
+        except BuildError as e:
+            raise
+        except OSError as e:
+            raise BuildError("Cannot download artifact: " + str(e))
+        finally:
+            self.__cache.flush()
+            setSigIntHandler(signal.SIG_DFL)
+
+    @staticmethod
+    def __checkPath(content, name):
+        if os.path.isabs(name) or ".." in name.split("/"):
+            raise BuildError("Invalid file name in binary artifact: " + name)
+        return os.path.join(content, name)
+
+    def __fetchBlob(self, digest):
+        """Get blob into the cache. Returns the opened blob and the transferred size."""
+        try:
+            digest = bytes.fromhex(digest)
+        except ValueError:
+            raise BuildError("Corrupt binary artifact manifest: invalid blob " + digest)
+
+        size = 0
+        cached = self.__cache.get(digest)
+        if cached is None:
+            try:
+                with self._openDownloadFile(digest, BLOB_SUFFIX) as (name, fileobj):
+                    if fileobj is None: fileobj = open(name, "rb")
+                    with fileobj:
+                        fileobj = CountingReader(fileobj)
+                        files = []
+                        try:
+                            (reader, _) = openDecompressor(fileobj, files)
+                            cached = self.__cache.add(digest, reader)
+                        except tarfile.ReadError as e:
+                            raise ArtifactDownloadError("corrupt blob {}: {}"
+                                .format(asHexStr(digest), str(e)))
+                        finally:
+                            for f in reversed(files): f.close()
+                    size = fileobj.count
+            except ArtifactNotFoundError:
+                raise ArtifactDownloadError("incomplete (missing blob {})"
+                    .format(asHexStr(digest)))
+
+        return (cached, size)
+
+    def __restoreBlob(self, digest, path, mode):
+        """Copy blob from cache to ``path``. Returns the transferred size."""
+        (cached, size) = self.__fetchBlob(digest)
+        with cached:
+            with open(path, "wb") as f:
+                shutil.copyfileobj(cached, f, BLOB_BUFFER_SIZE)
+        os.chmod(path, mode)
+        return size
+
+    def __restoreAudit(self, records, path):
+        """Assemble the self-contained audit trail from its record blobs."""
+        size = 0
+        def load(digest):
+            nonlocal size
+            (cached, transferred) = self.__fetchBlob(digest)
+            size += transferred
+            with cached:
+                return json.loads(cached.read().decode("utf8"))
+
+        try:
+            tree = {
+                "artifact" : load(records["artifact"]),
+                "references" : [ load(r) for r in records["references"] ],
+            }
+        except (KeyError, TypeError, ValueError) as e:
+            raise BuildError("Corrupt binary artifact manifest: " + str(e))
+        with gzip.open(path, "wb", 6) as gzf:
+            gzf.write(json.dumps(tree).encode("utf8"))
+        return size
+
+    @staticmethod
+    def __addAudit(audit, addBlob, addRecord):
+        """Add the records of the audit trail as separate blobs.
+
+        Files that are no audit trail are stored as single blob.
+        """
+        try:
+            parsed = Audit.fromFile(audit)
+        except ParseError:
+            if isStoredAudit(audit): raise
+            return addBlob(audit)
+        return {
+            "artifact" : addRecord(parsed.getArtifact()),
+            "references" : [ addRecord(r) for r in parsed.getReferencedArtifacts() ],
+        }
+
+    def _uploadPackage(self, buildId, suffix, audit, content):
+        setSigIntHandler(signal.default_int_handler)
+        try:
+            if self._queryFiles([buildId], MANIFEST_SUFFIX):
+                raise ArtifactExistsError()
+
+            blobs = {}
+            def addBlob(path):
+                h = hashlib.sha1()
+                with open(path, "rb") as f:
+                    while True:
+                        buf = f.read(BLOB_BUFFER_SIZE)
+                        if not buf: break
+                        h.update(buf)
+                blobs[h.digest()] = path
+                return h.hexdigest()
+
+            def addRecord(artifact):
+                data = json.dumps(artifact.dump(), sort_keys=True).encode("utf8")
+                h = hashlib.sha1(data)
+                blobs[h.digest()] = data
+                return h.hexdigest()
+
+            manifest = {
+                "version" : 2,
+                "audit" : self.__addAudit(audit, addBlob, addRecord),
+                "files" : self.__scanWorkspace(content, addBlob),
+            }
+
+            # Upload missing blobs. Other builds might upload the same blobs
+            # concurrently. Losing such a race is fine.
+            size = 0
+            present = self._queryFiles(blobs.keys(), BLOB_SUFFIX)
+            (codec, level) = self._getCompression()
+            for (digest, source) in sorted(blobs.items()):
+                if digest in present: continue
+                try:
+                    with self._openUploadFile(digest, BLOB_SUFFIX) as (name, fileobj):
+                        with ArtifactWriter(name, fileobj, codec, level) as dst:
+                            if isinstance(source, bytes):
+                                dst.write(source)
+                            else:
+                                with open(source, "rb") as src:
+                                    shutil.copyfileobj(src, dst, BLOB_BUFFER_SIZE)
+                        size += fileobj.tell() if fileobj is not None else os.path.getsize(name)
+                except ArtifactExistsError:
+                    pass
+
+            # Undecodable file names are kept as escaped surrogates by JSON
+            manifest = gzip.compress(json.dumps(manifest).encode("ascii"))
+            with self._openUploadFile(buildId, MANIFEST_SUFFIX) as (name, fileobj):
+                writeFileOrHandle(name, fileobj, manifest)
+            size += len(manifest)
+        except ArtifactExistsError:
+            return ("skipped ({} exists in archive)".format(content), SKIPPED, 0)
+        except (ArtifactUploadError, OSError) as e:
+            if self._ignoreErrors():
+                return ("error ("+str(e)+")", ERROR, 0)
+            else:
+                raise BuildError("Cannot upload artifact: " + str(e))
+        except ParseError as e:
+            if self._ignoreErrors():
+                return ("error ("+e.slogan+")", ERROR, 0)
+            else:
+                raise BuildError("Cannot upload artifact: " + e.slogan)
+        finally:
+            setSigIntHandler(signal.SIG_DFL)
+        return ("ok", EXECUTED, size)
+
+    @staticmethod
+    def __scanWorkspace(content, addBlob):
+        """List all files of the workspace in a deterministic order."""
+        ret = []
+        for (root, dirs, files) in os.walk(content):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                path = os.path.join(root, name)
+                relPath = os.path.relpath(path, content).replace(os.sep, "/")
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    ret.append({ "name" : relPath, "type" : "l",
+                                 "target" : os.readlink(path) })
+                elif stat.S_ISDIR(st.st_mode):
+                    ret.append({ "name" : relPath, "type" : "d",
+                                 "mode" : stat.S_IMODE(st.st_mode),
+                                 "mtime" : st.st_mtime_ns })
+                elif stat.S_ISREG(st.st_mode):
+                    ret.append({ "name" : relPath, "type" : "f",
+                                 "mode" : stat.S_IMODE(st.st_mode),
+                                 "mtime" : st.st_mtime_ns,
+                                 "blob" : addBlob(path) })
+                else:
+                    raise ArtifactUploadError("unsupported file type: " + relPath)
+        return ret
+
+
+class ArtifactCache(LocalArchive):
+    """Size bounded local cache of binary artifacts.
+
+    Uses the layout of the file backend. Artifacts are added and removed
+    atomically. Hence the cache can be shared by concurrent Bob processes.
+    The size and the last use of every artifact, including its audit trail
+    sidecar, are recorded in the cache index. If the cache exceeds its quota,
+    the least recently used artifacts are removed. Errors while adding
+    artifacts are never fatal.
+    """
+
+    def __init__(self, spec):
+        spec = spec.copy()
+        spec["flags"] = ["download", "upload", "nofail", "nojenkins"]
+        super().__init__(spec)
+        self.__quota = spec.get("quota")
+        self.__index = CacheIndex(self._getBasePath())
+        self.wantDownload(True)
+        self.wantUpload(True)
+
+    def canDownloadJenkins(self):
+        return False
+
+    def canUploadJenkins(self):
+        return False
+
+    def hasPackage(self, buildId):
+        return os.path.isfile(self._getPath(buildId, ARTIFACT_SUFFIX)[1])
+
+    def _downloadPackage(self, buildId, suffix, audit, content):
+        ret = super()._downloadPackage(buildId, suffix, audit, content)
+        if ret[0]:
+            try:
+                self.__index.update(self.__scan, used=[self.__getName(buildId)])
+            except (OSError, sqlite3.Error):
+                pass
+        return ret
+
+    async def addPackage(self, step, buildId, audit, content):
+        loop = asyncio.get_event_loop()
+        details = " to {}".format(self._remoteName(buildId, ARTIFACT_SUFFIX))
+        with stepAction(step, "CACHE", content, details=details) as a:
+            try:
+                msg, kind = await loop.run_in_executor(self._getExecutor(),
+                    ArtifactCache._addPackage, self, buildId, audit, content)
+                a.setResult(msg, kind)
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Caching of package interrupted.")
+
+    def _addPackage(self, buildId, audit, content):
+        msg, kind, _ = self._uploadPackage(buildId, ARTIFACT_SUFFIX, audit, content)
+        name = self.__getName(buildId)
+        try:
+            size = self.__getSize(name)
+            self.__index.update(self.__scan, { name : size } if size else {}, (),
+                self.__quota * 1024 * 1024 if self.__quota is not None else None,
+                self.__remove)
+        except (OSError, sqlite3.Error) as e:
+            return ("error (" + str(e) + ")", ERROR)
+        return (msg, kind)
+
+    def __getName(self, buildId):
+        name = buildIdToName(buildId)
+        return name[0:2] + "/" + name[2:4] + "/" + name[4:]
+
+    def __getSize(self, name):
+        """Get size of artifact and its audit trail sidecar."""
+        size = 0
+        base = os.path.join(self._getBasePath(), *name.split("/"))
+        for suffix in (ARTIFACT_SUFFIX, AUDIT_SUFFIX):
+            try:
+                size += os.stat(base + suffix).st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def __scan(self):
+        base = self._getBasePath()
+        for (root, dirs, files) in os.walk(base):
+            for name in files:
+                if not name.endswith(ARTIFACT_SUFFIX): continue
+                name = os.path.relpath(os.path.join(root, name[:-len(ARTIFACT_SUFFIX)]), base)
+                name = name.replace(os.sep, "/")
+                try:
+                    mtime = os.stat(os.path.join(root, name.split("/")[-1] + ARTIFACT_SUFFIX)).st_mtime
+                except FileNotFoundError:
+                    continue # evicted concurrently
+                yield (name, self.__getSize(name), mtime)
+
+    def __remove(self, name):
+        base = os.path.join(self._getBasePath(), *name.split("/"))
+        for suffix in (ARTIFACT_SUFFIX, AUDIT_SUFFIX):
+            try:
+                os.unlink(base + suffix)
+            except FileNotFoundError:
+                pass
+
+
+class HttpConnectionPool:
+    """Pool of keep-alive connections to a HTTP server.
+
+    Connections are handed out one at a time to each transfer and are put back
+    after the response was read completely. Connections that saw an error are
+    closed instead. At most ``size`` idle connections are kept.
+    """
+
+    def __init__(self, url, sslVerify, size):
+        self.__url = url
+        self.__sslVerify = sslVerify
+        self.__size = size
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def get(self):
+        with self.__lock:
+            if self.__idle:
+                return self.__idle.pop()
+
+        url = self.__url
+        if url.scheme == 'http':
+            connection = http.client.HTTPConnection(url.hostname, url.port)
+        elif url.scheme == 'https':
+            ctx = None if self.__sslVerify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            connection = http.client.HTTPSConnection(url.hostname, url.port,
+                                                     context=ctx)
+        else:
+            raise BuildError("Unsupported URL scheme: '{}'".format(url.schema))
+
+        return connection
+
+    def put(self, connection):
+        with self.__lock:
+            if len(self.__idle) < self.__size:
+                self.__idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.__lock:
+            idle = self.__idle
+            self.__idle = []
+        for connection in idle: connection.close()
+
+# Connection pools of the current process. Transfers run in the worker
+# processes of the process pool. Every worker keeps its own connections
+# between transfers. The pid is part of the key so that forked processes do
+# not share the connections of their parent.
+_httpPools = {}
+
+def getHttpConnectionPool(url, sslVerify, size):
+    key = (os.getpid(), url.geturl(), sslVerify)
+    ret = _httpPools.get(key)
+    if ret is None:
+        ret = _httpPools[key] = HttpConnectionPool(url, sslVerify, size)
+    return ret
+
 class SimpleHttpArchive(BaseArchive):
     def __init__(self, spec, secureSSL):
         super().__init__(spec)
         self.__url = urllib.parse.urlparse(spec["url"])
-        self.__connection = None
         self.__sslVerify = spec.get("sslVerify", secureSSL)
+        self.__connections = spec.get("connections", 8)
+
+    def __getPool(self):
+        return getHttpConnectionPool(self.__url, self.__sslVerify, self.__connections)
 
     def __retry(self, request):
+        # Requests close their connection on errors. The idle connections of
+        # the pool might have been closed by the server in the meantime too.
+        # Hence they are dropped and the request is retried once.
         retry = True
         while True:
             try:
                 return (True, request())
             except (http.client.HTTPException, OSError) as e:
-                self._resetConnection()
                 if not retry: return (False, e)
                 retry = False
+                self.__getPool().close()
+
+    def __request(self, method, url, body=None, headers={}):
+        """Send request and read response on a pooled connection."""
+        connection = self.__getPool().get()
+        try:
+            headers = headers.copy()
+            headers['User-Agent'] = 'BobBuildTool/{}'.format(BOB_VERSION)
+            connection.request(method, url, body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+        except:
+            connection.close()
+            raise
+        self.__getPool().put(connection)
+        return response
 
     def _makeUrl(self, buildId, suffix):
         packageResultId = buildIdToName(buildId)
@@ -561,28 +1496,6 @@ class SimpleHttpArchive(BaseArchive):
         url = self.__url
         return urllib.parse.urlunparse((url.scheme, url.netloc, self._makeUrl(buildId, suffix), '', '', ''))
 
-    def _getConnection(self):
-        if self.__connection is not None:
-            return self.__connection
-
-        url = self.__url
-        if url.scheme == 'http':
-            connection = http.client.HTTPConnection(url.hostname, url.port)
-        elif url.scheme == 'https':
-            ctx = None if self.__sslVerify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-            connection = http.client.HTTPSConnection(url.hostname, url.port,
-                                                     context=ctx)
-        else:
-            raise BuildError("Unsupported URL scheme: '{}'".format(url.schema))
-
-        self.__connection = connection
-        return connection
-
-    def _resetConnection(self):
-        if self.__connection is not None:
-            self.__connection.close()
-            self.__connection = None
-
     def _openDownloadFile(self, buildId, suffix):
         (ok, result) = self.__retry(lambda: self.__openDownloadFile(buildId, suffix))
         if ok:
@@ -591,20 +1504,55 @@ class SimpleHttpArchive(BaseArchive):
             raise ArtifactDownloadError(str(result))
 
     def __openDownloadFile(self, buildId, suffix):
-        connection = self._getConnection()
-        url = self._makeUrl(buildId, suffix)
-        connection.request("GET", url,
-                headers={ 'User-Agent' : 'BobBuildTool/{}'.format(BOB_VERSION) })
-        response = connection.getresponse()
-        if response.status == 200:
-            return SimpleHttpDownloader(self, response)
-        else:
+        connection = self.__getPool().get()
+        try:
+            url = self._makeUrl(buildId, suffix)
+            connection.request("GET", url,
+                    headers={ 'User-Agent' : 'BobBuildTool/{}'.format(BOB_VERSION) })
+            response = connection.getresponse()
+            if response.status == 200:
+                return SimpleHttpDownloader(self.__getPool(), connection, response)
             response.read()
-            if response.status == 404:
-                raise ArtifactNotFoundError()
-            else:
-                raise ArtifactDownloadError("{} {}".format(response.status,
-                                                           response.reason))
+        except:
+            connection.close()
+            raise
+
+        self.__getPool().put(connection)
+        if response.status == 404:
+            raise ArtifactNotFoundError()
+        else:
+            raise ArtifactDownloadError("{} {}".format(response.status,
+                                                       response.reason))
+
+    async def queryPackages(self, buildIds):
+        if not self.canDownloadLocal() or not buildIds:
+            return set()
+
+        # Issue the HEAD requests concurrently on the pooled connections of
+        # the main process. They are cheap enough to run in threads.
+        loop = asyncio.get_event_loop()
+        buildIds = list(buildIds)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.__connections)
+        try:
+            found = await asyncio.gather(*(
+                loop.run_in_executor(executor, self._queryFile,
+                                     buildId, ARTIFACT_SUFFIX)
+                for buildId in buildIds))
+        except concurrent.futures.CancelledError:
+            raise BuildError("Query of binary archive interrupted.")
+        finally:
+            executor.shutdown(wait=False)
+        return set(buildId for (buildId, f) in zip(buildIds, found) if f)
+
+    def _queryFile(self, buildId, suffix):
+        """Check the existence of a file on the server.
+
+        Unless the server explicitly reports the file as missing, it is
+        assumed to exist.
+        """
+        (ok, result) = self.__retry(lambda: self.__request("HEAD",
+            self._makeUrl(buildId, suffix)))
+        return not ok or result.status != 404
 
     def _openUploadFile(self, buildId, suffix):
         (ok, result) = self.__retry(lambda: self.__openUploadFile(buildId, suffix))
@@ -614,14 +1562,10 @@ class SimpleHttpArchive(BaseArchive):
             raise ArtifactUploadError(str(result))
 
     def __openUploadFile(self, buildId, suffix):
-        connection = self._getConnection()
         url = self._makeUrl(buildId, suffix)
 
         # check if already there
-        connection.request("HEAD", url,
-                headers={ 'User-Agent' : 'BobBuildTool/{}'.format(BOB_VERSION) })
-        response = connection.getresponse()
-        response.read()
+        response = self.__request("HEAD", url)
         if response.status == 200:
             raise ArtifactExistsError()
         elif response.status != 404:
@@ -643,11 +1587,8 @@ class SimpleHttpArchive(BaseArchive):
         tmp.seek(0, os.SEEK_END)
         length = str(tmp.tell())
         tmp.seek(0)
-        connection = self._getConnection()
-        connection.request("PUT", url, tmp, headers={ 'Content-Length' : length,
-            'If-None-Match' : '*', 'User-Agent' : 'BobBuildTool/{}'.format(BOB_VERSION) })
-        response = connection.getresponse()
-        response.read()
+        response = self.__request("PUT", url, tmp, headers={ 'Content-Length' : length,
+            'If-None-Match' : '*' })
         if response.status == 412:
             # precondition failed -> lost race with other upload
             raise ArtifactExistsError()
@@ -702,16 +1643,30 @@ class SimpleHttpArchive(BaseArchive):
     def uploadJenkinsFingerprint(self, step, keyFile, fingerprintFile):
         return self.__uploadJenkins(step, keyFile, fingerprintFile, FINGERPRINT_SUFFIX)
 
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        if not self._auditSidecar():
+            return ""
+        return self.__uploadJenkins(step, buildIdFile, auditFile, AUDIT_SUFFIX)
+
 class SimpleHttpDownloader:
-    def __init__(self, archiver, response):
-        self.archiver = archiver
+    def __init__(self, pool, connection, response):
+        self.pool = pool
+        self.connection = connection
         self.response = response
     def __enter__(self):
         return (None, self.response)
     def __exit__(self, exc_type, exc_value, traceback):
-        # reset connection on abnormal termination
-        if exc_type is not None:
-            self.archiver._resetConnection()
+        # Put connection back if the response could be read completely.
+        # Otherwise the connection is closed.
+        if exc_type is None:
+            try:
+                self.response.read()
+            except (http.client.HTTPException, OSError):
+                exc_type = True
+        if exc_type is None:
+            self.pool.put(self.connection)
+        else:
+            self.connection.close()
         return False
 
 class SimpleHttpUploader:
@@ -829,6 +1784,11 @@ fi
     def uploadJenkinsFingerprint(self, step, keyFile, fingerprintFile):
         return self.__uploadJenkins(step, keyFile, fingerprintFile, FINGERPRINT_SUFFIX)
 
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        if not self._auditSidecar():
+            return ""
+        return self.__uploadJenkins(step, buildIdFile, auditFile, AUDIT_SUFFIX)
+
 class CustomDownloader:
     def __init__(self, name):
         self.name = name
@@ -905,6 +1865,25 @@ class AzureArchive(BaseArchive):
         finally:
             if tmpName is not None: os.unlink(tmpName)
 
+    def _queryFiles(self, buildIds, suffix):
+        """List the blobs once per directory instead of probing every blob."""
+        from azure.common import AzureException
+
+        directories = {}
+        for buildId in buildIds:
+            blobName = self.__makeBlobName(buildId, suffix)
+            directories.setdefault(blobName[:6], {})[blobName] = buildId
+
+        ret = set()
+        for (prefix, blobs) in directories.items():
+            try:
+                for blob in self.__service.list_blobs(self.__container, prefix=prefix):
+                    buildId = blobs.get(blob.name)
+                    if buildId is not None: ret.add(buildId)
+            except AzureException:
+                ret.update(blobs.values())
+        return ret
+
     def _openUploadFile(self, buildId, suffix):
         from azure.common import AzureException
 
@@ -961,6 +1940,11 @@ class AzureArchive(BaseArchive):
     def uploadJenkinsFingerprint(self, step, keyFile, fingerprintFile):
         return self.__uploadJenkins(step, keyFile, fingerprintFile, FINGERPRINT_SUFFIX)
 
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        if not self._auditSidecar():
+            return ""
+        return self.__uploadJenkins(step, buildIdFile, auditFile, AUDIT_SUFFIX)
+
     @staticmethod
     def scriptDownload(args):
         service, container, remoteBlob, localFile = AzureArchive.scriptGetService(args)
@@ -1090,6 +2074,15 @@ class MultiArchive:
             if await i.downloadPackage(step, buildId, audit, content): return True
         return False
 
+    async def queryPackages(self, buildIds):
+        ret = set()
+        for i in self.__archives:
+            if not i.canDownloadLocal(): continue
+            missing = set(buildIds) - ret
+            if not missing: break
+            ret.update(await i.queryPackages(missing))
+        return ret
+
     def upload(self, step, buildIdFile, tgzFile):
         return "\n".join(
             i.upload(step, buildIdFile, tgzFile) for i in self.__archives
@@ -1136,11 +2129,101 @@ class MultiArchive:
             i.uploadJenkinsFingerprint(step, keyFile, fingerprintFile)
             for i in self.__archives if i.canUploadJenkins())
 
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        return "\n".join(
+            i.uploadJenkinsAudit(step, buildIdFile, auditFile)
+            for i in self.__archives if i.canUploadJenkins())
+
+
+class CachedArchive:
+    """Local read-through artifact cache in front of another archive.
+
+    Downloads are served from the cache if possible. Otherwise the artifact is
+    downloaded from the wrapped archive and added to the cache afterwards.
+    Everything else is passed through.
+    """
+
+    def __init__(self, archive, cache):
+        self.__archive = archive
+        self.__cache = cache
+
+    def wantDownload(self, enable):
+        self.__archive.wantDownload(enable)
+
+    def wantUpload(self, enable):
+        self.__archive.wantUpload(enable)
+
+    def canDownloadLocal(self):
+        return self.__archive.canDownloadLocal()
+
+    def canUploadLocal(self):
+        return self.__archive.canUploadLocal()
+
+    def canDownloadJenkins(self):
+        return self.__archive.canDownloadJenkins()
+
+    def canUploadJenkins(self):
+        return self.__archive.canUploadJenkins()
+
+    async def uploadPackage(self, step, buildId, audit, content):
+        await self.__archive.uploadPackage(step, buildId, audit, content)
+
+    async def downloadPackage(self, step, buildId, audit, content):
+        if not self.__archive.canDownloadLocal():
+            return False
+        if self.__cache.hasPackage(buildId):
+            if await self.__cache.downloadPackage(step, buildId, audit, content):
+                return True
+        if not await self.__archive.downloadPackage(step, buildId, audit, content):
+            return False
+        await self.__cache.addPackage(step, buildId, audit, content)
+        return True
+
+    async def queryPackages(self, buildIds):
+        if not self.__archive.canDownloadLocal():
+            return set()
+        ret = set(i for i in buildIds if self.__cache.hasPackage(i))
+        missing = set(buildIds) - ret
+        if missing:
+            ret.update(await self.__archive.queryPackages(missing))
+        return ret
+
+    def upload(self, step, buildIdFile, tgzFile):
+        return self.__archive.upload(step, buildIdFile, tgzFile)
+
+    def download(self, step, buildIdFile, tgzFile):
+        return self.__archive.download(step, buildIdFile, tgzFile)
+
+    async def uploadLocalLiveBuildId(self, step, liveBuildId, buildId):
+        await self.__archive.uploadLocalLiveBuildId(step, liveBuildId, buildId)
+
+    async def downloadLocalLiveBuildId(self, step, liveBuildId):
+        return await self.__archive.downloadLocalLiveBuildId(step, liveBuildId)
+
+    def uploadJenkinsLiveBuildId(self, step, liveBuildId, buildId, isWin):
+        return self.__archive.uploadJenkinsLiveBuildId(step, liveBuildId,
+                                                       buildId, isWin)
+
+    async def uploadLocalFingerprint(self, step, key, fingerprint):
+        await self.__archive.uploadLocalFingerprint(step, key, fingerprint)
+
+    async def downloadLocalFingerprint(self, step, key):
+        return await self.__archive.downloadLocalFingerprint(step, key)
+
+    def uploadJenkinsFingerprint(self, step, keyFile, fingerprintFile):
+        return self.__archive.uploadJenkinsFingerprint(step, keyFile,
+                                                       fingerprintFile)
+
+    def uploadJenkinsAudit(self, step, buildIdFile, auditFile):
+        return self.__archive.uploadJenkinsAudit(step, buildIdFile, auditFile)
+
 
 def getSingleArchiver(recipes, archiveSpec):
     archiveBackend = archiveSpec.get("backend", "none")
     if archiveBackend == "file":
         return LocalArchive(archiveSpec)
+    elif archiveBackend == "cas":
+        return CasArchive(archiveSpec)
     elif archiveBackend == "http":
         return SimpleHttpArchive(archiveSpec, recipes.getPolicy('secureSSL'))
     elif archiveBackend == "shell":
@@ -1155,9 +2238,14 @@ def getSingleArchiver(recipes, archiveSpec):
 def getArchiver(recipes):
     archiveSpec = recipes.archiveSpec()
     if isinstance(archiveSpec, list):
-        return MultiArchive([ getSingleArchiver(recipes, i) for i in archiveSpec ])
+        ret = MultiArchive([ getSingleArchiver(recipes, i) for i in archiveSpec ])
     else:
-        return getSingleArchiver(recipes, archiveSpec)
+        ret = getSingleArchiver(recipes, archiveSpec)
+
+    cacheSpec = recipes.archiveCacheSpec()
+    if cacheSpec is not None:
+        ret = CachedArchive(ret, ArtifactCache(cacheSpec))
+    return ret
 
 def doDownload(args, bobRoot):
     archiveBackend = args[0]
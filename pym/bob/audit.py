@@ -12,11 +12,15 @@ import gzip
 import hashlib
 import io
 import json
+import os
 import platform
 import pickle
 import schema
 import struct
 
+# Audit trails that use an audit store start with this prefix
+STORED_AUDIT_PREFIX = b'{"version": 2'
+
 def digestMap(m, h):
     h.update(struct.pack("<BI", 1, len(m)))
     for (k,v) in sorted(m.items()):
@@ -268,21 +272,174 @@ class Artifact:
     def getMetaEnv(self):
         return self.__metaEnv
 
+class AuditStore:
+    """Content addressed store of audit records.
+
+    Every record is stored once as gzip compressed JSON file that is named by
+    its artifact-id. The artifact-id is the digest of the record. Existing
+    records are thus never changed. Audit trails that use the store only hold
+    their own record and the ids of all referenced records.
+
+    Stores are shared per path within the process. Records are only loaded
+    on demand and are kept in memory afterwards.
+    """
+
+    __stores = {}
+
+    @classmethod
+    def open(cls, path):
+        path = os.path.abspath(path)
+        ret = cls.__stores.get(path)
+        if ret is None:
+            ret = cls.__stores[path] = cls(path)
+        return ret
+
+    def __init__(self, path):
+        self.__path = path
+        self.__records = {}
+
+    def __reduce__(self):
+        return (AuditStore.open, (self.__path,))
+
+    def getPath(self):
+        return self.__path
+
+    def __fileName(self, aid):
+        aid = asHexStr(aid)
+        return os.path.join(self.__path, aid[0:2], aid[2:] + ".json.gz")
+
+    def get(self, aid):
+        ret = self.__records.get(aid)
+        if ret is not None: return ret
+
+        name = self.__fileName(aid)
+        try:
+            with gzip.open(name, 'rb') as gzf:
+                ret = Artifact.fromData(Artifact.SCHEMA.validate(
+                    json.load(io.TextIOWrapper(gzf, encoding='utf8'))))
+        except FileNotFoundError:
+            raise ParseError("Incomplete audit: missing " + asHexStr(aid))
+        except schema.SchemaError as e:
+            raise ParseError(name + ": Invalid audit record: " + str(e))
+        except ValueError as e:
+            raise ParseError(name + ": Invalid json: " + str(e))
+        except (OSError, EOFError) as e:
+            raise ParseError("Error loading audit record: " + str(e))
+        if ret.getId() != aid:
+            raise ParseError(name + ": Corrupt Audit! Artifact-Id does not match!")
+
+        self.__records[aid] = ret
+        return ret
+
+    def put(self, artifact):
+        aid = artifact.getId()
+        if aid in self.__records: return
+
+        name = self.__fileName(aid)
+        if not os.path.exists(name):
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            tmpName = name + ".{}.tmp".format(os.getpid())
+            with gzip.open(tmpName, 'wb', 6) as gzf:
+                json.dump(artifact.dump(), io.TextIOWrapper(gzf, encoding='utf8'))
+            os.replace(tmpName, name)
+        self.__records[aid] = artifact
+
+    def prune(self, audits, dryRun=False):
+        """Remove all records that are not referenced by the given audit trails.
+
+        Audit trails that do not exist or that do not refer to this store are
+        ignored. Returns the file names of the removed records.
+        """
+        keep = set()
+        for name in audits:
+            if not isStoredAudit(name): continue
+            try:
+                with gzip.open(name, 'rb') as gzf:
+                    tree = Audit.STORED_SCHEMA.validate(
+                        json.load(io.TextIOWrapper(gzf, encoding='utf8')))
+            except schema.SchemaError as e:
+                raise ParseError(name + ": Invalid audit record: " + str(e))
+            except ValueError as e:
+                raise ParseError(name + ": Invalid json: " + str(e))
+            except (OSError, EOFError) as e:
+                raise ParseError("Error loading audit: " + str(e))
+            store = os.path.join(os.path.dirname(os.path.abspath(name)), tree["store"])
+            if os.path.normpath(store) != self.__path: continue
+            keep.add(tree["artifact"].get("artifact-id"))
+            keep.update(asHexStr(r) for r in tree["references"])
+
+        ret = []
+        try:
+            prefixes = sorted(os.listdir(self.__path))
+        except FileNotFoundError:
+            return ret
+        for prefix in prefixes:
+            path = os.path.join(self.__path, prefix)
+            # Temporary files of concurrent writers are not touched
+            for record in sorted(os.listdir(path)):
+                if not record.endswith(".json.gz"): continue
+                aid = prefix + record[:-len(".json.gz")]
+                if aid in keep: continue
+                ret.append(os.path.join(path, record))
+                if not dryRun:
+                    os.unlink(os.path.join(path, record))
+                    self.__records.pop(bytes.fromhex(aid), None)
+            if not dryRun:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass # not empty
+
+        return ret
+
 class Audit:
+    # The records are validated one by one by Artifact.SCHEMA
     SCHEMA = schema.Schema({
-        'artifact' : Artifact.SCHEMA,
-        'references' : [ Artifact.SCHEMA ]
+        'artifact' : dict,
+        'references' : [ dict ]
+    })
+
+    STORED_SCHEMA = schema.Schema({
+        'version' : 2,
+        'store' : str,
+        'artifact' : dict,
+        'references' : [ HexValidator() ]
     })
 
+    # Audits that were loaded or saved by this process by their file name.
+    # They are only used as long as the file did not change.
+    __loaded = {}
+
+    # Records that were already validated by their hex artifact-id. A loaded
+    # record that is equal to the validated one with the same id is reused
+    # without validating the schema again. Any other record is fully
+    # validated, including its digest.
+    __validated = {}
+
     def __init__(self):
         self.__artifact = Artifact()
         self.__references = {}
+        self.__store = None
 
     @classmethod
     def fromFile(cls, file):
+        try:
+            fileKey = binStat(file)
+        except OSError as e:
+            raise ParseError("Error loading audit: " + str(e))
+        loaded = cls.__loaded.get(file)
+        if loaded is not None and loaded[0] == fileKey:
+            return loaded[1]
+
+        audit = cls.__fromFile(file, fileKey)
+        audit.__remember(file, fileKey)
+        return audit
+
+    @classmethod
+    def __fromFile(cls, file, fileKey):
         try:
             cacheName = file + ".pickle"
-            cacheKey = binStat(file) + BOB_INPUT_HASH
+            cacheKey = fileKey + BOB_INPUT_HASH
             with open(cacheName, "rb") as f:
                 persistedCacheKey = f.read(len(cacheKey))
                 if cacheKey == persistedCacheKey:
@@ -301,6 +458,21 @@ class Audit:
             raise ParseError("Error loading audit: " + str(e))
         return audit
 
+    def __remember(self, file, fileKey):
+        Audit.__loaded[file] = (fileKey, self)
+        validated = Audit.__validated
+        validated[asHexStr(self.__artifact.getId())] = self.__artifact
+        for ref in self.__references.values():
+            if isinstance(ref, Artifact):
+                validated[asHexStr(ref.getId())] = ref
+
+    @classmethod
+    def __loadRecord(cls, data):
+        ret = cls.__validated.get(data.get("artifact-id"))
+        if ret is None or ret.dump() != data:
+            ret = Artifact.fromData(Artifact.SCHEMA.validate(data))
+        return ret
+
     @classmethod
     def fromByteStream(cls, stream, name):
         audit = cls()
@@ -332,31 +504,76 @@ class Audit:
     def load(self, file, name):
         try:
             tree = json.load(io.TextIOWrapper(file, encoding='utf8'))
-            tree = Audit.SCHEMA.validate(tree)
-            self.__artifact = Artifact.fromData(tree["artifact"])
-            self.__references = {
-                r["artifact-id"] : Artifact.fromData(r) for r in tree["references"]
-            }
+            if isinstance(tree, dict) and "version" in tree:
+                tree = Audit.STORED_SCHEMA.validate(tree)
+                self.__artifact = self.__loadRecord(tree["artifact"])
+                self.__store = AuditStore.open(os.path.join(os.path.dirname(name),
+                                                            tree["store"]))
+                self.__references = { r : self.__store for r in tree["references"] }
+            else:
+                tree = Audit.SCHEMA.validate(tree)
+                self.__artifact = self.__loadRecord(tree["artifact"])
+                self.__references = {}
+                for r in tree["references"]:
+                    r = self.__loadRecord(r)
+                    self.__references[r.getId()] = r
         except schema.SchemaError as e:
             raise ParseError(name + ": Invalid audit record: " + str(e))
         except ValueError as e:
             raise ParseError(name + ": Invalid json: " + str(e))
-        self.__validate()
 
-    def save(self, file):
-        tree = {
-            "artifact" : self.__artifact.dump(),
-            "references" : [ a.dump() for a in self.__references.values() ]
-        }
+        if self.__store is None:
+            self.__validate()
+        else:
+            # The records in the store are checked when they are loaded
+            for ref in self.__artifact.getReferences():
+                if ref not in self.__references:
+                    raise ParseError("Incomplete audit: missing " + asHexStr(ref))
+
+    def __getReference(self, aid):
+        ret = self.__references[aid]
+        if isinstance(ret, AuditStore):
+            ret = self.__references[aid] = ret.get(aid)
+        return ret
+
+    def save(self, file, store=None):
+        """Save the audit trail.
+
+        If no ``store`` is given the audit trail is saved in the self-contained
+        format that includes all referenced records. Otherwise all records
+        are put into the store and only their ids are saved. The path of the
+        store is saved relative to the audit trail.
+        """
         try:
+            if store is None:
+                tree = {
+                    "artifact" : self.__artifact.dump(),
+                    "references" : [ self.__getReference(aid).dump()
+                                     for aid in list(self.__references) ]
+                }
+            else:
+                for (aid, ref) in list(self.__references.items()):
+                    if ref is not store: store.put(self.__getReference(aid))
+                store.put(self.__artifact)
+                tree = {
+                    "version" : 2,
+                    "store" : os.path.relpath(store.getPath(),
+                                              os.path.dirname(os.path.abspath(file))),
+                    "artifact" : self.__artifact.dump(),
+                    "references" : sorted(asHexStr(aid) for aid in self.__references),
+                }
+
             with gzip.open(file, 'wb', 6) as gzf:
                 json.dump(tree, io.TextIOWrapper(gzf, encoding='utf8'))
 
-            cacheName = file + ".pickle"
-            cacheKey = binStat(file) + BOB_INPUT_HASH
-            with open(cacheName, "wb") as f:
-                f.write(cacheKey)
-                pickle.dump(self, f, -1)
+            if isinstance(file, str):
+                fileKey = binStat(file)
+                cacheName = file + ".pickle"
+                cacheKey = fileKey + BOB_INPUT_HASH
+                with open(cacheName, "wb") as f:
+                    f.write(cacheKey)
+                    pickle.dump(self, f, -1)
+                self.__remember(file, fileKey)
 
         except OSError as e:
             raise BuildError("Cannot write audit: " + str(e))
@@ -370,15 +587,18 @@ class Audit:
 
     def getArtifact(self, aid=None):
         if aid:
-            return self.__references[aid]
+            return self.__getReference(aid)
         else:
             return self.__artifact
 
+    def getReferencedArtifacts(self):
+        return [ self.__getReference(aid) for aid in list(self.__references) ]
+
     def getReferencedBuildIds(self):
         ret = set()
         refs = self.__artifact.getReferences()
         while refs:
-            artifact = self.__references[refs.pop()]
+            artifact = self.__getReference(refs.pop())
             if artifact.getMetaData()["step"] == "dist":
                 ret.add(artifact.getBuildId())
             else:
@@ -418,3 +638,25 @@ class Audit:
         self.__merge(audit)
         self.__artifact.addArg(audit.getId())
 
+
+def isStoredAudit(fileName):
+    """Check if the audit trail refers to an audit store."""
+    try:
+        with gzip.open(fileName, 'rb') as gzf:
+            return gzf.read(len(STORED_AUDIT_PREFIX)) == STORED_AUDIT_PREFIX
+    except (OSError, EOFError):
+        return False
+
+def exportAudit(fileName):
+    """Get the audit trail in the self-contained format.
+
+    Audit trails that refer to an audit store are converted. All other files
+    are returned unchanged. Returns the gzip compressed JSON document.
+    """
+    if isStoredAudit(fileName):
+        ret = io.BytesIO()
+        Audit.fromFile(fileName).save(ret)
+        return ret.getvalue()
+    else:
+        with open(fileName, "rb") as f:
+            return f.read()
@@ -3,10 +3,12 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from ..archive import ArtifactReader, ARTIFACT_SUFFIX, AUDIT_SUFFIX
 from ..audit import Audit
 from ..errors import BobError
 from ..utils import binStat, asHexStr, infixBinaryOp
 import argparse
+import concurrent.futures
 import gzip
 import json
 import os, os.path
@@ -16,10 +18,82 @@ import re
 import sqlite3
 import sys
 import tarfile
+import time
 
 # need to enable this for nested expression parsing performance
 pyparsing.ParserElement.enablePackrat()
 
+# Number of artifacts that are inserted into the database at once
+SCAN_BATCH_SIZE = 1024
+
+# Directories are only skipped if their modification time is older than this
+DIR_MTIME_SLACK = 2
+
+def sidecarName(fileName):
+    return fileName[:-len(ARTIFACT_SUFFIX)] + AUDIT_SUFFIX
+
+def artifactName(bid):
+    bid = asHexStr(bid)
+    return os.path.join(bid[0:2], bid[2:4], bid[4:] + "-1" + ARTIFACT_SUFFIX)
+
+def flattenVars(vrs, prefix=""):
+    """Yield all string fields of the variables with their dotted name."""
+    for (key, value) in vrs.items():
+        if isinstance(value, dict):
+            yield from flattenVars(value, prefix + key + ".")
+        elif isinstance(value, str):
+            yield (prefix + key, value)
+
+def readArtifact(fileName):
+    """Read the audit trail of an artifact.
+
+    Runs in a worker process. If the uploader published an audit trail
+    sidecar next to the artifact it is used directly. Otherwise only the tar
+    stream up to the audit trail is read. Returns a tuple of the status and
+    the pickled variables, their flattened fields and the references of the
+    artifact.
+    """
+    try:
+        try:
+            with gzip.open(sidecarName(fileName)) as auditJson:
+                audit = Audit.fromByteStream(auditJson, fileName)
+        except FileNotFoundError:
+            audit = None
+
+        if audit is None:
+            with ArtifactReader(fileName, None) as tar:
+                # validate
+                if tar.pax_headers.get('bob-archive-vsn') not in ("1", "2"):
+                    return ("ignored", None)
+
+                # find audit trail
+                f = tar.next()
+                while f:
+                    if f.name == "meta/audit.json.gz": break
+                    f = tar.next()
+                else:
+                    return ("error", "Missing audit trail!")
+
+                # read audit trail
+                auditJsonGz = tar.extractfile(f)
+                auditJson = gzip.GzipFile(fileobj=auditJsonGz)
+                audit = Audit.fromByteStream(auditJson, fileName)
+
+        artifact = audit.getArtifact()
+        vrs = {
+            'meta' : artifact.getMetaData(),
+            'build' : artifact.getBuildInfo(),
+            'metaEnv' : artifact.getMetaEnv(),
+        }
+        return ("ok", (pickle.dumps(vrs), list(flattenVars(vrs)),
+                       list(audit.getReferencedBuildIds())))
+    except tarfile.TarError as e:
+        return ("error", str(e))
+    except BobError as e:
+        return ("error", e.slogan)
+    except OSError as e:
+        return ("error", str(e))
+
 class ArchiveScanner:
     CUR_VERSION = 2
 
@@ -57,10 +131,41 @@ class ArchiveScanner:
             elif vsn[0] != self.CUR_VERSION:
                 raise BobError("Archive database was created by an incompatible version of Bob!",
                     help="Delete '.bob-archive.sqlite3' and run again to re-index.")
+            # Added later. Older databases get it on the fly.
+            self.__db.execute("""\
+                CREATE TABLE IF NOT EXISTS dirs(
+                    name TEXT PRIMARY KEY NOT NULL,
+                    stat BLOB,
+                    found INTEGER
+                )""")
+            self.__db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='vars'")
+            if self.__db.fetchone() is None:
+                self.__createVars()
         except sqlite3.Error as e:
             raise BobError("Cannot open cache: " + str(e))
         return self
 
+    def __createVars(self):
+        """Create the table of all string fields of the artifacts.
+
+        Retention expressions are evaluated directly on this table. Older
+        databases are indexed from the pickled variables of the artifacts.
+        """
+        self.__db.execute("BEGIN")
+        self.__db.execute("""\
+            CREATE TABLE vars(
+                bid BLOB NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (bid, name)
+            ) WITHOUT ROWID""")
+        self.__db.executemany("INSERT INTO vars VALUES (?, ?, ?)",
+            ( (bid, name, value)
+              for (bid, vrs) in self.__con.execute("SELECT bid, vars FROM files ORDER BY bid")
+              for (name, value) in flattenVars(pickle.loads(vrs)) ))
+        self.__db.execute("CREATE INDEX vars_value ON vars(name, value)")
+        self.__db.execute("END")
+
     def __exit__(self, *exc):
         try:
             if self.__cleanup:
@@ -69,6 +174,10 @@ class ArchiveScanner:
                     DELETE FROM refs WHERE bid NOT IN (
                         SELECT bid FROM files
                     )""")
+                self.__db.execute("""\
+                    DELETE FROM vars WHERE bid NOT IN (
+                        SELECT bid FROM files
+                    )""")
             self.__db.close()
             self.__con.close()
         except sqlite3.Error as e:
@@ -76,87 +185,172 @@ class ArchiveScanner:
         self.__db = None
         return False
 
-    def scan(self, verbose):
+    def scan(self, verbose, jobs=None):
+        """Index new and changed artifacts.
+
+        Fan-out directories whose stat did not change since the last scan
+        are skipped. Artifacts are only added or removed by changing the
+        directory. The audit trails of new artifacts are read in parallel.
+        """
         try:
             found = False
+            todo = []
+            dirs = []
+            visited = set()
             self.__db.execute("BEGIN")
             for l1 in os.listdir("."):
                 if not self.__dirSchema.fullmatch(l1): continue
                 for l2 in os.listdir(l1):
                     if not self.__dirSchema.fullmatch(l2): continue
-                    l2 = os.path.join(l1, l2)
-                    for l3 in os.listdir(l2):
-                        m = self.__archiveSchema.fullmatch(l3)
-                        if not m: continue
-                        found = True
-                        self.__scan(os.path.join(l2, l3), verbose)
+                    visited.add(os.path.join(l1, l2))
+                    found = self.__scanDir(os.path.join(l1, l2), todo, dirs) or found
+            self.__pruneDirs(visited)
+            failed = self.__readArtifacts(todo, verbose, jobs)
+            # Only mark directories as scanned when all their artifacts are
+            # indexed. Otherwise an interrupted scan would skip them later.
+            self.__db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                  [ d for d in dirs if d[0] not in failed ])
         except OSError as e:
             raise BobError("Error scanning archive: " + str(e))
         finally:
             self.__db.execute("END")
-            if verbose and not found:
-                print("Your archive seems to be empty. "
-                      "Are you running 'bob archive' from within the correct directory?",
-                      file=sys.stderr)
-            return found
+        if verbose and not found:
+            print("Your archive seems to be empty. "
+                  "Are you running 'bob archive' from within the correct directory?",
+                  file=sys.stderr)
+        return found
+
+    def __scanDir(self, path, todo, dirs):
+        st = binStat(path)
+        self.__db.execute("SELECT stat, found FROM dirs WHERE name=?", (path,))
+        cached = self.__db.fetchone()
+        if cached is not None and cached[0] == st:
+            return bool(cached[1])
+
+        # Get all known artifacts of this directory in one go
+        prefix = bytes.fromhex(path[0:2] + path[3:5])
+        self.__db.execute("SELECT bid, stat FROM files WHERE bid >= ? AND bid <= ?",
+            (prefix, prefix + b'\xff' * 64))
+        known = dict(self.__db.fetchall())
+
+        found = False
+        for l3 in os.listdir(path):
+            if not self.__archiveSchema.fullmatch(l3): continue
+            found = True
+            fileName = os.path.join(path, l3)
+            bid = bytes.fromhex(path[0:2] + path[3:5] + l3.partition("-")[0])
+            fileStat = binStat(fileName)
+            if known.pop(bid, None) != fileStat:
+                todo.append((fileName, bid, fileStat))
+
+        # Drop entries of vanished artifacts. The references are pruned when
+        # the database is closed.
+        if known:
+            self.__db.executemany("DELETE FROM files WHERE bid=?",
+                                  [ (bid,) for bid in known ])
+            self.__cleanup = True
+
+        # Directories that were modified just now might still change within
+        # the resolution of the timestamp. They are scanned again next time.
+        if os.stat(path).st_mtime < time.time() - DIR_MTIME_SLACK:
+            dirs.append((path, st, found))
+        return found
+
+    def __pruneDirs(self, visited):
+        """Drop the entries of fan-out directories that vanished."""
+        self.__db.execute("SELECT name FROM dirs")
+        self.__db.executemany("DELETE FROM dirs WHERE name=?",
+            [ r for r in self.__db.fetchall() if r[0] not in visited ])
+        visited = set(bytes.fromhex(d[0:2] + d[3:5]) for d in visited)
+        self.__db.execute("SELECT DISTINCT substr(bid, 1, 2) FROM files")
+        vanished = [ r[0] for r in self.__db.fetchall() if r[0] not in visited ]
+        for prefix in vanished:
+            self.__db.execute("DELETE FROM files WHERE bid >= ? AND bid <= ?",
+                (prefix, prefix + b'\xff' * 64))
+            self.__cleanup = True
+
+    def __readArtifacts(self, todo, verbose, jobs):
+        if jobs is None: jobs = os.cpu_count() or 1
+        if jobs > 1 and len(todo) > SCAN_BATCH_SIZE // 16:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            results = executor.map(readArtifact, (t[0] for t in todo),
+                                   chunksize=16)
+        else:
+            executor = None
+            results = map(readArtifact, (t[0] for t in todo))
 
-    def __scan(self, fileName, verbose):
+        failed = set()
         try:
-            st = binStat(fileName)
-            bidHex, sep, suffix = fileName.partition("-")
-            bid = bytes.fromhex(bidHex[0:2] + bidHex[3:5] + bidHex[6:])
-
-            # Validate entry in caching db. Delete entry if stat has changed.
-            # The database will clean the 'refs' table automatically.
-            self.__db.execute("SELECT stat FROM files WHERE bid=?",
-                                (bid,))
-            cachedStat = self.__db.fetchone()
-            if cachedStat is not None:
-                if cachedStat[0] == st: return
-                self.__db.execute("DELETE FROM files WHERE bid=?",
-                    (bid,))
-
-            # read audit trail
-            if verbose: print("scan", fileName)
-            with tarfile.open(fileName, errorlevel=1) as tar:
-                # validate
-                if tar.pax_headers.get('bob-archive-vsn') != "1":
+            files = []
+            fields = []
+            refs = []
+            for ((fileName, bid, fileStat), (status, result)) in zip(todo, results):
+                if verbose: print("scan", fileName)
+                if status == "error":
+                    # Keep going. The directory is scanned again next time.
+                    print("Cannot read {}: {}".format(fileName, result), file=sys.stderr)
+                    failed.add(os.path.dirname(fileName))
+                    continue
+                elif status == "ignored":
                     print("Not a Bob archive:", fileName, "Ignored!")
-                    return
-
-                # find audit trail
-                f = tar.next()
-                while f:
-                    if f.name == "meta/audit.json.gz": break
-                    f = tar.next()
-                else:
-                    raise Error("Missing audit trail!")
-
-                # read audit trail
-                auditJsonGz = tar.extractfile(f)
-                auditJson = gzip.GzipFile(fileobj=auditJsonGz)
-                audit = Audit.fromByteStream(auditJson, fileName)
-
-            # import data
-            artifact = audit.getArtifact()
-            vrs = pickle.dumps({
-                'meta' : artifact.getMetaData(),
-                'build' : artifact.getBuildInfo(),
-                'metaEnv' : artifact.getMetaEnv(),
-            })
-            self.__db.execute("INSERT INTO files VALUES (?, ?, ?)",
-                (bid, st, vrs))
-            self.__db.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?)",
-                [ (bid, r) for r in audit.getReferencedBuildIds() ])
-        except tarfile.TarError as e:
-            raise BobError("Cannot read {}: {}".format(fileName, str(e)))
-        except OSError as e:
-            raise BobError(str(e))
-
-    def remove(self, bid):
+                    continue
+                (vrs, flattened, references) = result
+                files.append((bid, fileStat, vrs))
+                fields.extend((bid, n, v) for (n, v) in flattened)
+                refs.extend((bid, r) for r in references)
+                if len(files) >= SCAN_BATCH_SIZE:
+                    self.__insert(files, fields, refs)
+            self.__insert(files, fields, refs)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+        return failed
+
+    def __insert(self, files, fields, refs):
+        # Changed artifacts replace their old entry, fields and references
+        self.__db.executemany("DELETE FROM refs WHERE bid=?", ( (f[0],) for f in files ))
+        self.__db.executemany("DELETE FROM vars WHERE bid=?", ( (f[0],) for f in files ))
+        self.__db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", files)
+        self.__db.executemany("INSERT OR REPLACE INTO vars VALUES (?, ?, ?)", fields)
+        self.__db.executemany("INSERT OR IGNORE INTO refs VALUES (?, ?)", refs)
+        del files[:]
+        del fields[:]
+        del refs[:]
+
+    def remove(self, bids):
         self.__cleanup = True
-        self.__db.execute("DELETE FROM files WHERE bid=?",
-            (bid,))
+        self.__db.execute("BEGIN")
+        try:
+            self.__db.executemany("DELETE FROM files WHERE bid=?",
+                ( (bid,) for bid in bids ))
+        finally:
+            self.__db.execute("END")
+
+    def isFieldGroup(self, name):
+        """Check if the dotted field name has sub-fields."""
+        self.__db.execute("SELECT 1 FROM vars WHERE name >= ? AND name < ? LIMIT 1",
+            (name + ".", name + "/"))
+        return self.__db.fetchone() is not None
+
+    def getUnretainedBuildIds(self, retainExpr):
+        """Get all build-ids that are not retained by the expression.
+
+        The expression is compiled to SQL. All artifacts that match the
+        expression and, recursively, the artifacts referenced by them are
+        retained.
+        """
+        query = SqlQuery(self)
+        predicate = retainExpr.sqlBool(query)
+        self.__db.execute("""\
+            WITH RECURSIVE retained(bid) AS (
+                SELECT bid FROM files WHERE {}
+                UNION
+                SELECT refs.ref FROM retained JOIN refs ON refs.bid = retained.bid
+            )
+            SELECT bid FROM files WHERE bid NOT IN (
+                SELECT bid FROM retained
+            )""".format(predicate), query.params)
+        return [ r[0] for r in self.__db.fetchall() ]
 
     def getBuildIds(self):
         self.__db.execute("SELECT bid FROM files")
@@ -177,6 +371,17 @@ class ArchiveScanner:
             return {}
 
 
+class SqlQuery:
+    """Parameters of a retention expression that is compiled to SQL."""
+
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.params = []
+
+    def param(self, value):
+        self.params.append(value)
+        return "?"
+
 class Base:
     def __init__(self, s, loc):
         self.__s = s
@@ -195,10 +400,10 @@ class NotPredicate(Base):
     def __repr__(self):
         return "NotPredicate({})".format(self.arg)
 
-    def evalBool(self, data):
-        return not self.arg.evalBool(data)
+    def sqlBool(self, query):
+        return "(NOT {})".format(self.arg.sqlBool(query))
 
-    def evalString(self, data):
+    def sqlString(self, query):
         self.barf("operator in string context")
 
 class AndPredicate(Base):
@@ -210,10 +415,10 @@ class AndPredicate(Base):
     def __repr__(self):
         return "AndPredicate({}, {})".format(self.left, self.right)
 
-    def evalBool(self, data):
-        return self.left.evalBool(data) and self.right.evalBool(data)
+    def sqlBool(self, query):
+        return "({} AND {})".format(self.left.sqlBool(query), self.right.sqlBool(query))
 
-    def evalString(self, data):
+    def sqlString(self, query):
         self.barf("operator in string context")
 
 class OrPredicate(Base):
@@ -225,10 +430,10 @@ class OrPredicate(Base):
     def __repr__(self):
         return "OrPredicate({}, {})".format(self.left, self.right)
 
-    def evalBool(self, data):
-        return self.left.evalBool(data) or self.right.evalBool(data)
+    def sqlBool(self, query):
+        return "({} OR {})".format(self.left.sqlBool(query), self.right.sqlBool(query))
 
-    def evalString(self, data):
+    def sqlString(self, query):
         self.barf("operator in string context")
 
 class ComparePredicate(Base):
@@ -236,29 +441,36 @@ class ComparePredicate(Base):
         super().__init__(s, loc)
         self.left = toks[0]
         self.right = toks[2]
-        op = toks[1]
-        if op == '<':
-            self.op = lambda l, r: l < r
-        elif op == '>':
-            self.op = lambda l, r: l > r
-        elif op == '<=':
-            self.op = lambda l, r: l <= r
-        elif op == '>=':
-            self.op = lambda l, r: l >= r
-        elif op == '==':
-            self.op = lambda l, r: l == r
-        elif op == '!=':
-            self.op = lambda l, r: l != r
-        else:
-            assert False, op
+        self.op = toks[1]
+        assert self.op in self.MIRRORED, self.op
+
+    MIRRORED = { '<' : '>', '>' : '<', '<=' : '>=', '>=' : '<=', '==' : '==', '!=' : '!=' }
 
     def __repr__(self):
         return "ComparePredicate({}, {})".format(self.left, self.right)
 
-    def evalBool(self, data):
-        return self.op(self.left.evalString(data), self.right.evalString(data))
+    def sqlBool(self, query):
+        (left, right, op) = (self.left, self.right, self.op)
+        if isinstance(left, StringLiteral) and isinstance(right, VarReference):
+            (left, right, op) = (right, left, self.MIRRORED[op])
+
+        if isinstance(left, VarReference) and isinstance(right, StringLiteral):
+            # Compare field with a constant by the (name, value) index. Missing
+            # fields are unequal to everything.
+            return "(files.bid {} (SELECT bid FROM vars WHERE name={} AND value{}{}))".format(
+                "NOT IN" if op == '!=' else "IN",
+                query.param(left.fieldName(query)),
+                "=" if op in ('==', '!=') else op,
+                query.param(right.literal))
+        elif op == '==':
+            return "({} IS {})".format(left.sqlString(query), right.sqlString(query))
+        elif op == '!=':
+            return "({} IS NOT {})".format(left.sqlString(query), right.sqlString(query))
+        else:
+            return "COALESCE({} {} {}, 0)".format(left.sqlString(query), op,
+                                                  right.sqlString(query))
 
-    def evalString(self, data):
+    def sqlString(self, query):
         self.barf("operator in string context")
 
 class StringLiteral(Base):
@@ -266,29 +478,28 @@ class StringLiteral(Base):
         super().__init__(s, loc)
         self.literal = toks[0]
 
-    def evalBool(self, data):
+    def sqlBool(self, query):
         self.barf("string in boolean context")
 
-    def evalString(self, data):
-        return self.literal
+    def sqlString(self, query):
+        return query.param(self.literal)
 
 class VarReference(Base):
     def __init__(self, s, loc, toks):
         super().__init__(s, loc)
-        self.path = toks[0].split(".")
+        self.name = toks[0]
 
-    def evalBool(self, data):
+    def sqlBool(self, query):
         self.barf("field reference in boolean context")
 
-    def evalString(self, data):
-        try:
-            for i in self.path:
-                data = data[i]
-        except:
-            return None
-        if not isinstance(data, str):
+    def sqlString(self, query):
+        return "(SELECT value FROM vars WHERE bid=files.bid AND name={})".format(
+            query.param(self.fieldName(query)))
+
+    def fieldName(self, query):
+        if query.scanner.isFieldGroup(self.name):
             self.barf("invalid field reference")
-        return data
+        return self.name
 
 
 def doArchiveScan(argv):
@@ -297,11 +508,13 @@ def doArchiveScan(argv):
         help="Verbose operation")
     parser.add_argument("-f", "--fail", action='store_true',
         help="Return a non-zero error code in case of errors")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+        help="Number of processes that read artifacts (default: number of CPUs)")
     args = parser.parse_args(argv)
 
     scanner = ArchiveScanner()
     with scanner:
-        if not scanner.scan(args.verbose) and args.fail:
+        if not scanner.scan(args.verbose, args.jobs) and args.fail:
             sys.exit(1)
 
 
@@ -317,10 +530,10 @@ def doArchiveClean(argv):
         stringLiteral | varReference,
         [
             ('!',  1, pyparsing.opAssoc.RIGHT, lambda s, loc, toks: NotPredicate(s, loc, toks)),
-            ('<',  2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
             ('<=', 2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
-            ('>',  2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
+            ('<',  2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
             ('>=', 2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
+            ('>',  2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
             ('==', 2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
             ('!=', 2, pyparsing.opAssoc.LEFT,  infixBinaryOp(ComparePredicate)),
             ('&&', 2, pyparsing.opAssoc.LEFT,  infixBinaryOp(AndPredicate)),
@@ -337,6 +550,8 @@ def doArchiveClean(argv):
         help="Verbose operation")
     parser.add_argument("-f", "--fail", action='store_true',
         help="Return a non-zero error code in case of errors")
+    parser.add_argument("-j", "--jobs", type=int, metavar="N",
+        help="Number of parallel jobs that read and delete artifacts (default: number of CPUs)")
     args = parser.parse_args(argv)
 
     try:
@@ -345,38 +560,63 @@ def doArchiveClean(argv):
         raise BobError("Invalid retention expression: " + str(e))
 
     scanner = ArchiveScanner()
-    retained = set()
     with scanner:
         if not args.noscan:
-            if not scanner.scan(args.verbose) and args.fail:
+            if not scanner.scan(args.verbose, args.jobs) and args.fail:
                 sys.exit(1)
-        for bid in scanner.getBuildIds():
-            if bid in retained: continue
-            if retainExpr.evalBool(scanner.getVars(bid)):
-                retained.add(bid)
-                todo = set(scanner.getReferencedBuildIds(bid))
-                while todo:
-                    n = todo.pop()
-                    if n in retained: continue
-                    retained.add(n)
-                    todo.update(scanner.getReferencedBuildIds(n))
-
-        for bid in scanner.getBuildIds():
-            if bid in retained: continue
-            victim = asHexStr(bid)
-            victim = os.path.join(victim[0:2], victim[2:4], victim[4:] + "-1.tgz")
-            if args.dry_run:
-                print(victim)
-            else:
-                try:
-                    if args.verbose:
-                        print("rm", victim)
-                    os.unlink(victim)
-                except FileNotFoundError:
-                    pass
-                except OSError as e:
-                    raise BobError("Cannot remove {}: {}".format(victim, str(e)))
-                scanner.remove(bid)
+        victims = scanner.getUnretainedBuildIds(retainExpr)
+        if args.dry_run:
+            for bid in victims:
+                print(artifactName(bid))
+        else:
+            removeArtifacts(scanner, victims, args.verbose, args.jobs)
+
+def removeArtifact(victim):
+    """Delete an artifact and its audit trail sidecar.
+
+    Runs in a worker thread. Returns a tuple of the error and warning
+    messages.
+    """
+    try:
+        os.unlink(victim)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return ("Cannot remove {}: {}".format(victim, str(e)), None)
+    try:
+        os.unlink(sidecarName(victim))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return (None, "Cannot remove audit trail sidecar of {}: {}".format(victim, str(e)))
+    return (None, None)
+
+def removeArtifacts(scanner, victims, verbose, jobs):
+    """Delete artifacts in parallel batches.
+
+    The database is updated after each batch. If a file cannot be removed
+    the successfully deleted artifacts of the batch are still dropped from
+    the database before failing.
+    """
+    if jobs is None: jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for i in range(0, len(victims), SCAN_BATCH_SIZE):
+            batch = [ (bid, artifactName(bid)) for bid in victims[i:i+SCAN_BATCH_SIZE] ]
+            results = executor.map(removeArtifact, (victim for (_, victim) in batch))
+            removed = []
+            error = None
+            for ((bid, victim), (err, warn)) in zip(batch, results):
+                if err is not None:
+                    if error is None: error = err
+                    continue
+                if verbose:
+                    print("rm", victim)
+                if warn is not None:
+                    print(warn, file=sys.stderr)
+                removed.append(bid)
+            scanner.remove(removed)
+            if error is not None:
+                raise BobError(error)
 
 availableArchiveCmds = {
     "scan" : (doArchiveScan, "Scan archive for new artifacts"),
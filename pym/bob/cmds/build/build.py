@@ -42,6 +42,14 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Destination of build result (will be overwritten!)")
     parser.add_argument('-j', '--jobs', default=None, type=int, nargs='?', const=...,
         help="Specifies  the  number of jobs to run simultaneously.")
+    parser.add_argument('--memory', metavar="MB", default=None, type=int,
+        help="Memory budget in MiB for steps that declare their memory usage")
+    parser.add_argument('--checkout-jobs', metavar="N", default=None, type=int,
+        help="Number of checkouts to run simultaneously (default: jobs)")
+    parser.add_argument('--download-jobs', metavar="N", default=None, type=int,
+        help="Number of downloads to run simultaneously (default: jobs)")
+    parser.add_argument('--fingerprint-jobs', metavar="N", default=None, type=int,
+        help="Number of fingerprint scripts to run simultaneously (default: jobs)")
     parser.add_argument('-k', '--keep-going', default=None, action='store_true',
         help="Continue  as much as possible after an error.")
     parser.add_argument('-f', '--force', default=None, action='store_true',
@@ -110,6 +118,13 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         help="Disable sandboxing")
     parser.add_argument('--clean-checkout', action='store_true', default=None, dest='clean_checkout',
         help="Do a clean checkout if SCM state is dirty.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--watch-workspaces', action='store_true', default=None, dest='watch_workspaces',
+        help="Watch workspaces for changes to speed up hashing (Linux only)")
+    group.add_argument('--no-watch-workspaces', action='store_false', dest='watch_workspaces',
+        help="Always hash workspaces completely")
+    parser.add_argument('--profile', metavar="FILE", default=None,
+        help="Write timing profile of the build in Chrome trace event format")
     args = parser.parse_args(argv)
 
     defines = processDefines(args.defines)
@@ -145,6 +160,7 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 'jobs' : 1,
                 'keep_going' : False,
                 'audit' : True,
+                'watch_workspaces' : False,
             }
 
         for a in vars(args):
@@ -155,6 +171,12 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
             args.jobs = os.cpu_count()
         elif args.jobs <= 0:
             parser.error("--jobs argument must be greater than zero!")
+        for (name, value) in (("memory", args.memory),
+                              ("checkout-jobs", args.checkout_jobs),
+                              ("download-jobs", args.download_jobs),
+                              ("fingerprint-jobs", args.fingerprint_jobs)):
+            if value is not None and value <= 0:
+                parser.error("--{} argument must be greater than zero!".format(name))
 
         envWhiteList = recipes.envWhiteList()
         envWhiteList |= set(args.white_list)
@@ -184,8 +206,12 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         builder.setAlwaysCheckout(args.always_checkout + cfg.get('always_checkout', []))
         builder.setLinkDependencies(args.link_deps)
         builder.setJobs(args.jobs)
+        builder.setMemoryBudget(args.memory)
+        builder.setPoolJobs(args.checkout_jobs, args.download_jobs,
+                            args.fingerprint_jobs)
         builder.setKeepGoing(args.keep_going)
         builder.setAudit(args.audit)
+        builder.setWatchWorkspaces(args.watch_workspaces)
         if args.resume: builder.loadBuildState()
 
         backlog = []
@@ -223,6 +249,7 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
         finally:
             if args.jobs > 1: setTui(1)
             builder.saveBuildState()
+            if args.profile: builder.saveProfile(args.profile)
             runHook(recipes, 'postBuildHook', ["success" if success else "fail"] + results)
 
     # tell the user
@@ -242,6 +269,10 @@ def commonBuildDevelop(parser, argv, bobRoot, develop):
                 + str(stats.packagesBuilt)
                     + " package" + ("s" if (stats.packagesBuilt != 1) else "") + " built, "
                 + str(stats.packagesDownloaded) + " downloaded.")
+        if stats.actualMakespan > 0.0:
+            print("Makespan: predicted {}, actual {}".format(
+                datetime.timedelta(seconds=stats.predictedMakespan),
+                datetime.timedelta(seconds=stats.actualMakespan)))
 
         # copy build result if requested
         ok = True
@@ -5,7 +5,7 @@
 
 from ... import BOB_VERSION
 from ...archive import DummyArchive
-from ...audit import Audit
+from ...audit import Audit, AuditStore
 from ...errors import BobError, BuildError, MultiBobError
 from ...input import RecipeSet
 from ...invoker import Invoker, InvocationMode
@@ -13,10 +13,13 @@ from ...languages import StepSpec
 from ...state import BobState
 from ...stringparser import Env
 from ...tty import log, stepMessage, stepAction, stepExec, setProgress, ttyReinit, \
-    SKIPPED, EXECUTED, INFO, WARNING, DEFAULT, \
+    setProfile, DummyTUIAction, SKIPPED, EXECUTED, INFO, WARNING, DEFAULT, \
     ALWAYS, IMPORTANT, NORMAL, INFO, DEBUG, TRACE
-from ...utils import asHexStr, hashDirectory, removePath, emptyDirectory, \
+from ...utils import asHexStr, DirHasher, removePath, emptyDirectory, \
     isWindows, INVALID_CHAR_TRANS, quoteCmdExe, getPlatformTag
+from ...watch import WorkspaceJournal
+from .profile import BuildProfile
+from .schedule import CriticalPathSchedule, JobSlots
 from shlex import quote
 from textwrap import dedent
 import argparse
@@ -33,6 +36,7 @@ import signal
 import stat
 import sys
 import tempfile
+import time
 
 # Output verbosity:
 #    <= -2: package name
@@ -48,9 +52,17 @@ async def gatherTasks(tasks):
     await asyncio.wait(tasks)
     return [ t.result() for t in tasks ]
 
-def hashWorkspace(step):
-    return hashDirectory(step.getWorkspacePath(),
-        os.path.join(step.getWorkspacePath(), "..", "cache.bin"))
+def _hashWorkspaceDirectory(workspace, watch):
+    # Set default signal handler so that KeyboardInterrupt is raised.
+    # Needed to gracefully handle ctrl+c.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    journal = WorkspaceJournal(workspace) if watch else None
+    changes = journal.begin() if journal is not None else None
+    hasher = DirHasher(os.path.join(workspace, "..", "cache.bin"),
+                       jobs=min(8, os.cpu_count() or 1), changes=changes)
+    ret = (hasher.hashDirectory(workspace), hasher.getBytesHashed())
+    if journal is not None: journal.commit()
+    return ret
 
 def compareDirectoryState(left, right):
     """Compare two directory states while ignoring the SCM specs.
@@ -110,6 +122,8 @@ class LocalBuilderStatistic:
         self.checkouts = 0
         self.packagesBuilt = 0
         self.packagesDownloaded = 0
+        self.predictedMakespan = 0.0
+        self.actualMakespan = 0.0
 
     def addOverrides(self, overrides):
         self.__activeOverrides.update(overrides)
@@ -183,6 +197,8 @@ cd {ROOT}
         self.__wasRun= {}
         self.__wasSkipped = {}
         self.__wasDownloadTried = {}
+        self.__downloadFailed = set()
+        self.__missingArtifacts = set()
         self.__verbose = max(ALWAYS, min(TRACE, verbose))
         self.__noLogFile = noLogFile
         self.__force = force
@@ -199,15 +215,22 @@ cd {ROOT}
         self.__cleanCheckout = False
         self.__srcBuildIds = {}
         self.__buildDistBuildIds = {}
+        self.__buildIdDependents = {}
+        self.__buildIdGeneration = 0
         self.__statistic = LocalBuilderStatistic()
+        self.__profile = BuildProfile()
         self.__alwaysCheckout = []
         self.__linkDeps = True
         self.__jobs = 1
+        self.__memory = None
+        self.__poolJobs = {}
         self.__bufferedStdIO = False
         self.__keepGoing = False
         self.__audit = True
+        self.__auditStore = AuditStore.open(".bob-audit")
         self.__fingerprints = { None : b'', "" : b'' }
         self.__workspaceLocks = {}
+        self.__watchWorkspaces = False
 
     def setArchiveHandler(self, archive):
         self.__archive = archive
@@ -260,6 +283,20 @@ cd {ROOT}
     def setJobs(self, jobs):
         self.__jobs = max(jobs, 1)
 
+    def setMemoryBudget(self, memory):
+        """Limit the memory in MiB that is reserved by concurrent steps."""
+        self.__memory = memory
+
+    def setPoolJobs(self, checkout=None, download=None, fingerprint=None):
+        """Set the number of concurrent checkouts, downloads and fingerprints.
+
+        These are executed in separate pools so that they do not compete with
+        the build steps for job slots. By default each pool has as many slots
+        as there are jobs.
+        """
+        self.__poolJobs = { "checkout" : checkout, "download" : download,
+                            "fingerprint" : fingerprint }
+
     def enableBufferedIO(self):
         self.__bufferedStdIO = True
 
@@ -269,6 +306,12 @@ cd {ROOT}
     def setAudit(self, audit):
         self.__audit = audit
 
+    def setWatchWorkspaces(self, watch):
+        self.__watchWorkspaces = watch
+
+    def saveProfile(self, fileName):
+        self.__profile.dump(fileName)
+
     def saveBuildState(self):
         state = {}
         # Save 'wasRun' as plain dict. Skipped steps are dropped because they
@@ -311,21 +354,12 @@ cd {ROOT}
         self.__wasRun[path] = (step.getVariantId(), isCheckoutStep)
         self.__wasSkipped[path] = skipped
 
-    def _clearWasRun(self):
-        """Clear "was-run" info for build- and package-steps."""
-        self.__wasRun = { path : (vid, isCheckoutStep)
-            for path, (vid, isCheckoutStep) in self.__wasRun.items()
-            if isCheckoutStep }
-
     def _wasDownloadTried(self, step):
         return self.__wasDownloadTried.get(step.getWorkspacePath(), False)
 
     def _setDownloadTried(self, step):
         self.__wasDownloadTried[step.getWorkspacePath()] = True
 
-    def _clearDownloadTried(self):
-        self.__downloadDisposition = {}
-
     def _constructDir(self, step, label):
         created = False
         workDir = step.getWorkspacePath()
@@ -334,6 +368,33 @@ cd {ROOT}
             created = True
         return (workDir, created)
 
+    async def _hashWorkspace(self, step, watch=False):
+        """Hash the workspace of a step without blocking the event loop.
+
+        The hashing is done in the executor pool of the event loop. The caller
+        must hold a job slot so that no more than the configured number of
+        jobs are hashing concurrently.
+
+        The change journal of the workspace is used to hash only the
+        directories that were changed since the last time if ``watch`` is set
+        and watching workspaces is enabled. This is only done for checkout
+        workspaces and build workspaces in develop mode.
+        """
+        loop = asyncio.get_event_loop()
+        workspace = step.getWorkspacePath()
+        start = time.monotonic()
+        watch = watch and self.__watchWorkspaces
+        with self.__profile.profileAction(step, "HASH", DummyTUIAction()) as a:
+            try:
+                ret, hashed = await loop.run_in_executor(None, _hashWorkspaceDirectory,
+                                                         workspace, watch)
+            except (concurrent.futures.CancelledError, concurrent.futures.process.BrokenProcessPool):
+                raise BuildError("Hashing of workspace interrupted.")
+            a.addBytesHashed(hashed)
+        stepMessage(step, "HASH", "{} ({:.2f}s)".format(workspace, time.monotonic() - start),
+            EXECUTED, INFO)
+        return ret
+
     def __workspaceLock(self, step):
         path = step.getWorkspacePath()
         ret = self.__workspaceLocks.get(path)
@@ -395,7 +456,7 @@ cd {ROOT}
                                                 .format(e.slogan, dir),
                                            WARNING)
 
-            audit.save(auditPath)
+            audit.save(auditPath, self.__auditStore)
             return auditPath
 
     def __linkDependencies(self, step):
@@ -485,7 +546,13 @@ cd {ROOT}
         invoker = Invoker(spec, self.__preserveEnv, self.__noLogFile,
             self.__verbose >= INFO, self.__verbose >= NORMAL,
             self.__verbose >= DEBUG, self.__bufferedStdIO)
-        ret = await invoker.executeStep(InvocationMode.CALL, cleanWorkspace)
+        if step.isCheckoutStep():
+            ret = await self.__runInPool("checkout",
+                lambda: invoker.executeStep(InvocationMode.CALL, cleanWorkspace))
+        else:
+            (weight, memory) = step.getResources()
+            ret = await self.__runWeighted(weight, memory,
+                lambda: invoker.executeStep(InvocationMode.CALL, cleanWorkspace))
         if not self.__bufferedStdIO: ttyReinit() # work around MSYS2 messing up the console
         if ret == -int(signal.SIGINT):
             raise BuildError("User aborted while running {}".format(absRunFile),
@@ -504,6 +571,11 @@ cd {ROOT}
         """Create and return task for coroutine."""
         return asyncio.get_event_loop().create_task(self.__taskWrapper(coro))
 
+    @staticmethod
+    def __getTaskKey(step, checkoutOnly):
+        sandbox = step.getSandbox() and step.getSandbox().getStep().getVariantId()
+        return (step.getWorkspacePath(), sandbox, checkoutOnly)
+
     def __createCookTask(self, coro, step, checkoutOnly, tracker, count):
         """Create and return task for a cook()-like coroutine.
 
@@ -514,15 +586,14 @@ cd {ROOT}
         If ``count`` is True then the task will be counted in the global
         progress.
         """
-        sandbox = step.getSandbox() and step.getSandbox().getStep().getVariantId()
-        path = (step.getWorkspacePath(), sandbox, checkoutOnly)
+        path = self.__getTaskKey(step, checkoutOnly)
         task = tracker.get(path)
         if task is not None: return task
 
         # Is there a concurrent task running for *not* checkoutOnly? If yes
         # then we have to wait for it to not call the same coroutine
         # concurrently.
-        alternatePath = (step.getWorkspacePath(), sandbox, not checkoutOnly)
+        alternatePath = self.__getTaskKey(step, not checkoutOnly)
         alternateTask = tracker.get(alternatePath)
 
         if count:
@@ -557,6 +628,8 @@ cd {ROOT}
         try:
             task = asyncio.Task.current_task()
             self.__allTasks.add(task)
+            if step is not None:
+                self.__taskPriorities[task] = self.__schedule.getPriority(step)
             if fence is not None:
                 await fence
             ret = await coro()
@@ -600,6 +673,12 @@ cd {ROOT}
             for i in asyncio.Task.all_tasks(): i.cancel()
 
         async def dispatcher():
+            # The prefetching runs concurrently. Cooked package steps wait
+            # for their prefetch task if there is one.
+            if not checkoutOnly and self.__archive.canDownloadLocal():
+                prefetch = self.__createGenericTask(lambda: self.__prefetch(steps, depth))
+            else:
+                prefetch = None
             if self.__jobs > 1:
                 packageJobs = [
                     self.__createGenericTask(lambda s=step: self._cookTask(s, checkoutOnly, depth))
@@ -613,20 +692,31 @@ cd {ROOT}
                     await asyncio.wait({job})
                 # retrieve results as last step to --keep-going
                 for job in packageJobs: job.result()
+            if prefetch is not None:
+                await asyncio.wait({prefetch})
 
         loop = asyncio.get_event_loop()
+        self.__schedule = CriticalPathSchedule(steps, self.__jobs)
         self.__restart = True
         while self.__restart:
             self.__running = True
             self.__restart = False
             self.__cookTasks = {}
             self.__buildIdTasks = {}
+            self.__prefetchTasks = {}
+            self.__prefetchVisited = set()
             self.__fingerprintTasks = {}
             self.__allTasks = set()
+            self.__taskPriorities = {}
             self.__buildErrors = []
-            self.__runners = asyncio.BoundedSemaphore(self.__jobs)
+            self.__runners = JobSlots(self.__jobs, self.__memory)
+            self.__pools = {
+                name : JobSlots(self.__poolJobs.get(name) or self.__jobs)
+                for name in ("checkout", "download", "fingerprint")
+            }
             self.__tasksDone = 0
             self.__tasksNum = 0
+            setProfile(self.__profile)
 
             j = self.__createGenericTask(dispatcher)
             try:
@@ -653,18 +743,32 @@ cd {ROOT}
                 loop.run_until_complete(asyncio.gather(*self.__allTasks,
                                                        return_exceptions=True))
             self.__allTasks.clear()
+            self.__taskPriorities.clear()
+            setProfile(None)
+            for (step, start, end) in self.__profile.getExecutedSteps():
+                self.__schedule.stepExecuted(step, start, end)
+            self.__profile.saveTimings()
 
             if len(self.__buildErrors) > 1:
                 raise MultiBobError(self.__buildErrors)
             elif self.__buildErrors:
                 raise self.__buildErrors[0]
 
+        makespan = self.__schedule.getMakespan()
+        if makespan is not None:
+            self.__statistic.predictedMakespan += makespan[0]
+            self.__statistic.actualMakespan += makespan[1]
+
         if not self.__running:
             raise BuildError("Canceled by user!",
                              help = "Run again with '--resume' to skip already built packages.")
 
+    def __getPriority(self):
+        """Priority of the current task when waiting for a job slot."""
+        return self.__taskPriorities.get(asyncio.Task.current_task(), 0.0)
+
     async def _cookTask(self, step, checkoutOnly, depth):
-        async with self.__runners:
+        async with self.__runners.slot(self.__getPriority()):
             if not self.__running: raise CancelBuildException
             await self._cook([step], step.getPackage(), checkoutOnly, depth)
 
@@ -699,7 +803,7 @@ cd {ROOT}
             for t in tasks: t.result()
 
     async def _cookStep(self, step, checkoutOnly, depth):
-        await self.__runners.acquire()
+        await self.__runners.acquire(self.__getPriority())
         try:
             if not self.__running:
                 raise CancelBuildException
@@ -720,13 +824,14 @@ cd {ROOT}
                         self._setAlreadyRun(step, False, checkoutOnly)
             else:
                 assert step.isPackageStep()
-                self._preparePackageStep(step)
-
-                # Prohibit up-/download if we are on the old allRelocatable
-                # policy and the package is not explicitly relocatable and
-                # built outside the sandbox.
-                mayUpOrDownload = self.__recipes.getPolicy('allRelocatable') or \
-                    step.isRelocatable() or (step.getSandbox() is not None)
+                # Let a pending prefetch of the step finish first. The
+                # download is only tried once per invocation!
+                prefetch = self.__prefetchTasks.get(self.__getTaskKey(step, False))
+                if prefetch is not None:
+                    await self.__yieldJobWhile(asyncio.wait({prefetch}))
+                async with self.__workspaceLock(step):
+                    self._preparePackageStep(step)
+                mayUpOrDownload = self.__mayUpOrDownload(step)
 
                 # Calculate build-id and fingerprint of expected artifact if
                 # needed. Must be done without the workspace lock because it
@@ -740,16 +845,15 @@ cd {ROOT}
                 # invocation!
                 downloaded = False
                 if mayUpOrDownload and not checkoutOnly:
-                    async with self.__workspaceLock(step):
-                        if not self._wasDownloadTried(step):
-                            downloaded = await self._downloadPackage(step, depth, buildId)
-                            self._setDownloadTried(step)
-                            if downloaded:
-                                self._setAlreadyRun(step, False, checkoutOnly)
+                    downloaded = await self.__tryDownload(step, depth, buildId)
 
                 # Recurse and build if not downloaded
                 if not downloaded:
                     await self._cook(step.getAllDepSteps(), step.getPackage(), checkoutOnly, depth+1)
+                    # The build-id might have changed in the meantime if
+                    # some sources were predicted wrongly.
+                    if not checkoutOnly:
+                        buildId = await self._getBuildId(step, depth)
                     async with self.__workspaceLock(step):
                         if not self._wasAlreadyRun(step, checkoutOnly):
                             await self._cookPackageStep(step, checkoutOnly, depth, mayUpOrDownload, buildId)
@@ -761,6 +865,116 @@ cd {ROOT}
             # we're done, let the others do their work
             self.__runners.release()
 
+    def __mayUpOrDownload(self, step):
+        # Prohibit up-/download if we are on the old allRelocatable
+        # policy and the package is not explicitly relocatable and
+        # built outside the sandbox.
+        return self.__recipes.getPolicy('allRelocatable') or \
+            step.isRelocatable() or (step.getSandbox() is not None)
+
+    async def __tryDownload(self, step, depth, buildId):
+        """Try to download a package step.
+
+        The download is only tried once per invocation. Returns True if the
+        package was downloaded, either now or by a previous attempt.
+        """
+        path = step.getWorkspacePath()
+        async with self.__workspaceLock(step):
+            if self._wasDownloadTried(step):
+                # The error was already reported by the first attempt
+                if path in self.__downloadFailed: raise CancelBuildException
+                return self._wasAlreadyRun(step, False)
+            try:
+                downloaded = await self._downloadPackage(step, depth, buildId)
+            except BuildError:
+                self._setDownloadTried(step)
+                self.__downloadFailed.add(path)
+                raise
+            if downloaded and self.__buildDistBuildIds.get(path) != buildId:
+                # Build-id was invalidated while downloading.
+                # Others may already rely on the result.
+                raise RestartBuildException()
+            self._setDownloadTried(step)
+            if downloaded:
+                self._setAlreadyRun(step, False)
+            return downloaded
+
+    async def __prefetch(self, steps, depth):
+        """Speculatively download the packages below ``steps``.
+
+        The binary archive is queried top-down, one level of packages at a
+        time. The existence of all artifacts of a level is queried in a
+        single round. Then all found packages are downloaded concurrently,
+        limited by the size of the download pool. The dependencies of a
+        package are only prefetched if the package itself could not be
+        downloaded. Downloaded packages are marked as done and are skipped
+        when they are cooked.
+
+        This runs concurrently to the cooking of ``steps``. The prefetch tasks
+        of a level are created before the archive is queried so that cooked
+        package steps can wait for them instead of trying the download
+        themselves.
+        """
+        level = [ (s, depth) for s in steps ]
+        while level:
+            # Collect package steps of current level. Traverse through the
+            # build and checkout steps in between.
+            packages = []
+            todo = list(reversed(level))
+            while todo:
+                (step, depth) = todo.pop()
+                if not step.isValid(): continue
+                path = step.getWorkspacePath()
+                if path in self.__prefetchVisited: continue
+                self.__prefetchVisited.add(path)
+                if step.isPackageStep():
+                    packages.append((step, depth))
+                else:
+                    todo.extend((s, depth+1) for s in reversed(step.getAllDepSteps()))
+
+            query = self.__createGenericTask(lambda packages=packages: self.__queryArchive(
+                [ (s, d) for (s, d) in packages
+                  if self.__mayUpOrDownload(s) and self.__downloadEnabled(s, d) ]))
+            tasks = [ self.__createCookTask(lambda s=s, d=d: self._prefetchStep(s, d, query),
+                                            s, False, self.__prefetchTasks, False)
+                      for (s, d) in packages ]
+            await asyncio.wait(tasks + [query])
+
+            level = []
+            if self.__skipDeps: break
+            for ((step, depth), task) in zip(packages, tasks):
+                if task.cancelled() or task.exception() is not None: continue
+                if task.result(): continue
+                level.extend((s, depth+1) for s in step.getAllDepSteps())
+
+    async def __queryArchive(self, packages):
+        """Query which artifacts of the given package steps are missing."""
+        if not packages: return
+        async with self.__runners.slot():
+            if not self.__running: raise CancelBuildException
+            try:
+                buildIds = await self.__getBuildIdList([ s for (s, d) in packages ],
+                                                       min(d for (s, d) in packages))
+            except CancelBuildException:
+                # Error is reported when cooking the affected packages
+                return
+            found = await self.__runInPool("download",
+                lambda: self.__archive.queryPackages(set(buildIds)))
+            self.__missingArtifacts.update(set(buildIds) - found)
+
+    async def _prefetchStep(self, step, depth, query):
+        """Try to download a package step. Returns True if it is done."""
+        await asyncio.wait({query})
+        async with self.__runners.slot(self.__getPriority()):
+            if not self.__running: raise CancelBuildException
+            if self._wasAlreadyRun(step, False): return True
+            if not self.__mayUpOrDownload(step): return False
+            # The step might be cooked concurrently
+            async with self.__workspaceLock(step):
+                self._preparePackageStep(step)
+            buildId = await self._getBuildId(step, depth)
+            return await self.__tryDownload(step, depth, buildId)
+
     async def _cookCheckoutStep(self, checkoutStep, depth):
         overrides = set()
         scmList = checkoutStep.getScmList()
@@ -869,7 +1083,7 @@ cd {ROOT}
 
         # We always have to rehash the directory as the user might have
         # changed the source code manually.
-        checkoutHash = hashWorkspace(checkoutStep)
+        checkoutHash = await self._hashWorkspace(checkoutStep, True)
         BobState().setResultHash(prettySrcPath, checkoutHash)
 
         # Generate audit trail. Has to be done _after_ setResultHash()
@@ -934,7 +1148,7 @@ cd {ROOT}
             # We always rehash the directory in development mode as the
             # user might have compiled the package manually.
             if not self.__cleanBuild:
-                BobState().setResultHash(prettyBuildPath, hashWorkspace(buildStep))
+                BobState().setResultHash(prettyBuildPath, await self._hashWorkspace(buildStep, True))
         else:
             with stepExec(buildStep, "BUILD", prettyBuildPath) as a:
                 # Squash state because running the step will change the
@@ -944,7 +1158,7 @@ cd {ROOT}
                 BobState().setResultHash(prettyBuildPath, datetime.datetime.utcnow())
                 # build it
                 await self._runShell(buildStep, "build", a, self.__cleanBuild)
-                buildHash = hashWorkspace(buildStep)
+                buildHash = await self._hashWorkspace(buildStep, not self.__cleanBuild)
             await self._generateAudit(buildStep, depth, buildHash)
             BobState().setResultHash(prettyBuildPath, buildHash)
             BobState().setVariantId(prettyBuildPath, buildDigest[0])
@@ -964,6 +1178,10 @@ cd {ROOT}
             # invalidate result if folder was created
             BobState().resetWorkspaceState(prettyPackagePath, packageDigest)
 
+    def __downloadEnabled(self, packageStep, depth):
+        return depth >= self.__downloadDepth or (self.__downloadPackages and
+            self.__downloadPackages.search(packageStep.getPackage().getName()))
+
     async def _downloadPackage(self, packageStep, depth, packageBuildId):
         # Dissect input parameters that lead to current workspace the last time
         prettyPackagePath = packageStep.getWorkspacePath()
@@ -984,8 +1202,7 @@ cd {ROOT}
         workspaceChanged = False
         wasDownloaded = False
         packageDigest = packageStep.getVariantId()
-        if depth >= self.__downloadDepth or (self.__downloadPackages and
-                self.__downloadPackages.search(packageStep.getPackage().getName())):
+        if self.__downloadEnabled(packageStep, depth):
             # prune directory if we previously downloaded/built something different
             if (oldInputBuildId is not None) and (oldInputBuildId != packageBuildId):
                 prune = True
@@ -1010,13 +1227,18 @@ cd {ROOT}
             # we're done.
             if BobState().getResultHash(prettyPackagePath) is None:
                 audit = os.path.join(prettyPackagePath, "..", "audit.json.gz")
-                wasDownloaded = await self.__archive.downloadPackage(packageStep,
-                    packageBuildId, audit, prettyPackagePath)
+                if packageBuildId in self.__missingArtifacts:
+                    stepMessage(packageStep, "DOWNLOAD", "{} (not in archive)"
+                        .format(prettyPackagePath), SKIPPED, INFO)
+                else:
+                    wasDownloaded = await self.__runInPool("download",
+                        lambda: self.__archive.downloadPackage(packageStep,
+                            packageBuildId, audit, prettyPackagePath))
                 if wasDownloaded:
                     self.__statistic.packagesDownloaded += 1
                     BobState().setInputHashes(prettyPackagePath,
                         packageInputDownloaded(packageBuildId))
-                    packageHash = hashWorkspace(packageStep)
+                    packageHash = await self._hashWorkspace(packageStep)
                     workspaceChanged = True
                     wasDownloaded = True
                 elif depth >= self.__downloadDepthForce:
@@ -1069,7 +1291,7 @@ cd {ROOT}
                 BobState().delInputHashes(prettyPackagePath)
                 BobState().setResultHash(prettyPackagePath, datetime.datetime.utcnow())
                 await self._runShell(packageStep, "package", a)
-                packageHash = hashWorkspace(packageStep)
+                packageHash = await self._hashWorkspace(packageStep)
                 packageDigest = self.__getIncrementalVariantId(packageStep)
                 workspaceChanged = True
                 self.__statistic.packagesBuilt += 1
@@ -1169,9 +1391,8 @@ cd {ROOT}
 
         Checkout steps are cached separately from build and package steps.
         Build-ids of checkout steps may be predicted through live-build-ids. If
-        we the prediction was wrong the build and package step build-ids are
-        invalidated because they could be derived from the wrong checkout
-        build-id.
+        we the prediction was wrong the build and package step build-ids that
+        were derived from the wrong checkout build-id are invalidated.
         """
 
         # Pass over to __getBuildIdList(). It will try to create a task and (if
@@ -1201,7 +1422,7 @@ cd {ROOT}
         return ret
 
     async def __getBuildIdTask(self, step, depth):
-        async with self.__runners:
+        async with self.__runners.slot(self.__getPriority()):
             ret = await self.__getBuildIdSingle(step, depth)
         return ret
 
@@ -1217,9 +1438,20 @@ cd {ROOT}
         else:
             ret = self.__buildDistBuildIds.get(path)
             if ret is None:
-                fingerprint = await self._getFingerprint(step, depth)
-                ret = await step.getDigestCoro(lambda x: self.__getBuildIdList(x, depth+1),
-                    True, fingerprint=fingerprint, platform=getPlatformTag())
+                def getDeps(deps):
+                    for dep in deps:
+                        self.__buildIdDependents.setdefault(dep.getWorkspacePath(),
+                                                            set()).add(path)
+                    return self.__getBuildIdList(deps, depth+1)
+
+                # Calculate again if some build-ids were invalidated in the
+                # meantime. We might have used an outdated one.
+                generation = None
+                while generation != self.__buildIdGeneration:
+                    generation = self.__buildIdGeneration
+                    fingerprint = await self._getFingerprint(step, depth)
+                    ret = await step.getDigestCoro(getDeps, True,
+                        fingerprint=fingerprint, platform=getPlatformTag())
                 self.__buildDistBuildIds[path] = ret
 
         return ret
@@ -1229,25 +1461,49 @@ cd {ROOT}
 
         Through live-build-ids it is possible that an initially queried
         build-id does not match the real build-id after the sources have been
-        checked out. As we might have already downloaded artifacts based on
-        the now invalidated build-id we have to restart the build and check all
-        build-ids, build- and package-steps again.
+        checked out. Only the build-ids of steps that were derived from the
+        wrong build-id are invalidated. They are calculated again when needed.
+
+        Steps that are still in progress pick up the new build-id. If some of
+        the affected steps were already finished (e.g. artifacts were
+        downloaded based on the wrong build-id) they are forgotten and the
+        build is restarted. All unrelated steps are kept.
         """
         key = (step.getWorkspacePath(), step.getVariantId())
 
         # Invalidate wrong live-build-id
         self.__invalidateLiveBuildId(step)
 
-        # Invalidate (possibly) derived build-ids
+        # Invalidate derived build-ids
         self.__srcBuildIds[key] = (checkoutHash, False)
-        self.__buildDistBuildIds = {}
+        affected = self.__invalidateDependentBuildIds(step.getWorkspacePath())
+
+        # Forget affected steps that were already finished and restart
+        stale = [ path for path in affected if path in self.__wasRun ]
+        if stale:
+            for path in stale: del self.__wasRun[path]
+            raise RestartBuildException()
 
-        # Forget all executed build- and package-steps
-        self._clearWasRun()
-        self._clearDownloadTried()
+    def __invalidateDependentBuildIds(self, path):
+        """Invalidate all build-ids that were derived from the step at path.
 
-        # start from scratch
-        raise RestartBuildException()
+        Returns the set of the workspace paths of the affected steps.
+        """
+        self.__buildIdGeneration += 1
+        affected = set()
+        todo = [path]
+        while todo:
+            for dependent in self.__buildIdDependents.get(todo.pop(), ()):
+                if dependent in affected: continue
+                affected.add(dependent)
+                todo.append(dependent)
+
+        for dependent in affected:
+            self.__buildDistBuildIds.pop(dependent, None)
+            self.__wasDownloadTried.pop(dependent, None)
+            self.__downloadFailed.discard(dependent)
+
+        return affected
 
     def __getIncrementalVariantId(self, step):
         """Calculate the variant-id with respect to workspace state.
@@ -1289,13 +1545,38 @@ cd {ROOT}
             acquired = False
             while not acquired:
                 try:
-                    await self.__runners.acquire()
+                    await self.__runners.acquire(self.__getPriority())
                     acquired = True
                 except concurrent.futures.CancelledError:
                     pass
         if not self.__running and not ignoreExecutionStop: raise CancelBuildException
         return ret
 
+    async def __runInPool(self, pool, coro):
+        """Run a coroutine in a separate pool instead of the job slots.
+
+        The job slot is handed to other tasks while the coroutine is waiting
+        for or running in the pool. The coroutine must not wait for other
+        tasks.
+        """
+        async def run():
+            async with self.__pools[pool].slot(self.__getPriority()):
+                if not self.__running: raise CancelBuildException
+                return await coro()
+        return await self.__yieldJobWhile(run(), True)
+
+    async def __runWeighted(self, weight, memory, coro):
+        """Run a coroutine with more than one job slot and/or reserved memory.
+
+        The coroutine must not wait for other tasks.
+        """
+        if weight <= 1 and memory <= 0:
+            return await coro()
+        async def run():
+            async with self.__runners.slot(self.__getPriority(), weight, memory):
+                return await coro()
+        return await self.__yieldJobWhile(run(), True)
+
     async def _getFingerprint(self, step, depth):
         # Use a shortcut when the sandboxFingerprints policy is not set and the
         # step is built inside a sandbox. In this case the variant-id and
@@ -1345,7 +1626,7 @@ cd {ROOT}
         return hashlib.sha1(fingerprint).digest()
 
     async def __calcFingerprintTask(self, step, sandbox, key, depth):
-        async with self.__runners:
+        async with self.__runners.slot(self.__getPriority()):
             # If this is built in a sandbox then the artifact cache may help...
             if sandbox:
                 fingerprint = await self.__archive.downloadLocalFingerprint(sandbox, key)
@@ -1358,7 +1639,8 @@ cd {ROOT}
                 if sandbox:
                     await self._cook([sandbox], sandbox.getPackage(), False, depth+1)
                 with stepAction(step, "FNGRPRNT", step.getPackage().getName()) as a:
-                    fingerprint = await self.__runFingerprintScript(step, a)
+                    fingerprint = await self.__runInPool("fingerprint",
+                        lambda: self.__runFingerprintScript(step, a))
 
                 # Always upload if this was calculated in a sandbox. The task will
                 # only be run once so we don't need to worry here about duplicate
@@ -3,6 +3,7 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+from ...audit import AuditStore
 from ...input import RecipeSet
 from ...scm import getScm, ScmTaint, ScmStatus
 from ...state import BobState
@@ -218,5 +219,13 @@ would get removed without actually deleting that already.
                 if not os.path.exists(d): BobState().delDirectoryState(d)
             for d in BobState().getAtticDirectories():
                 if not os.path.exists(d): BobState().delAtticDirectoryState(d)
+
+        # Remove audit records that are not referenced by any workspace anymore
+        if os.path.isdir(".bob-audit"):
+            audits = [ os.path.join(d, "..", "audit.json.gz")
+                for d in BobState().getDirectories() if d not in delPaths ]
+            for r in AuditStore.open(".bob-audit").prune(audits, args.dry_run):
+                if args.verbose or args.dry_run:
+                    print("rm", os.path.relpath(r))
     finally:
         BobState().setSynchronous()
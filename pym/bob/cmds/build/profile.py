@@ -0,0 +1,218 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Timing of step actions.
+
+All actions of a step (CHECKOUT, BUILD, PACKAGE, DOWNLOAD, FNGRPRNT, ...) are
+measured while the profile is active. The accumulated wall time, CPU time,
+hashed and transferred bytes of each step are stored in the workspace state
+by variant-id. Only steps that were actually checked out, built, packaged or
+downloaded are stored. Otherwise a step that was merely hashed again would
+replace the timing of its last real execution. The single actions are kept to
+write a profile of the job slot occupancy in the Chrome trace event format.
+
+The CPU time is the time consumed by Bob itself and its terminated child
+processes while the action was running. It cannot be attributed to a single
+action if actions of other tasks ran at the same time. No CPU time is
+recorded for such actions and their steps.
+"""
+
+from ...errors import BuildError
+from ...state import BobState
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+
+if hasattr(asyncio, "current_task"):
+    def _currentTask():
+        try:
+            return asyncio.current_task()
+        except RuntimeError:
+            return None
+else:
+    def _currentTask():
+        return asyncio.Task.current_task()
+
+def _cpuTime():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def _stepKind(step):
+    if step.isCheckoutStep():
+        return "checkout"
+    elif step.isBuildStep():
+        return "build"
+    else:
+        return "package"
+
+class ProfiledAction:
+    """Wrapper of a tty action that measures its execution."""
+
+    def __init__(self, profile, step, action, tuiAction):
+        self.__profile = profile
+        self.__step = step
+        self.__action = action
+        self.__tuiAction = tuiAction
+
+    def __getattr__(self, attr):
+        return getattr(self.__tuiAction, attr)
+
+    def __enter__(self):
+        self.__tuiAction.__enter__()
+        self.__start = self.__profile._enter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__profile._leave(self.__step, self.__action, self.__start,
+                              self.__tuiAction, exc_type is None)
+        return self.__tuiAction.__exit__(exc_type, exc_value, traceback)
+
+EXECUTION_ACTIONS = frozenset(["CHECKOUT", "BUILD", "PACKAGE", "DOWNLOAD"])
+
+class BuildProfile:
+    """Collects the timing of all step actions of a build.
+
+    Each task that executes actions is assigned to a lane while it is active.
+    Because actions are only executed while holding a job slot, the lanes
+    reflect the job slot occupancy. Nested actions of the same task share the
+    lane of the outermost action.
+    """
+
+    def __init__(self):
+        self.__origin = time.monotonic()
+        self.__events = []
+        self.__timings = {}
+        self.__executed = {}
+        self.__tasks = {}
+        self.__running = []
+        self.__freeLanes = []
+        self.__nextLane = itertools.count()
+
+    def profileAction(self, step, action, tuiAction):
+        return ProfiledAction(self, step, action, tuiAction)
+
+    def _enter(self):
+        task = _currentTask()
+        state = self.__tasks.get(task)
+        if state is None:
+            if self.__freeLanes:
+                lane = heapq.heappop(self.__freeLanes)
+            else:
+                lane = next(self.__nextLane)
+            state = self.__tasks[task] = [lane, 0]
+        state[1] += 1
+
+        # Actions of different tasks that overlap cannot tell their CPU time
+        # apart. Flag them both.
+        running = [task, False]
+        for other in self.__running:
+            if other[0] is not task:
+                other[1] = running[1] = True
+        self.__running.append(running)
+
+        return (state[0], state[1] == 1, time.monotonic(), _cpuTime(), running)
+
+    def _leave(self, step, action, start, tuiAction, ok):
+        (lane, outermost, wall, cpu, running) = start
+        end = time.monotonic()
+        self.__running = [ r for r in self.__running if r is not running ]
+        cpu = None if running[1] else _cpuTime() - cpu
+
+        task = _currentTask()
+        state = self.__tasks[task]
+        state[1] -= 1
+        if state[1] == 0:
+            heapq.heappush(self.__freeLanes, state[0])
+            del self.__tasks[task]
+
+        hashed = tuiAction.bytesHashed
+        transferred = tuiAction.bytesTransferred
+        self.__events.append((step.getPackage().getName(), action, lane,
+            wall, end, cpu, hashed, transferred, ok))
+
+        variantId = step.getVariantId()
+        timing = self.__timings.get(variantId)
+        if timing is None:
+            timing = self.__timings[variantId] = {
+                "recipe" : step.getPackage().getRecipe().getName(),
+                "step" : _stepKind(step),
+                "wall" : 0.0,
+                "cpu" : 0.0,
+                "hashed" : 0,
+                "transferred" : 0,
+            }
+        if outermost:
+            timing["wall"] += end - wall
+            if cpu is None or timing["cpu"] is None:
+                timing["cpu"] = None
+            else:
+                timing["cpu"] += cpu
+        timing["hashed"] += hashed
+        timing["transferred"] += transferred
+
+        span = self.__executed.get(variantId)
+        if span is not None:
+            span[2] = end
+        elif action in EXECUTION_ACTIONS:
+            self.__executed[variantId] = [step, wall, end]
+
+    def getExecutedSteps(self):
+        """Return (step, start, end) of all steps executed since the last save.
+
+        The span covers all actions of a step since its first execution
+        action.
+        """
+        return [ tuple(span) for span in self.__executed.values() ]
+
+    def saveTimings(self):
+        """Store the timing of all steps that were executed so far."""
+        state = BobState()
+        for variantId in self.__executed:
+            state.setStepTiming(variantId, self.__timings[variantId])
+        self.__timings.clear()
+        self.__executed.clear()
+
+    def dump(self, fileName):
+        """Write the profile as Chrome trace events.
+
+        Every lane is shown as a separate thread. The file can be loaded
+        into chrome://tracing or other trace viewers.
+        """
+        lanes = set()
+        events = []
+        for (name, action, lane, start, end, cpu, hashed, transferred, ok) in self.__events:
+            lanes.add(lane)
+            events.append({
+                "name" : "{} {}".format(action, name),
+                "cat" : action,
+                "ph" : "X",
+                "pid" : 1,
+                "tid" : lane,
+                "ts" : round((start - self.__origin) * 1000000),
+                "dur" : round((end - start) * 1000000),
+                "args" : {
+                    "package" : name,
+                    "cpu" : round(cpu, 3) if cpu is not None else None,
+                    "hashed" : hashed,
+                    "transferred" : transferred,
+                    "result" : "ok" if ok else "failed",
+                },
+            })
+        events.extend({
+                "name" : "thread_name",
+                "ph" : "M",
+                "pid" : 1,
+                "tid" : lane,
+                "args" : { "name" : "Job {}".format(lane+1) },
+            } for lane in sorted(lanes))
+
+        try:
+            with open(fileName, "w") as f:
+                json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, f)
+        except OSError as e:
+            raise BuildError("Cannot write profile: " + str(e))
@@ -0,0 +1,219 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Critical path based scheduling of build jobs.
+
+Every step is prioritized by the estimated length of the critical path that
+is still ahead of it: its own duration plus the longest chain of steps that
+depend on it. Free job slots are handed to the waiting step with the highest
+priority. Long dependency chains are thereby started early instead of being
+stuck behind cheap leaf packages.
+
+The durations of the steps are taken from the timings that were recorded per
+variant-id in the workspace state. The recorded wall time is averaged over the
+executions of a step. Steps that were never executed are estimated with
+DEFAULT_DURATION.
+"""
+
+from ...state import BobState
+import asyncio
+import heapq
+import itertools
+
+DEFAULT_DURATION = 1.0
+
+class JobSlots:
+    """Bounded number of job slots that are granted by priority.
+
+    Works like an asyncio.BoundedSemaphore except that waiters with a higher
+    priority are woken up first. Waiters of the same priority are served in
+    FIFO order.
+
+    A job may take more than one slot and may additionally reserve memory if
+    a memory budget is given. Requests that exceed the available slots or the
+    budget are clamped so that such jobs can still run alone. Waiters are
+    strictly served in order. A big job is thus not starved by smaller jobs
+    that would still fit.
+    """
+
+    def __init__(self, jobs, memory=None):
+        self.__jobs = jobs
+        self.__memory = memory
+        self.__free = jobs
+        self.__freeMemory = memory or 0
+        self.__waiting = []
+        self.__seq = itertools.count()
+
+    def __clamp(self, weight, memory):
+        weight = max(1, min(weight, self.__jobs))
+        memory = min(memory, self.__memory) if self.__memory else 0
+        return (weight, memory)
+
+    def __fits(self, weight, memory):
+        return self.__free >= weight and self.__freeMemory >= memory
+
+    async def acquire(self, priority=0.0, weight=1, memory=0):
+        (weight, memory) = self.__clamp(weight, memory)
+        if not self.__waiting and self.__fits(weight, memory):
+            self.__free -= weight
+            self.__freeMemory -= memory
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.__waiting, (-priority, next(self.__seq), waiter,
+                                        weight, memory))
+        try:
+            await waiter
+        except:
+            # Pass the slots on if they were already granted to us.
+            # Otherwise the cancelled waiter is skipped when slots are
+            # released.
+            if waiter.done() and not waiter.cancelled():
+                self.__release(weight, memory)
+            else:
+                waiter.cancel()
+                self.__grant()
+            raise
+
+    def release(self, weight=1, memory=0):
+        self.__release(*self.__clamp(weight, memory))
+
+    def __release(self, weight, memory):
+        self.__free += weight
+        self.__freeMemory += memory
+        self.__grant()
+
+    def __grant(self):
+        waiting = self.__waiting
+        while waiting:
+            (_, _, waiter, weight, memory) = waiting[0]
+            if waiter.done():
+                heapq.heappop(waiting)
+            elif self.__fits(weight, memory):
+                heapq.heappop(waiting)
+                self.__free -= weight
+                self.__freeMemory -= memory
+                waiter.set_result(None)
+            else:
+                break
+
+    def slot(self, priority=0.0, weight=1, memory=0):
+        """Return an async context manager that holds a slot."""
+        return _JobSlot(self, priority, weight, memory)
+
+class _JobSlot:
+    def __init__(self, slots, priority, weight, memory):
+        self.__slots = slots
+        self.__priority = priority
+        self.__weight = weight
+        self.__memory = memory
+
+    async def __aenter__(self):
+        await self.__slots.acquire(self.__priority, self.__weight, self.__memory)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__slots.release(self.__weight, self.__memory)
+
+class CriticalPathSchedule:
+    """Priorities and makespan prediction of a build.
+
+    The dependency graph below ``roots`` is only traversed if more than one
+    job is used. Sequential builds do not need priorities and their makespan
+    is just the sum of all step durations.
+    """
+
+    def __init__(self, roots, jobs):
+        self.__jobs = jobs
+        self.__estimates = {}
+        self.__priorities = {}
+        self.__order = []
+        self.__edges = {}
+        self.__executed = {}
+        if jobs > 1:
+            self.__plan(roots)
+
+    @staticmethod
+    def __key(step):
+        return step.getWorkspacePath()
+
+    def __estimate(self, step, key):
+        ret = self.__estimates.get(key)
+        if ret is None:
+            ret = BobState().getStepDuration(step.getVariantId())
+            if ret is None: ret = DEFAULT_DURATION
+            self.__estimates[key] = ret
+        return ret
+
+    def __plan(self, roots):
+        """Calculate the remaining critical path of all steps.
+
+        A depth first traversal yields the steps in post-order. In reverse
+        order every step is visited before its dependencies. The priority
+        of each step is propagated to its dependencies from there.
+        """
+        edges = self.__edges
+        order = self.__order
+        for root in roots:
+            key = self.__key(root)
+            if key in edges or not root.isValid(): continue
+            edges[key] = []
+            self.__estimate(root, key)
+            stack = [(key, iter(root.getAllDepSteps()))]
+            while stack:
+                (key, deps) = stack[-1]
+                for dep in deps:
+                    if not dep.isValid(): continue
+                    depKey = self.__key(dep)
+                    edges[key].append(depKey)
+                    if depKey not in edges:
+                        edges[depKey] = []
+                        self.__estimate(dep, depKey)
+                        stack.append((depKey, iter(dep.getAllDepSteps())))
+                        break
+                else:
+                    stack.pop()
+                    order.append(key)
+
+        priorities = self.__priorities
+        for key in reversed(order):
+            prio = priorities.get(key, 0.0) + self.__estimates[key]
+            priorities[key] = prio
+            for dep in edges[key]:
+                if priorities.get(dep, 0.0) < prio:
+                    priorities[dep] = prio
+
+    def getPriority(self, step):
+        """Get remaining critical path of step in seconds."""
+        return self.__priorities.get(self.__key(step), 0.0)
+
+    def stepExecuted(self, step, start, end):
+        """Record the execution of a step for the makespan calculation."""
+        key = self.__key(step)
+        self.__executed[key] = (self.__estimate(step, key), start, end)
+
+    def getMakespan(self):
+        """Return predicted and actual makespan of the executed steps.
+
+        The prediction is the lower bound of the critical path through the
+        executed steps and their total work distributed over all jobs.
+        Returns None if no step was executed.
+        """
+        executed = self.__executed
+        if not executed: return None
+
+        work = sum(e for (e, _, _) in executed.values())
+        if self.__jobs > 1:
+            path = {}
+            for key in self.__order:
+                tmp = max((path[dep] for dep in self.__edges[key]), default=0.0)
+                e = executed.get(key)
+                path[key] = tmp + (e[0] if e is not None else 0.0)
+            predicted = max(max(path.values(), default=0.0), work / self.__jobs)
+        else:
+            predicted = work
+
+        actual = max(end for (_, _, end) in executed.values()) - \
+                 min(start for (_, start, _) in executed.values())
+        return (predicted, actual)
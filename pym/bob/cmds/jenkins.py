@@ -915,6 +915,8 @@ class JenkinsJob:
                 self.dumpStepAuditGen(d),
                 "", "# pack result for archive and inter-job exchange",
                 "cd \"$WORKSPACE\"",
+                # Always gzip compressed. The compression of the archive is
+                # only applied by local builds.
                 "tar zcfv {TGZ} -H pax --pax-option=\"bob-archive-vsn=1\" --transform='s|^{AUDIT}|meta/audit.json.gz|' --transform='s|^{WSP_PATH}|content|' {AUDIT} {WSP_PATH}".format(
                     TGZ=JenkinsJob._tgzName(d),
                     AUDIT=JenkinsJob._auditName(d),
@@ -923,7 +925,8 @@ class JenkinsJob:
                       not d.isRelocatable() and \
                       (d.getSandbox() is None) and \
                       (options.get("artifacts.copy", "jenkins") == "jenkins")
-                    else self.__archive.upload(d, JenkinsJob._buildIdName(d), JenkinsJob._tgzName(d))
+                    else self.__archive.uploadJenkinsAudit(d, JenkinsJob._buildIdName(d), JenkinsJob._auditName(d)) +
+                         self.__archive.upload(d, JenkinsJob._buildIdName(d), JenkinsJob._tgzName(d))
             ])
             if options.get("artifacts.copy", "jenkins") == "jenkins":
                 publish.append(JenkinsJob._tgzName(d))
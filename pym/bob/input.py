@@ -17,8 +17,10 @@ from os.path import expanduser
 from string import Template
 from textwrap import dedent
 import copy
+import copyreg
 import hashlib
 import fnmatch
+import io
 import os, os.path
 import pickle
 import re
@@ -107,6 +109,84 @@ class DigestHasher:
         """Extract host fingerprint digest part (if any)."""
         return digest[20:]
 
+class DigestPlan:
+    """Inputs of the digest of a step.
+
+    The digest of a step is calculated from static properties of the step and
+    the digests of its dependencies. The plan records both so that the digests
+    of all dependencies can be calculated in one go before the digest of the
+    step is computed with any hasher. The sandbox is listed only once in
+    ``deps`` even if it is used for the fingerprint too.
+    """
+
+    __slots__ = ('deps', '__sandboxFingerprint', '__sandbox', '__script',
+        '__tools', '__env', '__args')
+
+    def __init__(self, sandboxFingerprint, sandbox, script, tools, env, args):
+        self.deps = deps = []
+        if sandboxFingerprint is not None:
+            self.__sandboxFingerprint = 0
+            deps.append(sandboxFingerprint)
+        else:
+            self.__sandboxFingerprint = None
+        if not sandbox:
+            self.__sandbox = None
+        elif sandbox[0] is sandboxFingerprint:
+            self.__sandbox = (0, sandbox[1])
+        else:
+            self.__sandbox = (len(deps), sandbox[1])
+            deps.append(sandbox[0])
+        self.__script = script
+        self.__tools = [ (len(deps)+i, path, libs) for (i, (dep, path, libs)) in enumerate(tools) ]
+        deps.extend(dep for (dep, path, libs) in tools)
+        self.__env = env
+        self.__args = range(len(deps), len(deps) + len(args))
+        deps.extend(args)
+
+    def digest(self, digests, hasher=DigestHasher, fingerprint=None, platform=b''):
+        """Calculate the digest from the digests of the dependencies.
+
+        The ``digests`` must be in the same order as ``deps``.
+        """
+        h = hasher()
+        h.update(platform)
+        if self.__sandboxFingerprint is not None:
+            h.fingerprint(hasher.sliceRecipes(digests[self.__sandboxFingerprint]))
+        elif fingerprint:
+            h.fingerprint(fingerprint)
+        if self.__sandbox:
+            (dep, paths) = self.__sandbox
+            h.update(hasher.sliceRecipes(digests[dep]))
+            h.update(struct.pack("<I", len(paths)))
+            for p in paths:
+                h.update(struct.pack("<I", len(p)))
+                h.update(p.encode('utf8'))
+        else:
+            h.update(b'\x00' * 20)
+        script = self.__script
+        if script:
+            h.update(struct.pack("<I", len(script)))
+            h.update(script.encode("utf8"))
+        else:
+            h.update(b'\x00\x00\x00\x00')
+        h.update(struct.pack("<I", len(self.__tools)))
+        for (dep, path, libs) in self.__tools:
+            h.update(hasher.sliceRecipes(digests[dep]))
+            h.update(struct.pack("<II", len(path), len(libs)))
+            h.update(path.encode("utf8"))
+            for l in libs:
+                h.update(struct.pack("<I", len(l)))
+                h.update(l.encode('utf8'))
+        h.update(struct.pack("<I", len(self.__env)))
+        for (key, val) in sorted(self.__env.items()):
+            h.update(struct.pack("<II", len(key), len(val)))
+            h.update((key+val).encode('utf8'))
+        h.update(struct.pack("<I", len(self.__args)))
+        for dep in self.__args:
+            h.update(hasher.sliceRecipes(digests[dep]))
+            h.fingerprint(hasher.sliceHost(digests[dep]))
+        return h.digest()
+
 def fetchScripts(recipe, prefix, resolveBash = lambda x, y: x, resolvePwsh = lambda x, y: x):
     return {
         ScriptLanguage.BASH : resolveBash(recipe.get(prefix + "ScriptBash",
@@ -409,11 +489,93 @@ class CheckoutAssert:
         return self.__file + " " + self.__digestSHA1 + " " + str(self.__start) + " " + str(self.__end)
 
 
-class CoreRef:
+class InternedEnv(dict):
+    """Environment dictionary that was interned by :class:`GraphInterner`.
+
+    Such dictionaries are shared between steps and must not be modified. The
+    type is used by the :class:`PackageStore` to store them only once.
+    """
+    __slots__ = ()
+
+class GraphInterner:
+    """Share identical parts of the package graph.
+
+    Most variants of a package end up with the same environment, tools and
+    stack entries. Instead of keeping a copy for every step, identical
+    dictionaries are replaced by a single instance. All strings of interned
+    environments are interned too so that partially overlapping environments
+    still share their keys and values.
+
+    The interner is only needed while the package graph is calculated. The
+    interned objects stay valid after the interner has been dropped.
+    """
+
+    __slots__ = ('__envs', '__dicts', '__stacks')
+
+    def __init__(self):
+        self.__envs = {}
+        self.__dicts = {}
+        self.__stacks = {}
+
+    def internEnv(self, env):
+        """Return the shared instance of a detached environment dict."""
+        key = frozenset(env.items())
+        ret = self.__envs.get(key)
+        if ret is None:
+            ret = InternedEnv((sys.intern(k), sys.intern(v)) for (k, v) in env.items())
+            self.__envs[frozenset(ret.items())] = ret
+        return ret
+
+    def internDict(self, d):
+        """Return the shared instance of a dict with hashable values."""
+        key = frozenset(d.items())
+        ret = self.__dicts.get(key)
+        if ret is None:
+            ret = self.__dicts[key] = d
+        return ret
+
+    def internStack(self, name):
+        """Return the shared stack tuple of a reference to a package."""
+        ret = self.__stacks.get(name)
+        if ret is None:
+            ret = self.__stacks[name] = (sys.intern(name),)
+        return ret
+
+
+class CoreStored:
+    """Base class of all objects that are persisted by the PackageStore.
+
+    Objects that belong to a record of the store that was not loaded yet are
+    created empty. The record is loaded on first access of any attribute,
+    which fills in all objects of the record.
+    """
+
+    __slots__ = ('_storePending',)
+
+    def __getattr__(self, name):
+        # Only called if the attribute is not set. Pickle and copy probe for
+        # special methods that must not trigger loading the record.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        try:
+            (store, record) = object.__getattribute__(self, "_storePending")
+        except AttributeError:
+            raise AttributeError("'{}' object has no attribute '{}'"
+                                    .format(type(self).__name__, name)) from None
+        store._loadRecord(record)
+        try:
+            del self._storePending
+        except AttributeError:
+            pass
+        return getattr(self, name)
+
+
+class CoreRef(CoreStored):
     """Reference from one CoreStep/CorePackage to another one.
 
     The destination must always be deeper or at the same level in the graph.
-    The names that are added to the path stack are given in stackAdd. Because
+    The names that are added to the path stack are given in stackAdd as tuple
+    that is usually shared with other references. Because
     identical "core" sub-graphs can be visible to the user under different
     "real" paths we only store the difference between source and destination
     to reconstruct the real values on reference resolution.
@@ -433,7 +595,7 @@ class CoreRef:
 
     __slots__ = ('__destination', '__stackAdd', '__diffTools', '__diffSandbox')
 
-    def __init__(self, destination, stackAdd=[], diffTools={}, diffSandbox=...):
+    def __init__(self, destination, stackAdd=(), diffTools={}, diffSandbox=...):
         self.__destination = destination
         self.__stackAdd = stackAdd
         self.__diffTools = diffTools
@@ -471,16 +633,16 @@ class CoreRef:
         else:
             sandbox = self.__diffSandbox.refDeref(stack, inputTools, inputSandbox, pathFormatter, cache)
 
-        return self.__destination.refDeref(stack + self.__stackAdd, tools, sandbox, pathFormatter)
+        return self.__destination.refDeref(stack + list(self.__stackAdd), tools, sandbox, pathFormatter)
 
-class CoreItem:
+class CoreItem(CoreStored):
     __slots__ = []
 
     def refGetDestination(self):
         return self
 
     def refGetStack(self):
-        return []
+        return ()
 
     def refDeref(self, stack, inputTools, inputSandbox, pathFormatter, cache=None):
         raise NotImplementedError
@@ -729,8 +891,9 @@ class CoreStep(CoreItem):
     def __init__(self, corePackage, isValid, deterministic, digestEnv, env, args):
         self.corePackage = corePackage
         self.isValid = isValid
-        self.digestEnv = digestEnv.detach()
-        self.env = env.detach()
+        interner = corePackage.recipe.getRecipeSet()._getInterner()
+        self.digestEnv = interner.internEnv(digestEnv.detach())
+        self.env = self.digestEnv if env is digestEnv else interner.internEnv(env.detach())
         self.args = args
         self.deterministic = deterministic and all(
             arg.isDeterministic() for arg in self.getAllDepCoreSteps(True))
@@ -924,6 +1087,8 @@ class Step:
     the step. See :meth:`bob.input.Step.getVariantId` for details.
     """
 
+    __slots__ = ('_coreStep', '__package', '__pathFormatter')
+
     def __init__(self, coreStep, package, pathFormatter):
         self._coreStep = coreStep
         self.__package = package
@@ -1020,98 +1185,38 @@ class Step:
         """Get Package object that is the parent of this Step."""
         return self.__package
 
+    def _getDigestPlan(self, forceSandbox=False):
+        recipeSet = self.__package.getRecipe().getRecipeSet()
+        sandbox = self.getSandbox()
+        if self._coreStep.isFingerprinted() and sandbox and not recipeSet.sandboxFingerprints:
+            sandboxFingerprint = sandbox.getStep()
+        else:
+            sandboxFingerprint = None
+        sandbox = not recipeSet.sandboxInvariant and self.getSandbox(forceSandbox)
+        return DigestPlan(sandboxFingerprint,
+            sandbox and (sandbox.getStep(), sandbox.getPaths()),
+            self.getDigestScript(),
+            [ (tool.step, tool.path, tool.libs) for (name, tool)
+              in sorted(self.getTools().items(), key=lambda t: t[0]) ],
+            self._coreStep.digestEnv,
+            [ a for a in self.getArguments() if a.isValid() ])
+
     def getDigest(self, calculate, forceSandbox=False, hasher=DigestHasher,
                   fingerprint=None, platform=b''):
-        h = hasher()
-        h.update(platform)
-        if self._coreStep.isFingerprinted() and self.getSandbox() \
-                and not self.__package.getRecipe().getRecipeSet().sandboxFingerprints:
-            h.fingerprint(hasher.sliceRecipes(calculate(self.getSandbox().getStep())))
-        elif fingerprint:
-            h.fingerprint(fingerprint)
-        sandbox = not self.__package.getRecipe().getRecipeSet().sandboxInvariant and \
-            self.getSandbox(forceSandbox)
-        if sandbox:
-            h.update(hasher.sliceRecipes(calculate(sandbox.getStep())))
-            h.update(struct.pack("<I", len(sandbox.getPaths())))
-            for p in sandbox.getPaths():
-                h.update(struct.pack("<I", len(p)))
-                h.update(p.encode('utf8'))
-        else:
-            h.update(b'\x00' * 20)
-        script = self.getDigestScript()
-        if script:
-            h.update(struct.pack("<I", len(script)))
-            h.update(script.encode("utf8"))
-        else:
-            h.update(b'\x00\x00\x00\x00')
-        h.update(struct.pack("<I", len(self.getTools())))
-        for (name, tool) in sorted(self.getTools().items(), key=lambda t: t[0]):
-            h.update(hasher.sliceRecipes(calculate(tool.step)))
-            h.update(struct.pack("<II", len(tool.path), len(tool.libs)))
-            h.update(tool.path.encode("utf8"))
-            for l in tool.libs:
-                h.update(struct.pack("<I", len(l)))
-                h.update(l.encode('utf8'))
-        h.update(struct.pack("<I", len(self._coreStep.digestEnv)))
-        for (key, val) in sorted(self._coreStep.digestEnv.items()):
-            h.update(struct.pack("<II", len(key), len(val)))
-            h.update((key+val).encode('utf8'))
-        args = [ calculate(a) for a in self.getArguments() if a.isValid() ]
-        h.update(struct.pack("<I", len(args)))
-        for arg in args:
-            h.update(hasher.sliceRecipes(arg))
-            h.fingerprint(hasher.sliceHost(arg))
-        return h.digest()
+        plan = self._getDigestPlan(forceSandbox)
+        digests = [ calculate(dep) for dep in plan.deps ]
+        # The variant-id is already known if all dependencies yield their
+        # variant-id too.
+        if (hasher is DigestHasher) and not (forceSandbox or fingerprint or platform) and \
+           all(d == dep._coreStep.variantId for (d, dep) in zip(digests, plan.deps)):
+            return self._coreStep.variantId
+        return plan.digest(digests, hasher, fingerprint, platform)
 
     async def getDigestCoro(self, calculate, forceSandbox=False, hasher=DigestHasher,
                             fingerprint=None, platform=b''):
-        h = hasher()
-        h.update(platform)
-        if self._coreStep.isFingerprinted() and self.getSandbox() \
-                and not self.__package.getRecipe().getRecipeSet().sandboxFingerprints:
-            [d] = await calculate([self.getSandbox().getStep()])
-            h.fingerprint(hasher.sliceRecipes(d))
-        elif fingerprint:
-            h.fingerprint(fingerprint)
-        sandbox = not self.__package.getRecipe().getRecipeSet().sandboxInvariant and \
-            self.getSandbox(forceSandbox)
-        if sandbox:
-            [d] = await calculate([sandbox.getStep()])
-            h.update(hasher.sliceRecipes(d))
-            h.update(struct.pack("<I", len(sandbox.getPaths())))
-            for p in sandbox.getPaths():
-                h.update(struct.pack("<I", len(p)))
-                h.update(p.encode('utf8'))
-        else:
-            h.update(b'\x00' * 20)
-        script = self.getDigestScript()
-        if script:
-            h.update(struct.pack("<I", len(script)))
-            h.update(script.encode("utf8"))
-        else:
-            h.update(b'\x00\x00\x00\x00')
-        h.update(struct.pack("<I", len(self.getTools())))
-        tools = sorted(self.getTools().items(), key=lambda t: t[0])
-        toolsDigests = await calculate([ tool.step for name,tool in tools ])
-        for ((name, tool), d) in zip(tools, toolsDigests):
-            h.update(hasher.sliceRecipes(d))
-            h.update(struct.pack("<II", len(tool.path), len(tool.libs)))
-            h.update(tool.path.encode("utf8"))
-            for l in tool.libs:
-                h.update(struct.pack("<I", len(l)))
-                h.update(l.encode('utf8'))
-        h.update(struct.pack("<I", len(self._coreStep.digestEnv)))
-        for (key, val) in sorted(self._coreStep.digestEnv.items()):
-            h.update(struct.pack("<II", len(key), len(val)))
-            h.update((key+val).encode('utf8'))
-        args = [ a for a in self.getArguments() if a.isValid() ]
-        argsDigests = await calculate(args)
-        h.update(struct.pack("<I", len(args)))
-        for d in argsDigests:
-            h.update(hasher.sliceRecipes(d))
-            h.fingerprint(hasher.sliceHost(d))
-        return h.digest()
+        plan = self._getDigestPlan(forceSandbox)
+        digests = await calculate(plan.deps)
+        return plan.digest(digests, hasher, fingerprint, platform)
 
     def getVariantId(self):
         """Return Variant-Id of this Step.
@@ -1251,6 +1356,15 @@ class Step:
         """Returns True if the step is relocatable."""
         return False
 
+    def getResources(self):
+        """Return the resources that are needed to execute the step.
+
+        Returns a tuple of the number of job slots and the memory in MiB that
+        the step script occupies while running. Checkout steps always take a
+        single job slot.
+        """
+        return (1, 0)
+
     def _getProvidedDeps(self):
         p = self.__package
         refCache = {}
@@ -1377,6 +1491,8 @@ class CoreCheckoutStep(CoreStep):
         return 0
 
 class CheckoutStep(Step):
+    __slots__ = ()
+
     def getJenkinsXml(self, credentials, options):
         return [ s.asJenkins(self.getWorkspacePath(), credentials, options)
                  for s in self._coreStep.scmList if s.hasJenkinsPlugin() ]
@@ -1493,11 +1609,15 @@ class CoreBuildStep(CoreStep):
         return ret
 
 class BuildStep(Step):
+    __slots__ = ()
 
     def hasNetAccess(self):
         return self.getPackage().getRecipe()._getBuildNetAccess() or any(
             t.getNetAccess() for t in self.getTools().values())
 
+    def getResources(self):
+        return self.getPackage().getRecipe()._getBuildResources()
+
 
 class CorePackageStep(CoreStep):
     __slots__ = []
@@ -1535,6 +1655,7 @@ class CorePackageStep(CoreStep):
         return self.corePackage.fingerprintMask
 
 class PackageStep(Step):
+    __slots__ = ()
 
     def isShared(self):
         return self.getPackage().getRecipe().isShared()
@@ -1547,6 +1668,9 @@ class PackageStep(Step):
         return self.getPackage().getRecipe()._getPackageNetAccess() or any(
             t.getNetAccess() for t in self.getTools().values())
 
+    def getResources(self):
+        return self.getPackage().getRecipe()._getPackageResources()
+
 
 class CorePackageInternal(CoreItem):
     __slots__ = []
@@ -1555,7 +1679,7 @@ class CorePackageInternal(CoreItem):
 
 corePackageInternal = CorePackageInternal()
 
-class CorePackage:
+class CorePackage(CoreStored):
     __slots__ = ("recipe", "internalRef", "directDepSteps", "indirectDepSteps",
         "states", "tools", "sandbox", "checkoutStep", "buildStep", "packageStep",
         "pkgId", "fingerprintMask")
@@ -1565,7 +1689,7 @@ class CorePackage:
         self.recipe = recipe
         self.tools = tools
         self.sandbox = sandbox
-        self.internalRef = CoreRef(corePackageInternal, [], diffTools, diffSandbox)
+        self.internalRef = CoreRef(corePackageInternal, (), diffTools, diffSandbox)
         self.directDepSteps = directDepSteps
         self.indirectDepSteps = indirectDepSteps
         self.states = states
@@ -1614,6 +1738,10 @@ class Package(object):
     package.
     """
 
+    __slots__ = ('__corePackage', '__stack', '__pathFormatter', '__inputTools',
+        '__tools', '__inputSandbox', '__sandbox', '__checkoutStep', '__buildStep',
+        '__packageStep')
+
     def __init__(self, corePackage, stack, pathFormatter, inputTools, tools, inputSandbox, sandbox):
         self.__corePackage = corePackage
         self.__stack = stack
@@ -1848,6 +1976,10 @@ class VarDefineValidator:
 
 RECIPE_NAME_SCHEMA = schema.Regex(r'^[0-9A-Za-z_.+-]+$')
 MULTIPACKAGE_NAME_SCHEMA = schema.Regex(r'^[0-9A-Za-z_.+-]*$')
+RESOURCES_SCHEMA = schema.Schema({
+    schema.Optional('jobs') : schema.And(int, lambda n: n >= 1),
+    schema.Optional('memory') : schema.And(int, lambda n: n >= 0),
+})
 
 class UniquePackageList:
     def __init__(self, stack, errorHandler):
@@ -1864,7 +1996,8 @@ class UniquePackageList:
             self.cache[name] = ref
             self.ret.append(ref)
         elif ref2.refGetDestination().variantId != step.variantId:
-            self.errorHandler(name, self.stack + ref.refGetStack(), self.stack + ref2.refGetStack())
+            self.errorHandler(name, self.stack + list(ref.refGetStack()),
+                self.stack + list(ref2.refGetStack()))
 
     def extend(self, gen):
         for i in gen: self.append(i)
@@ -2051,7 +2184,7 @@ class Recipe(object):
             n : p(n in recipe, recipe.get(n))
             for (n, p) in properties.items()
         }
-        self.__corePackagesByMatch = []
+        self.__corePackagesByMatch = PackageMatchIndex()
         self.__corePackagesById = {}
 
         sourceName = ("Recipe " if isRecipe else "Class  ") + packageName + (
@@ -2082,6 +2215,8 @@ class Recipe(object):
 
         self.__buildNetAccess = recipe.get("buildNetAccess")
         self.__packageNetAccess = recipe.get("packageNetAccess")
+        self.__buildResources = recipe.get("buildResources")
+        self.__packageResources = recipe.get("packageResources")
 
     def __resolveClassesOrder(self, cls, stack, visited, isRecipe=False):
         # prevent cycles
@@ -2201,6 +2336,8 @@ class Recipe(object):
             self.__toolDepPackage |= cls.__toolDepPackage
             if self.__buildNetAccess is None: self.__buildNetAccess = cls.__buildNetAccess
             if self.__packageNetAccess is None: self.__packageNetAccess = cls.__packageNetAccess
+            if self.__buildResources is None: self.__buildResources = cls.__buildResources
+            if self.__packageResources is None: self.__packageResources = cls.__packageResources
             for (n, p) in self.__properties.items():
                 p.inherit(cls.__properties[n])
 
@@ -2273,14 +2410,15 @@ class Recipe(object):
     def prepare(self, inputEnv, sandboxEnabled, inputStates, inputSandbox=None,
                 inputTools=Env(), stack=[]):
         # already calculated?
-        for m in self.__corePackagesByMatch:
-            if m.matches(inputEnv.detach(), inputTools.detach(), inputStates, inputSandbox):
-                if set(stack) & m.subTreePackages:
-                    raise ParseError("Recipes are cyclic")
-                m.touch(inputEnv, inputTools)
-                if DEBUG['pkgck']:
-                    reusedCorePackage = m.corePackage
-                    break
+        m = self.__corePackagesByMatch.lookup(inputEnv, inputTools, inputStates,
+                                              inputSandbox)
+        if m is not None:
+            if set(stack) & m.subTreePackages:
+                raise ParseError("Recipes are cyclic")
+            m.touch(inputEnv, inputTools)
+            if DEBUG['pkgck']:
+                reusedCorePackage = m.corePackage
+            else:
                 return m.corePackage, m.subTreePackages
         else:
             reusedCorePackage = None
@@ -2319,6 +2457,7 @@ class Recipe(object):
         for s in states.values(): s.onEnter(env, self.__properties)
 
         # traverse dependencies
+        interner = self.__recipeSet._getInterner()
         subTreePackages = set()
         directPackages = []
         indirectPackages = []
@@ -2355,6 +2494,7 @@ class Recipe(object):
                 thisDepDiffTools = depDiffTools
 
             r = self.__recipeSet.getRecipe(dep.recipe)
+            depStackAdd = interner.internStack(r.__packageName)
             try:
                 if r.__packageName in stack:
                     raise ParseError("Recipes are cyclic (1st package in cylce)")
@@ -2365,7 +2505,7 @@ class Recipe(object):
                 subTreePackages.add(p.getName())
                 subTreePackages.update(s)
                 depCoreStep = p.getCorePackageStep()
-                depRef = CoreRef(depCoreStep, [p.getName()], thisDepDiffTools, depDiffSandbox)
+                depRef = CoreRef(depCoreStep, depStackAdd, thisDepDiffTools, depDiffSandbox)
             except ParseError as e:
                 e.pushFrame(r.getPackageName())
                 raise e
@@ -2395,25 +2535,25 @@ class Recipe(object):
                     if dep.provideGlobal: depStates[n].onUse(depCoreStep.corePackage.states[n])
             if dep.useDeps:
                 indirectPackages.extend(
-                    CoreRef(d, [p.getName()], origDepDiffTools, origDepDiffSandbox)
+                    CoreRef(d, depStackAdd, origDepDiffTools, origDepDiffSandbox)
                     for d in depCoreStep.providedDeps)
             if dep.useBuildResult and depTrack.useResultOnce():
                 results.append(depRef)
             if dep.useTools:
                 tools.update(depCoreStep.providedTools)
-                diffTools.update( (n, CoreRef(d, [p.getName()], origDepDiffTools, origDepDiffSandbox))
+                diffTools.update( (n, CoreRef(d, depStackAdd, origDepDiffTools, origDepDiffSandbox))
                     for n, d in depCoreStep.providedTools.items() )
                 if dep.provideGlobal:
                     depTools.update(depCoreStep.providedTools)
                     depDiffTools = depDiffTools.copy()
-                    depDiffTools.update( (n, CoreRef(d, [p.getName()], origDepDiffTools, origDepDiffSandbox))
+                    depDiffTools.update( (n, CoreRef(d, depStackAdd, origDepDiffTools, origDepDiffSandbox))
                         for n, d in depCoreStep.providedTools.items() )
             if dep.useEnv:
                 env.update(depCoreStep.providedEnv)
                 if dep.provideGlobal: depEnv.update(depCoreStep.providedEnv)
             if dep.useSandbox and (depCoreStep.providedSandbox is not None):
                 sandbox = depCoreStep.providedSandbox
-                diffSandbox = CoreRef(depCoreStep.providedSandbox, [p.getName()], origDepDiffTools,
+                diffSandbox = CoreRef(depCoreStep.providedSandbox, depStackAdd, origDepDiffTools,
                     origDepDiffSandbox)
                 if dep.provideGlobal:
                     depSandbox = sandbox
@@ -2423,7 +2563,7 @@ class Recipe(object):
                     if dep.provideGlobal: depEnv.update(sandbox.environment)
             if dep.recipe in self.__provideDeps:
                 provideDeps.append(depRef)
-                provideDeps.extend(CoreRef(d, [p.getName()], origDepDiffTools, origDepDiffSandbox)
+                provideDeps.extend(CoreRef(d, depStackAdd, origDepDiffTools, origDepDiffSandbox)
                     for d in depCoreStep.providedDeps)
 
         # Filter indirect packages and add to result list if necessary. Most
@@ -2441,8 +2581,8 @@ class Recipe(object):
                 indirectPackages.append(depRef)
             elif depCoreStep.variantId != depTrack.item.refGetDestination().variantId:
                 self.__raiseIncompatibleProvided(name,
-                    stack + depRef.refGetStack(),
-                    stack + depTrack.item.refGetStack())
+                    stack + list(depRef.refGetStack()),
+                    stack + list(depTrack.item.refGetStack()))
 
             if depTrack.useResultOnce():
                 results.append(depRef)
@@ -2504,7 +2644,8 @@ class Recipe(object):
         # create package
         # touchedTools = tools.touchedKeys()
         # diffTools = { n : t for n,t in diffTools.items() if n in touchedTools }
-        p = CorePackage(self, tools.detach(), diffTools, sandbox, diffSandbox,
+        p = CorePackage(self, interner.internDict(tools.detach()),
+                interner.internDict(diffTools), sandbox, diffSandbox,
                 directPackages, indirectPackages, states, uidGen(), doFingerprint)
 
         # optional checkout step
@@ -2538,7 +2679,7 @@ class Recipe(object):
         provideEnv = {}
         for (key, value) in self.__provideVars.items():
             provideEnv[key] = env.substitute(value, "provideVars::"+key)
-        packageCoreStep.providedEnv = provideEnv
+        packageCoreStep.providedEnv = interner.internEnv(provideEnv)
 
         # provide tools
         packageCoreStep.providedTools = { name : tool.prepare(packageCoreStep, env)
@@ -2565,7 +2706,7 @@ class Recipe(object):
             reusableCorePackage = self.__corePackagesById.setdefault(pid, p)
             if reusableCorePackage is not p:
                 p = reusableCorePackage
-            self.__corePackagesByMatch.insert(0, PackageMatcher(
+            self.__corePackagesByMatch.add(PackageMatcher(
                 reusableCorePackage, inputEnv, inputTools, inputStates,
                 inputSandbox, subTreePackages))
         elif packageCoreStep.getResultId() != reusedCorePackage.getCorePackageStep().getResultId():
@@ -2588,6 +2729,19 @@ class Recipe(object):
         else:
             return self.__packageNetAccess
 
+    @staticmethod
+    def __getResources(resources):
+        if resources is None:
+            return (1, 0)
+        else:
+            return (resources.get("jobs", 1), resources.get("memory", 0))
+
+    def _getBuildResources(self):
+        return Recipe.__getResources(self.__buildResources)
+
+    def _getPackageResources(self):
+        return Recipe.__getResources(self.__packageResources)
+
     def __raiseIncompatibleProvided(self, name, stack1, stack2):
         raise ParseError("Incompatible variants of package: {} vs. {}"
             .format("/".join(stack1), "/".join(stack2)),
@@ -2687,6 +2841,15 @@ class PackageMatcher:
         self.sandbox = sandbox.resultId if sandbox is not None else None
         self.subTreePackages = subTreePackages
 
+        # Pre-compute the index key. The "shape" is the set of environment
+        # variables and tools that the package has looked at. Packages with
+        # the same shape can be found by hashing the respective values.
+        self.envKeys = tuple(sorted(self.env.keys()))
+        self.toolKeys = tuple(sorted(self.tools.keys()))
+        self.key = (tuple(self.env[k] for k in self.envKeys),
+                    tuple(self.tools[k] for k in self.toolKeys),
+                    self.sandbox)
+
     def matches(self, inputEnv, inputTools, inputStates, inputSandbox):
         for (name, env) in self.env.items():
             if env != inputEnv.get(name): return False
@@ -2704,22 +2867,69 @@ class PackageMatcher:
         inputTools.touch(self.tools.keys())
 
 
+class PackageMatchIndex:
+    """Hashed index of the already calculated packages of a recipe.
+
+    The matchers are grouped by their shape, i.e. the names of the environment
+    variables and tools that were touched while calculating the package. For
+    each shape the values of the input environment, tools and sandbox are
+    hashed so that a lookup is a dictionary access per shape instead of
+    comparing every known variant. Plugin states are not hashable and are
+    compared only for the matchers in the same bucket.
+    """
+
+    __slots__ = ('__shapes',)
+
+    def __init__(self):
+        self.__shapes = {}
+
+    def __len__(self):
+        return sum(len(bucket) for shape in self.__shapes.values()
+                               for bucket in shape.values())
+
+    def add(self, matcher):
+        shape = self.__shapes.setdefault((matcher.envKeys, matcher.toolKeys), {})
+        shape.setdefault(matcher.key, []).insert(0, matcher)
+
+    def lookup(self, inputEnv, inputTools, inputStates, inputSandbox):
+        envData = inputEnv.inspect()
+        toolsData = inputTools.inspect()
+        sandbox = inputSandbox.resultId if inputSandbox is not None else None
+        for ((envKeys, toolKeys), shape) in self.__shapes.items():
+            key = (tuple(envData.get(k) for k in envKeys),
+                   tuple((t.resultId if t is not None else None)
+                         for t in (toolsData.get(k) for k in toolKeys)),
+                   sandbox)
+            for m in shape.get(key, []):
+                if m.states == inputStates: return m
+        return None
+
+
 class ArchiveValidator:
     def __init__(self):
-        self.__validTypes = schema.Schema({'backend': schema.Or('none', 'file', 'http', 'shell', 'azure')},
+        self.__validTypes = schema.Schema({'backend': schema.Or('none', 'file', 'cas', 'http', 'shell', 'azure')},
             ignore_extra_keys=True)
         baseArchive = {
             'backend' : str,
             schema.Optional('flags') : schema.Schema(["download", "upload",
-                "nofail", "nolocal", "nojenkins"])
+                "nofail", "nolocal", "nojenkins"]),
+            schema.Optional('compression') : schema.Or("gzip", "zstd", "lz4"),
+            schema.Optional('compressionLevel') : int,
+            schema.Optional('auditSidecar') : bool,
         }
         fileArchive = baseArchive.copy()
         fileArchive["path"] = str
         fileArchive[schema.Optional("fileMode")] = int
         fileArchive[schema.Optional("directoryMode")] = int
+        casArchive = fileArchive.copy()
+        casArchive[schema.Optional("cache")] = str
+        casArchive[schema.Optional("cacheQuota")] = schema.And(int, lambda n: n >= 1,
+            error="cacheQuota: must be a positive number")
         httpArchive = baseArchive.copy()
         httpArchive["url"] = str
         httpArchive[schema.Optional("sslVerify")] = bool
+        httpArchive[schema.Optional("connections")] = schema.And(int, lambda n: n >= 1,
+            error="connections: must be a positive number")
         shellArchive = baseArchive.copy()
         shellArchive.update({
             schema.Optional('download') : str,
@@ -2735,6 +2945,7 @@ class ArchiveValidator:
         self.__backends = {
             'none' : schema.Schema(baseArchive),
             'file' : schema.Schema(fileArchive),
+            'cas' : schema.Schema(casArchive),
             'http' : schema.Schema(httpArchive),
             'shell' : schema.Schema(shellArchive),
             'azure' : schema.Schema(azureArchive),
@@ -2788,6 +2999,11 @@ class RecipeSet:
             schema.Optional('always_checkout') : [str],
             schema.Optional('jobs') : int,
             schema.Optional('audit') : bool,
+            schema.Optional('watch_workspaces') : bool,
+            schema.Optional('memory') : schema.And(int, lambda n: n >= 1),
+            schema.Optional('checkout_jobs') : schema.And(int, lambda n: n >= 1),
+            schema.Optional('download_jobs') : schema.And(int, lambda n: n >= 1),
+            schema.Optional('fingerprint_jobs') : schema.And(int, lambda n: n >= 1),
         })
 
     GRAPH_SCHEMA = schema.Schema(
@@ -2848,12 +3064,14 @@ class RecipeSet:
         else:
             self.__whiteList = set(["PATH", "TERM", "SHELL", "USER", "HOME"])
         self.__archive = { "backend" : "none" }
+        self.__archiveCache = None
         self.__rootFilter = []
         self.__scmOverrides = []
         self.__hooks = {}
         self.__projectGenerators = {}
         self.__configFiles = []
         self.__properties = {}
+        self.__interner = GraphInterner()
         self.__states = {}
         self.__cache = YamlCache()
         self.__stringFunctions = DEFAULT_STRING_FUNS.copy()
@@ -2921,6 +3139,7 @@ class RecipeSet:
         self.__sandboxOpts = {}
 
         def updateArchive(x): self.__archive = x
+        def updateArchiveCache(x): self.__archiveCache = x
 
         if sys.platform == "win32":
             # Convert to upper case on Windows. The Python interpreter does that
@@ -2943,6 +3162,15 @@ class RecipeSet:
                 ),
                 updateArchive
             ),
+            "archiveCache" : BuiltinSetting(
+                schema.Schema({
+                    'path' : str,
+                    schema.Optional('quota') : schema.And(int, lambda n: n >= 1),
+                    schema.Optional('compression') : schema.Or("gzip", "zstd", "lz4"),
+                    schema.Optional('compressionLevel') : int,
+                }),
+                updateArchiveCache
+            ),
             "command" : BuiltinSetting(
                 schema.Schema({
                     schema.Optional('dev') : self.BUILD_DEV_SCHEMA,
@@ -3150,6 +3378,9 @@ class RecipeSet:
     def archiveSpec(self):
         return self.__archive
 
+    def archiveCacheSpec(self):
+        return self.__archiveCache
+
     def defaultEnv(self):
         return self.__defaultEnv
 
@@ -3410,6 +3641,8 @@ class RecipeSet:
             schema.Optional('relocatable') : bool,
             schema.Optional('buildNetAccess') : bool,
             schema.Optional('packageNetAccess') : bool,
+            schema.Optional('buildResources') : RESOURCES_SCHEMA,
+            schema.Optional('packageResources') : RESOURCES_SCHEMA,
             schema.Optional('fingerprintScript', default="") : str,
             schema.Optional('fingerprintScriptBash') : str,
             schema.Optional('fingerprintScriptPwsh', default="") : str,
@@ -3439,6 +3672,9 @@ class RecipeSet:
         self.__userConfigSchema = schema.Schema(userConfigSchemaSpec)
 
 
+    def _getInterner(self):
+        return self.__interner
+
     def getRecipe(self, packageName):
         if packageName not in self.__recipes:
             raise ParseError("Package {} requested but not found.".format(packageName))
@@ -3483,25 +3719,25 @@ class RecipeSet:
 
         # try to load the persisted packages
         try:
-            with open(cacheName, "rb") as f:
-                persistedCacheKey = f.read(len(cacheKey))
-                if cacheKey == persistedCacheKey:
-                    tmp = PackageUnpickler(f, self.getRecipe, self.__plugins,
-                                           nameFormatter).load()
-                    return tmp.refDeref([], {}, None, nameFormatter)
-        except (EOFError, OSError, pickle.UnpicklingError):
+            tmp = PackageStore.load(cacheName, cacheKey, self.getRecipe,
+                                    self.__plugins, nameFormatter)
+            if tmp is not None:
+                return tmp.refDeref([], {}, None, nameFormatter)
+        except (EOFError, OSError, ValueError, struct.error, pickle.UnpicklingError):
             pass
 
         # not cached -> calculate packages
         states = { n:s() for (n,s) in self.__states.items() }
-        result = self.__rootRecipe.prepare(env, sandboxEnabled, states)[0]
+        try:
+            result = self.__rootRecipe.prepare(env, sandboxEnabled, states)[0]
+        finally:
+            # The lookup tables are not needed anymore
+            self.__interner = GraphInterner()
 
         # save package tree for next invocation
         try:
             newCacheName = cacheName + ".new"
-            with open(newCacheName, "wb") as f:
-                f.write(cacheKey)
-                PackagePickler(f, nameFormatter).dump(result)
+            PackageStore.save(newCacheName, cacheKey, result, nameFormatter)
             os.replace(newCacheName, cacheName)
         except OSError as e:
             print("Error saving internal state:", str(e), file=sys.stderr)
@@ -3559,17 +3795,56 @@ class YamlCache:
                 # Bob was changed or new workspace -> purge cache
                 self.__cur.execute("INSERT OR REPLACE INTO meta VALUES ('vsn', ?)", (BOB_INPUT_HASH,))
                 self.__cur.execute("DELETE FROM yaml")
-                self.__hot = False
+                self.__cached = {}
+                self.__stale = []
             else:
-                # This could work
-                self.__hot = True
+                # This could work. Load all entries at once and keep the ones
+                # whose files are unchanged. The data is unpickled on demand.
+                self.__stale = []
+                self.__cur.execute("SELECT name, stat, digest, data FROM yaml")
+                self.__cached = self.__validate(self.__cur.fetchall())
         except sqlite3.Error as e:
             raise ParseError("Cannot access cache: " + str(e),
                 help="You probably executed Bob concurrently in the same workspace. Try again later.")
         self.__files = {}
+        self.__updated = []
+
+    @staticmethod
+    def __stat(name):
+        try:
+            return binStat(name)
+        except OSError:
+            return None
+
+    def __validate(self, rows):
+        """Stat all cached files and return the still valid entries.
+
+        Large projects have thousands of recipes and classes. Stat them
+        concurrently to hide the latency of cold or networked file systems.
+        """
+        names = [ row[0] for row in rows ]
+        if len(names) >= 64:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                stats = list(executor.map(YamlCache.__stat, names, chunksize=64))
+        else:
+            stats = [ YamlCache.__stat(name) for name in names ]
+
+        ret = {}
+        for ((name, bs, digest, data), newBs) in zip(rows, stats):
+            if bs == newBs:
+                ret[name] = (bs, digest, data)
+            elif newBs is None:
+                self.__stale.append((name,))
+        return ret
 
     def close(self):
         try:
+            if self.__stale:
+                self.__cur.executemany("DELETE FROM yaml WHERE name=?", self.__stale)
+            if self.__updated:
+                self.__cur.executemany("INSERT OR REPLACE INTO yaml VALUES (?, ?, ?, ?)",
+                    self.__updated)
             self.__cur.execute("END")
             self.__cur.close()
             self.__con.close()
@@ -3582,21 +3857,21 @@ class YamlCache:
             h.update(name.encode('utf8'))
             h.update(data)
         self.__digest = h.digest()
+        self.__cached = {}
+        self.__stale = []
+        self.__updated = []
 
     def getDigest(self):
         return self.__digest
 
     def loadYaml(self, name, yamlSchema, default):
+        cached = self.__cached.get(name)
+        if cached is not None:
+            self.__files[name] = cached[1]
+            return pickle.loads(cached[2])
+
         try:
             bs = binStat(name)
-            if self.__hot:
-                self.__cur.execute("SELECT digest, data FROM yaml WHERE name=? AND stat=?",
-                                    (name, bs))
-                cached = self.__cur.fetchone()
-                if cached is not None:
-                    self.__files[name] = cached[0]
-                    return pickle.loads(cached[1])
-
             with open(name, "r", encoding='utf8') as f:
                 try:
                     rawData = f.read()
@@ -3604,22 +3879,18 @@ class YamlCache:
                     digest = hashlib.sha1(rawData.encode('utf8')).digest()
                 except Exception as e:
                     raise ParseError("Error while parsing {}: {}".format(name, str(e)))
-
-            if data is None: data = default
-            try:
-                data = yamlSchema.validate(data)
-            except schema.SchemaError as e:
-                raise ParseError("Error while validating {}: {}".format(name, str(e)))
-
-            self.__files[name] = digest
-            self.__cur.execute("INSERT OR REPLACE INTO yaml VALUES (?, ?, ?, ?)",
-                (name, bs, digest, pickle.dumps(data)))
-        except sqlite3.Error as e:
-            raise ParseError("Cannot access cache: " + str(e),
-                help="You probably executed Bob concurrently in the same workspace. Try again later.")
         except OSError as e:
             raise ParseError("Error loading yaml file: " + str(e))
 
+        if data is None: data = default
+        try:
+            data = yamlSchema.validate(data)
+        except schema.SchemaError as e:
+            raise ParseError("Error while validating {}: {}".format(name, str(e)))
+
+        self.__files[name] = digest
+        self.__updated.append((name, bs, digest, pickle.dumps(data)))
+
         return data
 
     def loadBinary(self, name):
@@ -3664,3 +3935,242 @@ class PackageUnpickler(pickle.Unpickler):
         else:
             return super().find_class(module, name)
 
+
+class PackageStorePickler(PackagePickler):
+    """Pickle one record of the package store.
+
+    Objects that belong to other records are replaced by references. Objects
+    of the record itself are restored through the store so that placeholders
+    that were handed out before are filled in.
+    """
+
+    def __init__(self, file, pathFormatter, store, record, exports):
+        super().__init__(file, pathFormatter)
+        self.__store = store
+        self.__record = record
+        self.__exports = exports
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        for cls in PackageStore.CLASSES:
+            self.dispatch_table[cls] = self.__reduceStored
+
+    PLAIN_TYPES = frozenset([str, bytes, int, float, bool, type(None), tuple,
+                             list, dict, set, frozenset])
+
+    def persistent_id(self, obj):
+        # This is called for every object. Bail out early for the most
+        # common types.
+        if type(obj) in PackageStorePickler.PLAIN_TYPES: return None
+        if obj is self.__store: return ("store", None)
+        ret = super().persistent_id(obj)
+        if ret is None:
+            ret = self.__store._getReference(obj, self.__record, self.__exports)
+        return ret
+
+    def __reduceStored(self, obj):
+        ret = obj.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+        pid = self.__store._getOwnReference(obj, self.__record)
+        if pid is None:
+            return ret
+        else:
+            return (_restoreStored, (self.__store, pid), ret[2])
+
+def _restoreStored(store, pid):
+    return store._restore(pid)
+
+class PackageStoreUnpickler(PackageUnpickler):
+    def __init__(self, file, recipeGetter, plugins, pathFormatter, store):
+        super().__init__(file, recipeGetter, plugins, pathFormatter)
+        self.__store = store
+
+    def persistent_load(self, pid):
+        if pid[0] in ("pkg", "step", "obj", "env"):
+            return self.__store._getObject(pid)
+        elif pid[0] == "store":
+            return self.__store
+        else:
+            return super().persistent_load(pid)
+
+    def find_class(self, module, name):
+        # Every record is a separate pickle. Cache the lookups across them.
+        classes = self.__store._classes
+        ret = classes.get((module, name))
+        if ret is None:
+            ret = classes[(module, name)] = super().find_class(module, name)
+        return ret
+
+class PackageStore:
+    """Paged store of the calculated package graph.
+
+    Each CorePackage is pickled separately together with its steps. Every
+    other object belongs to the first record where it was encountered.
+    References to objects in other records are stored by (record, index).
+    When loading, such references are resolved to empty objects of the right
+    class that are filled in when their record is loaded (see CoreStored).
+    Loading a package therefore only loads the records of the packages that
+    are actually visited. Interned environments are shared by many records.
+    They are kept in a separate table that is loaded on first use.
+
+    File layout: cache key, offset of the index, records, environment table,
+    pickled index of (offset, length) tuples of the records and the table. The
+    root package is always the first record.
+    """
+
+    STEPS = ("checkoutStep", "buildStep", "packageStep")
+    CLASSES = ()    # filled in below
+
+    def __init__(self):
+        self.__records = []
+        self.__recordIds = {}
+        self.__owners = {}
+        self.__envs = {}
+        self.__loaded = {}
+        self.__objects = {}
+        self.__data = None
+        self._classes = {}
+
+    # saving
+
+    def _getReference(self, obj, record, exports):
+        if isinstance(obj, CorePackage):
+            if obj is self.__records[record]: return None
+            return ("pkg", self.__getRecordId(obj))
+        elif isinstance(obj, CoreStep):
+            pkg = obj.corePackage
+            if pkg is self.__records[record]: return None
+            for name in PackageStore.STEPS:
+                if getattr(pkg, name, None) is obj: break
+            else:
+                return None
+            return ("step", self.__getRecordId(pkg), name, type(obj))
+        elif isinstance(obj, InternedEnv):
+            ret = self.__envs.get(id(obj))
+            if ret is None:
+                ret = self.__envs[id(obj)] = (len(self.__envs), obj)
+            return ("env", ret[0])
+        elif isinstance(obj, (CoreRef, CoreTool, CoreSandbox)):
+            owner = self.__owners.get(id(obj))
+            if owner is None:
+                self.__owners[id(obj)] = (record, len(exports), obj)
+                exports.append(obj)
+                return None
+            elif owner[0] == record:
+                return None
+            else:
+                return ("obj", owner[0], owner[1], type(obj))
+        else:
+            return None
+
+    def _getOwnReference(self, obj, record):
+        """Get reference of an object that belongs to the given record."""
+        if isinstance(obj, CorePackage):
+            return ("pkg", record)
+        elif isinstance(obj, CoreStep):
+            for name in PackageStore.STEPS:
+                if getattr(obj.corePackage, name, None) is obj:
+                    return ("step", record, name, type(obj))
+            return None
+        else:
+            owner = self.__owners.get(id(obj))
+            return ("obj", record, owner[1], type(obj)) if owner is not None else None
+
+    def __getRecordId(self, pkg):
+        ret = self.__recordIds.get(id(pkg))
+        if ret is None:
+            ret = self.__recordIds[id(pkg)] = len(self.__records)
+            self.__records.append(pkg)
+        return ret
+
+    @classmethod
+    def save(cls, fileName, cacheKey, root, pathFormatter):
+        self = cls()
+        self.__getRecordId(root)
+        index = []
+        with open(fileName, "wb") as f:
+            f.write(cacheKey)
+            f.write(struct.pack("<Q", 0))
+            i = 0
+            while i < len(self.__records):
+                start = f.tell()
+                exports = []
+                PackageStorePickler(f, pathFormatter, self, i, exports).dump(
+                    (self.__records[i], exports))
+                index.append((start, f.tell() - start))
+                i += 1
+            start = f.tell()
+            pickle.dump([ dict(env) for (_, env) in sorted(self.__envs.values(),
+                                                          key=lambda e: e[0]) ],
+                        f, -1)
+            envTable = (start, f.tell() - start)
+            indexPos = f.tell()
+            pickle.dump((index, envTable), f, -1)
+            f.seek(len(cacheKey))
+            f.write(struct.pack("<Q", indexPos))
+
+    # loading
+
+    @classmethod
+    def load(cls, fileName, cacheKey, recipeGetter, plugins, pathFormatter):
+        """Load the root package. Returns None if the store does not match."""
+        self = cls()
+        with open(fileName, "rb") as f:
+            if f.read(len(cacheKey)) != cacheKey: return None
+            if sys.platform == "win32":
+                # A mapped file could not be replaced by other invocations.
+                self.__data = f.read()
+            else:
+                import mmap
+                self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (indexPos,) = struct.unpack_from("<Q", self.__data, len(cacheKey))
+            (self.__index, self.__envTable) = pickle.loads(self.__data[indexPos:])
+            self.__unpickler = lambda data: PackageStoreUnpickler(io.BytesIO(data),
+                recipeGetter, plugins, pathFormatter, self).load()
+            return self._loadRecord(0)[0]
+        except:
+            self.__close()
+            raise
+
+    def __close(self):
+        if self.__data is not None:
+            if not isinstance(self.__data, bytes): self.__data.close()
+            self.__data = None
+            self.__unpickler = None
+
+    def _loadRecord(self, record):
+        if record not in self.__loaded:
+            # Objects of the record that are created while it is unpickled
+            # must not become placeholders.
+            self.__loaded[record] = None
+            (offset, length) = self.__index[record]
+            self.__loaded[record] = self.__unpickler(self.__data[offset:offset+length])
+            if len(self.__loaded) == len(self.__index):
+                self.__close()
+        return self.__loaded[record]
+
+    def _getObject(self, pid):
+        if pid[0] == "env":
+            envs = self.__envs
+            if not envs:
+                (offset, length) = self.__envTable
+                envs = self.__envs = pickle.loads(self.__data[offset:offset+length])
+            return envs[pid[1]]
+
+        key = pid[:3]
+        ret = self.__objects.get(key)
+        if ret is None:
+            cls = CorePackage if pid[0] == "pkg" else pid[3]
+            ret = self.__objects[key] = cls.__new__(cls)
+            if pid[1] not in self.__loaded:
+                ret._storePending = (self, pid[1])
+        return ret
+
+    def _restore(self, pid):
+        ret = self._getObject(pid)
+        try:
+            del ret._storePending
+        except AttributeError:
+            pass
+        return ret
+
+PackageStore.CLASSES = (CorePackage, CoreCheckoutStep, CoreBuildStep,
+                        CorePackageStep, CoreRef, CoreTool, CoreSandbox)
@@ -4,7 +4,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from . import BOB_VERSION, _enableDebug, DEBUG
-from .errors import BobError
+from .errors import BobError, BuildError
 from .state import finalize
 from .tty import colorize, Unbuffered, setColorMode, cleanup
 from .utils import asHexStr, hashPath, getPlatformTag, EventLoopWrapper
@@ -296,15 +296,31 @@ def auditEngine():
     parser.add_argument("--scm", action="append", default=[], nargs=3) # legacy Bob <= 0.15
     parser.add_argument("--scmEx", action="append", default=[], nargs=4)
     parser.add_argument("--tool", action="append", default=[], nargs=2)
-    parser.add_argument("variantID")
-    parser.add_argument("buildID")
-    parser.add_argument("resultHash")
+    parser.add_argument("--export", metavar="AUDIT",
+        help="Convert existing audit trail to the self-contained format")
+    parser.add_argument("variantID", nargs='?')
+    parser.add_argument("buildID", nargs='?')
+    parser.add_argument("resultHash", nargs='?')
     args = parser.parse_args()
+    if args.export is None and args.resultHash is None:
+        parser.error("the following arguments are required: variantID, buildID, resultHash")
 
     def cmd(loop):
-        from .audit import Audit
+        from .audit import Audit, exportAudit
         import json
         import os
+        if args.export is not None:
+            try:
+                data = exportAudit(args.export)
+                if args.output == "-":
+                    sys.stdout.buffer.write(data)
+                else:
+                    with open(args.output, "wb") as f:
+                        f.write(data)
+            except OSError as e:
+                raise BuildError("Cannot export audit: " + str(e))
+            return 0
+
         try:
             gen = Audit.create(bytes.fromhex(args.variantID), bytes.fromhex(args.buildID),
                 bytes.fromhex(args.resultHash))
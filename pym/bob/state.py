@@ -27,26 +27,35 @@ class _BobState():
     #  5 -> 6: build state stores predicted live-build-ids too
     #  6 -> 7: amended directory state for source steps, store attic directories
     #  7 -> 8: normalize attic directories
+    #  8 -> 9: state moved to SQLite database with one row per key
     MIN_VERSION = 2
-    CUR_VERSION = 8
+    CUR_VERSION = 9
 
     VERSION_SINCE_ATTIC_TRACKED = 7
 
+    # Namespaces of the persisted state. Each key of the respective
+    # dictionary is stored as a separate row in the database.
+    NAMESPACES = ("byNameDirs", "results", "inputs", "jenkins", "dirStates",
+                  "buildState", "variantIds", "atticDirs", "timings")
+
     instance = None
     def __init__(self):
-        self.__path = ".bob-state.pickle"
+        self.__path = ".bob-state.sqlite3"
+        self.__legacyPath = ".bob-state.pickle"
         self.__byNameDirs = {}
         self.__results = {}
         self.__inputs = {}
         self.__jenkins = {}
         self.__asynchronous = 0
-        self.__dirty = False
+        self.__dirty = set()
         self.__dirStates = {}
         self.__buildState = {}
         self.__lock = None
+        self.__db = None
         self.__buildIdCache = None
         self.__variantIds = {}
         self.__atticDirs = {}
+        self.__timings = {}
         self.__createdWithVersion = self.CUR_VERSION
 
         # lock state
@@ -68,20 +77,27 @@ class _BobState():
         # load state if it exists
         try:
             if os.path.exists(self.__path):
-                try:
-                    with open(self.__path, 'rb') as f:
-                        state = pickle.load(f)
-                except OSError as e:
-                    raise ParseError("Error loading workspace state: " + str(e))
-                except pickle.PickleError as e:
-                    raise ParseError("Error decoding workspace state: " + str(e))
+                self.__openDb()
+                state = self.__loadDb()
+            elif os.path.exists(self.__legacyPath):
+                state = self.__loadPickle()
+            else:
+                state = None
 
+            if state is not None:
                 if state["version"] < _BobState.MIN_VERSION:
                     raise ParseError("This version of Bob cannot read the workspace anymore. Sorry. :-(",
                                      help="This workspace was created by an older version of Bob that is no longer supported.")
                 if state["version"] > _BobState.CUR_VERSION:
                     raise ParseError("This version of Bob is too old for the workspace.",
                                      help="A more recent version of Bob was previously used in this workspace. You have to use that version instead.")
+                if "byNameDirs" not in state:
+                    # Only the stub of a migrated workspace is left over
+                    raise ParseError("Workspace state database '{}' is missing!".format(self.__path),
+                        help="The workspace state was migrated to '{}' by a previous Bob run "
+                             "but the database was deleted since. Remove '{}' to start "
+                             "over with an empty workspace state."
+                                .format(self.__path, self.__legacyPath))
                 self.__byNameDirs = state["byNameDirs"]
                 self.__results = state["results"]
                 self.__inputs = state["inputs"]
@@ -90,6 +106,7 @@ class _BobState():
                 self.__buildState = state.get("buildState", {})
                 self.__variantIds = state.get("variantIds", {})
                 self.__atticDirs = state.get("atticDirs", {})
+                self.__timings = state.get("timings", {})
                 self.__createdWithVersion = state.get("createdWithVersion", 0)
 
                 # version upgrades
@@ -116,36 +133,122 @@ class _BobState():
                 if state["version"] <= 7:
                     self.__atticDirs = { os.path.normpath(k) : v
                         for k, v in self.__atticDirs.items() }
+                if state["version"] <= 8:
+                    self.__migrate()
         except:
             self.finalize()
             raise
 
-    def __save(self):
-        if self.__asynchronous == 0:
-            state = {
-                "version" : _BobState.CUR_VERSION,
-                "byNameDirs" : self.__byNameDirs,
-                "results" : self.__results,
-                "inputs" : self.__inputs,
-                "jenkins" : self.__jenkins,
-                "dirStates" : self.__dirStates,
-                "buildState" : self.__buildState,
-                "variantIds" : self.__variantIds,
-                "atticDirs" : self.__atticDirs,
-                "createdWithVersion" : self.__createdWithVersion,
-            }
-            tmpFile = self.__path+".new"
+    def __tables(self):
+        return {
+            "byNameDirs" : self.__byNameDirs,
+            "results" : self.__results,
+            "inputs" : self.__inputs,
+            "jenkins" : self.__jenkins,
+            "dirStates" : self.__dirStates,
+            "buildState" : self.__buildState,
+            "variantIds" : self.__variantIds,
+            "atticDirs" : self.__atticDirs,
+            "timings" : self.__timings,
+        }
+
+    def __openDb(self):
+        if self.__db is not None: return
+        try:
+            self.__db = sqlite3.connect(self.__path, isolation_level=None).cursor()
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value)")
+            self.__db.execute("""CREATE TABLE IF NOT EXISTS state(
+                ns TEXT, key TEXT, value BLOB,
+                PRIMARY KEY(ns, key))""")
+        except sqlite3.Error as e:
+            self.__db = None
+            raise ParseError("Cannot open workspace state: " + str(e))
+
+    def __loadDb(self):
+        try:
+            self.__db.execute("SELECT key, value FROM meta")
+            meta = dict(self.__db.fetchall())
+            state = { ns : {} for ns in self.NAMESPACES }
+            state["version"] = meta.get("version", self.CUR_VERSION)
+            state["createdWithVersion"] = meta.get("createdWithVersion", 0)
+            self.__db.execute("SELECT ns, key, value FROM state")
+            for (ns, key, value) in self.__db:
+                if ns in state:
+                    state[ns][key] = pickle.loads(value)
+            return state
+        except sqlite3.Error as e:
+            raise ParseError("Error loading workspace state: " + str(e))
+        except pickle.PickleError as e:
+            raise ParseError("Error decoding workspace state: " + str(e))
+
+    def __loadPickle(self):
+        try:
+            with open(self.__legacyPath, 'rb') as f:
+                return pickle.load(f)
+        except OSError as e:
+            raise ParseError("Error loading workspace state: " + str(e))
+        except pickle.PickleError as e:
+            raise ParseError("Error decoding workspace state: " + str(e))
+
+    def __migrate(self):
+        """Convert legacy pickle based state into the database.
+
+        The old pickle file is replaced by a stub with the current version
+        number. Older Bob versions will thus refuse to work in the workspace
+        instead of silently starting with an empty state.
+        """
+        self.__openDb()
+        self.__dirty = set((ns, key) for (ns, table) in self.__tables().items()
+                                     for key in table.keys())
+        self.__save()
+        tmpFile = self.__legacyPath+".new"
+        try:
+            with open(tmpFile, "wb") as f:
+                pickle.dump({ "version" : _BobState.CUR_VERSION }, f)
+            os.replace(tmpFile, self.__legacyPath)
+        except OSError as e:
+            raise ParseError("Error saving workspace state: " + str(e))
+
+    def __save(self, *keys):
+        """Persist the given (namespace, key) tuples.
+
+        Only the changed keys are written. In asynchronous mode the changes
+        are collected and committed as one transaction when switching back
+        to synchronous mode.
+        """
+        self.__dirty.update(keys)
+        if self.__asynchronous == 0 and self.__dirty:
+            self.__openDb()
+            tables = self.__tables()
             try:
-                with open(tmpFile, "wb") as f:
-                    pickle.dump(state, f)
-                    f.flush()
-                    os.fsync(f.fileno())
-                os.replace(tmpFile, self.__path)
-            except OSError as e:
+                self.__db.execute("BEGIN")
+                try:
+                    self.__db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        [ ("version", _BobState.CUR_VERSION),
+                          ("createdWithVersion", self.__createdWithVersion) ])
+                    for (ns, key) in self.__dirty:
+                        table = tables[ns]
+                        if key in table:
+                            self.__db.execute("INSERT OR REPLACE INTO state VALUES (?, ?, ?)",
+                                (ns, key, pickle.dumps(table[key])))
+                        else:
+                            self.__db.execute("DELETE FROM state WHERE ns=? AND key=?",
+                                (ns, key))
+                    self.__db.execute("END")
+                except:
+                    # Do not leave the connection in the middle of a
+                    # transaction. The keys stay dirty and are written again
+                    # with the next save.
+                    if self.__db.connection.in_transaction:
+                        try:
+                            self.__db.execute("ROLLBACK")
+                        except sqlite3.Error:
+                            pass
+                    raise
+            except sqlite3.Error as e:
                 raise ParseError("Error saving workspace state: " + str(e))
-            self.__dirty = False
-        else:
-            self.__dirty = True
+            self.__dirty = set()
 
     def __openBIdCache(self):
         if self.__buildIdCache is None:
@@ -159,6 +262,16 @@ class _BobState():
 
     def finalize(self):
         assert (self.__asynchronous == 0) and not self.__dirty
+        if self.__db is not None:
+            try:
+                self.__db.close()
+                self.__db.connection.close()
+            except sqlite3.Error as e:
+                from .tty import colorize
+                from sys import stderr
+                print(colorize("Warning: cannot close workspace state: "+str(e), "33"),
+                    file=stderr)
+            self.__db = None
         if self.__buildIdCache is not None:
             try:
                 self.__buildIdCache.execute("END")
@@ -188,7 +301,7 @@ class _BobState():
     def setSynchronous(self):
         self.__asynchronous -= 1
         assert self.__asynchronous >= 0
-        if (self.__asynchronous == 0) and self.__dirty:
+        if self.__asynchronous == 0:
             self.__save()
 
     def getByNameDirectory(self, baseDir, digest, isSourceDir):
@@ -199,7 +312,7 @@ class _BobState():
             res = "{}/{}".format(baseDir, num)
             self.__byNameDirs[baseDir] = num
             self.__byNameDirs[digest] = (res, isSourceDir)
-            self.__save()
+            self.__save(("byNameDirs", baseDir), ("byNameDirs", digest))
             return res
 
     def getExistingByNameDirectory(self, digest):
@@ -217,7 +330,7 @@ class _BobState():
     def setResultHash(self, stepDigest, hash):
         if self.getResultHash(stepDigest) != hash:
             self.__results[stepDigest] = hash
-            self.__save()
+            self.__save(("results", stepDigest))
 
     def getInputHashes(self, path):
         return self.__inputs.get(path)
@@ -225,12 +338,12 @@ class _BobState():
     def setInputHashes(self, path, hashes):
         if self.getInputHashes(path) != hashes:
             self.__inputs[path] = hashes
-            self.__save()
+            self.__save(("inputs", path))
 
     def delInputHashes(self, path):
         if path in self.__inputs:
             del self.__inputs[path]
-            self.__save()
+            self.__save(("inputs", path))
 
     def getDirectories(self):
         return list(self.__dirStates.keys())
@@ -251,7 +364,7 @@ class _BobState():
         For pacakge directories:    bytes
         """
         self.__dirStates[path] = digest
-        self.__save()
+        self.__save(("dirStates", path))
 
     def delDirectoryState(self, path):
         self.resetWorkspaceState(path, None)
@@ -262,31 +375,61 @@ class _BobState():
     def setVariantId(self, path, variantId):
         if self.getVariantId(path) != variantId:
             self.__variantIds[path] = variantId
-            self.__save()
+            self.__save(("variantIds", path))
+
+    def getStepTiming(self, variantId):
+        """Return the timing of the last execution of a step or None.
+
+        The timing is a dict with the keys "recipe", "step", "wall",
+        "lastWall", "cpu", "hashed" and "transferred". The "wall" time is
+        averaged over the executions while "lastWall" is the wall time of the
+        last execution. The "cpu" time is None if it could not be measured.
+        """
+        return copy.deepcopy(self.__timings.get(variantId.hex()))
+
+    def setStepTiming(self, variantId, timing):
+        """Record the timing of a step execution.
+
+        The wall time is averaged with the previous value to smooth outliers.
+        """
+        key = variantId.hex()
+        timing = copy.deepcopy(timing)
+        timing["lastWall"] = timing["wall"]
+        old = self.__timings.get(key)
+        if old is not None:
+            timing["wall"] = (old["wall"] + timing["wall"]) / 2
+        self.__timings[key] = timing
+        self.__save(("timings", key))
+
+    def getStepDuration(self, variantId):
+        """Return the expected duration of a step in seconds or None."""
+        timing = self.__timings.get(variantId.hex())
+        return timing["wall"] if timing is not None else None
 
     def resetWorkspaceState(self, path, dirState):
-        needSave = False
+        changed = []
         if path in self.__results:
             del self.__results[path]
-            needSave = True
+            changed.append(("results", path))
         if path in self.__inputs:
             del self.__inputs[path]
-            needSave = True
+            changed.append(("inputs", path))
         if self.__dirStates.get(path) != dirState:
             if dirState is None:
                 del self.__dirStates[path]
             else:
                 self.__dirStates[path] = dirState
-            needSave = True
+            changed.append(("dirStates", path))
         if path in self.__variantIds:
             del self.__variantIds[path]
-            needSave = True
-        if needSave:
-            self.__save()
+            changed.append(("variantIds", path))
+        if changed:
+            self.__save(*changed)
 
     def setAtticDirectoryState(self, path, state):
-        self.__atticDirs[os.path.normpath(path)] = state
-        self.__save()
+        path = os.path.normpath(path)
+        self.__atticDirs[path] = state
+        self.__save(("atticDirs", path))
 
     def getAtticDirectoryState(self, path):
         if self.__createdWithVersion < self.VERSION_SINCE_ATTIC_TRACKED:
@@ -296,7 +439,7 @@ class _BobState():
     def delAtticDirectoryState(self, path):
         if path in self.__atticDirs:
             del self.__atticDirs[path]
-            self.__save()
+            self.__save(("atticDirs", path))
 
     def getAtticDirectories(self):
         if self.__createdWithVersion < self.VERSION_SINCE_ATTIC_TRACKED:
@@ -312,12 +455,12 @@ class _BobState():
             "jobs" : {},
             "byNameDirs" : {},
         }
-        self.__save()
+        self.__save(("jenkins", name))
 
     def delJenkins(self, name):
         if name in self.__jenkins:
             del self.__jenkins[name]
-            self.__save()
+            self.__save(("jenkins", name))
 
     def getJenkinsByNameDirectory(self, jenkins, baseDir, digest):
         byNameDirs = self.__jenkins[jenkins].setdefault('byNameDirs', {})
@@ -328,7 +471,7 @@ class _BobState():
             res = "{}/{}".format(baseDir, num)
             byNameDirs[baseDir] = num
             byNameDirs[digest] = res
-            self.__save()
+            self.__save(("jenkins", jenkins))
             return res
 
     def getJenkinsConfig(self, name):
@@ -336,29 +479,30 @@ class _BobState():
 
     def setJenkinsConfig(self, name, config):
         self.__jenkins[name]["config"] = copy.deepcopy(config)
-        self.__save()
+        self.__save(("jenkins", name))
 
     def getJenkinsAllJobs(self, name):
         return set(self.__jenkins[name]["jobs"].keys())
 
     def addJenkinsJob(self, jenkins, job, jobConfig):
         self.__jenkins[jenkins]["jobs"][job] = copy.deepcopy(jobConfig)
-        self.__save()
+        self.__save(("jenkins", jenkins))
 
     def delJenkinsJob(self, jenkins, job):
         del self.__jenkins[jenkins]["jobs"][job]
-        self.__save()
+        self.__save(("jenkins", jenkins))
 
     def getJenkinsJobConfig(self, jenkins, job):
         return copy.deepcopy(self.__jenkins[jenkins]['jobs'][job])
 
     def setJenkinsJobConfig(self, jenkins, job, jobConfig):
         self.__jenkins[jenkins]['jobs'][job] = copy.deepcopy(jobConfig)
-        self.__save()
+        self.__save(("jenkins", jenkins))
 
     def setBuildState(self, digest2Dir):
+        changed = set(self.__buildState.keys()) | set(digest2Dir.keys())
         self.__buildState = copy.deepcopy(digest2Dir)
-        self.__save()
+        self.__save(*(("buildState", k) for k in changed))
 
     def getBuildState(self):
         return copy.deepcopy(self.__buildState)
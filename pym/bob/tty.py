@@ -89,6 +89,8 @@ class BaseTUIAction:
         self.ok_message = "ok"
         self.err_kind = WARNING
         self.err_message = "error"
+        self.bytesHashed = 0
+        self.bytesTransferred = 0
 
     def setResult(self, message, kind=EXECUTED, details=""):
         if self.showDetails and details:
@@ -106,6 +108,12 @@ class BaseTUIAction:
         self.setResult(message, kind, details)
         self.setError(message, kind, details)
 
+    def addBytesHashed(self, size):
+        self.bytesHashed += size
+
+    def addBytesTransferred(self, size):
+        self.bytesTransferred += size
+
 class BaseTUI:
     def __init__(self, verbosity):
         self.__verbosity = verbosity
@@ -274,7 +282,7 @@ class ParallelTtyUI(BaseTUI):
                         self.__tasksDone, self.__tasksNum),
               end="")
         i = 0
-        while i < self.__maxJobs:
+        while i < len(self.__slots):
             num = self.__slots[i]
             if num is not None:
                 print("\n\x1b[2K {:>4}  {}".format(num, self.__jobs[num]), end='')
@@ -322,8 +330,11 @@ class ParallelTtyUI(BaseTUI):
             details += " .. "
 
         job = self.__nextJob()
+        # Checkouts, downloads and fingerprints run in separate pools. There
+        # might be more actions than jobs.
         slot = 0
-        while self.__slots[slot] is not None: slot += 1
+        while slot < len(self.__slots) and self.__slots[slot] is not None: slot += 1
+        if slot == len(self.__slots): self.__slots.append(None)
         name = step.getPackage().getName()
         self.__slots[slot] = job
         self.__jobs[job] = colorize("{:10}{} - {}".format(action, name, message), EXECUTED)
@@ -333,7 +344,7 @@ class ParallelTtyUI(BaseTUI):
 
     def cleanup(self):
         self.__putFooter()
-        for i in range(max(len(self.__jobs), self.__maxJobs)+1):
+        for i in range(len(self.__slots)+1):
             print()
         print("\x1b[?25h")
         try:
@@ -435,10 +446,19 @@ def stepMessage(step, action, message, kind, severity=-2):
     __tui.stepMessage(step, action, message, kind, severity)
 
 def stepAction(step, action, message, severity=-2, details=""):
-    return __tui.stepAction(step, action, message, severity, details)
+    ret = __tui.stepAction(step, action, message, severity, details)
+    if __profile is not None: ret = __profile.profileAction(step, action, ret)
+    return ret
 
 def stepExec(step, action, message, severity=-2, details=""):
-    return __tui.stepExec(step, action, message, severity, details)
+    ret = __tui.stepExec(step, action, message, severity, details)
+    if __profile is not None: ret = __profile.profileAction(step, action, ret)
+    return ret
+
+def setProfile(profile):
+    """Measure all step actions by the given profile. Pass None to disable."""
+    global __profile
+    __profile = profile
 
 def setVerbosity(verbosity):
     verbosity = max(ALWAYS, min(TRACE, verbosity))
@@ -477,6 +497,7 @@ def ttyReinit():
 __onTTY = (sys.stdout.isatty() and sys.stderr.isatty())
 __useColor = False
 __tui = SingleTUI(NORMAL)
+__profile = None
 
 if __onTTY and sys.platform == "win32":
     # Try to set ENABLE_VIRTUAL_TERMINAL_PROCESSING flag. Enables vt100 color
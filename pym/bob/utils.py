@@ -9,12 +9,14 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory
 import collections.abc
 import hashlib
 import logging
+import mmap
 import os
 import re
 import shutil
 import stat
 import struct
 import sys
+import threading
 
 def hashString(string):
     h = hashlib.md5()
@@ -204,14 +206,21 @@ def getPlatformTag():
 
 ### directory hashing ###
 
+__hashBuffer = threading.local()
+
 def hashFile(path, hasher=hashlib.sha1):
+    # Read into a per-thread buffer to avoid allocating a new object for
+    # every chunk. Hashing large chunks releases the GIL.
+    buf = getattr(__hashBuffer, "buf", None)
+    if buf is None:
+        buf = __hashBuffer.buf = memoryview(bytearray(1024 * 1024))
     m = hasher()
     try:
         with open(path, 'rb', buffering=0) as f:
-            buf = f.read(16384)
-            while len(buf) > 0:
-                m.update(buf)
-                buf = f.read(16384)
+            l = f.readinto(buf)
+            while l > 0:
+                m.update(buf[:l])
+                l = f.readinto(buf)
     except OSError as e:
         logging.getLogger(__name__).warning("Cannot hash file: %s", str(e))
     return m.digest()
@@ -230,110 +239,212 @@ class DirHasher:
     ])
 
     class FileIndex:
-        SIGNATURE        = b'BOB1'
-        CACHE_ENTRY_FMT  = '=QQLQLQ20sH'
+        """Persistent index of file digests.
+
+        The index is a table of fixed size records that is sorted by the file
+        name. The names are stored in a heap behind the table. The file is
+        memory mapped so that entries are found by binary search without
+        loading the whole index. Entries of changed files are updated in
+        place. The file is only rewritten if new files were found or if too
+        many entries are unused.
+        """
+
+        SIGNATURE        = b'BOB2'
+        HEADER_FMT       = '=4sL'
+        HEADER_SIZE      = struct.calcsize(HEADER_FMT)
+        CACHE_ENTRY_FMT  = '=QQQQLQ20sLH'
         CACHE_ENTRY_SIZE = struct.calcsize(CACHE_ENTRY_FMT)
+        CACHE_STAT_FMT   = '=QQQQLQ'
+        CACHE_NAME_FMT   = '=LH'
+        CACHE_NAME_POS   = struct.calcsize('=QQQQLQ20s')
 
-        class Stat:
-            def __init__(self):
-                self.name = b""
-                self.ctime = 0
-                self.mtime = 0
-                self.dev = 0
-                self.ino = 0
-                self.mode = 0
-                self.size = 0
-                self.digest = b''
-
-            def __repr__(self):
-                return "Stat(name={}, ctime={}, mtime={}, dev={}, ino={}, mode={}, size={}, digest={})".format(
-                    self.name, self.ctime, self.mtime, self.dev, self.ino, self.mode, self.size, self.digest)
+        # Old stream format that is still read to migrate existing indices.
+        LEGACY_SIGNATURE  = b'BOB1'
+        LEGACY_ENTRY_FMT  = '=QQLQLQ20sH'
+        LEGACY_ENTRY_SIZE = struct.calcsize(LEGACY_ENTRY_FMT)
 
         def __init__(self, cachePath):
             self.__cachePath = cachePath
             self.__cacheDir = os.path.dirname(cachePath)
 
         def open(self):
-            self.__inPos = 0
-            self.__inPosOld = 0
-            self.__outFile = None
-            self.__current = DirHasher.FileIndex.Stat()
+            self.__file = None
+            self.__map = None
+            self.__count = 0
+            self.__used = bytearray()
+            self.__updated = []
+            self.__added = []
+            self.__legacy = {}
             try:
                 if os.path.exists(self.__cachePath):
-                    self.__inFile = open(self.__cachePath, "rb")
-                    sig = self.__inFile.read(4)
-                    if sig == DirHasher.FileIndex.SIGNATURE:
-                        self.__mismatch = False
-                        self.__inPos = self.__inPosOld = 4
-                        self.__readEntry() # prefetch first entry
-                    else:
-                        logging.getLogger(__name__).info(
-                            "Wrong signature at '%s': %s", self.__cachePath, sig)
-                        self.__inFile.close()
-                        self.__inFile = None
-                        self.__mismatch = True
-                else:
-                    self.__inFile = None
-                    self.__mismatch = True
+                    self.__open()
             except OSError as e:
+                self.__release()
                 raise BuildError("Error opening hash cache: " + str(e))
 
+        def __open(self):
+            f = open(self.__cachePath, "r+b")
+            try:
+                sig = f.read(4)
+                if sig == DirHasher.FileIndex.SIGNATURE:
+                    (sig, count) = struct.unpack(DirHasher.FileIndex.HEADER_FMT,
+                        sig + f.read(DirHasher.FileIndex.HEADER_SIZE - 4))
+                    size = os.fstat(f.fileno()).st_size
+                    if size < DirHasher.FileIndex.HEADER_SIZE + count * DirHasher.FileIndex.CACHE_ENTRY_SIZE:
+                        logging.getLogger(__name__).info(
+                            "Truncated hash cache: %s", self.__cachePath)
+                        return
+                    self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+                    self.__file = f
+                    self.__count = count
+                    self.__used = bytearray(count)
+                    f = None
+                elif sig == DirHasher.FileIndex.LEGACY_SIGNATURE:
+                    self.__readLegacy(f)
+                else:
+                    logging.getLogger(__name__).info(
+                        "Wrong signature at '%s': %s", self.__cachePath, sig)
+            finally:
+                if f is not None: f.close()
+
+        def __readLegacy(self, f):
+            while True:
+                raw = f.read(DirHasher.FileIndex.LEGACY_ENTRY_SIZE)
+                if len(raw) < DirHasher.FileIndex.LEGACY_ENTRY_SIZE: break
+                e = struct.unpack(DirHasher.FileIndex.LEGACY_ENTRY_FMT, raw)
+                self.__legacy[f.read(e[7])] = (e[:6], e[6])
+
+        def __release(self):
+            if self.__map is not None:
+                self.__map.close()
+                self.__map = None
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
         def close(self):
             try:
-                if self.__inFile:
-                    self.__inFile.close()
-                if self.__outFile:
-                    self.__outFile.close()
-                    os.replace(self.__outFile.name, self.__cachePath)
+                unused = self.__count - sum(self.__used)
+                if self.__added or (unused > self.__count // 4):
+                    self.__rewrite()
+                else:
+                    self.__update()
             except OSError as e:
                 raise BuildError("Error closing hash cache: " + str(e))
-
-        def __readEntry(self):
-            if not self.__inFile: return False
-            raw = self.__inFile.read(DirHasher.FileIndex.CACHE_ENTRY_SIZE)
-            if len(raw) < DirHasher.FileIndex.CACHE_ENTRY_SIZE: return False
-            e = self.__current
-            (e.ctime, e.mtime, e.dev, e.ino, e.mode, e.size, e.digest,
-                nameLen) = struct.unpack(DirHasher.FileIndex.CACHE_ENTRY_FMT, raw)
-            e.name = self.__inFile.read(nameLen)
-            self.__inPosOld = self.__inPos
-            self.__inPos += DirHasher.FileIndex.CACHE_ENTRY_SIZE + nameLen
-            return True
-
-        def __writeEntry(self, name, st, digest):
-            if not self.__outFile:
-                self.__outFile = NamedTemporaryFile(mode="wb", dir=self.__cacheDir, delete=False)
-                if self.__inFile:
-                    pos = self.__inFile.tell()
-                    self.__inFile.seek(0)
-                    self.__outFile.write(self.__inFile.read(self.__inPosOld))
-                    self.__inFile.seek(pos)
+            finally:
+                self.__release()
+                self.__legacy = {}
+
+        def __name(self, i):
+            (off, length) = struct.unpack_from(DirHasher.FileIndex.CACHE_NAME_FMT,
+                self.__map, DirHasher.FileIndex.HEADER_SIZE
+                    + i * DirHasher.FileIndex.CACHE_ENTRY_SIZE
+                    + DirHasher.FileIndex.CACHE_NAME_POS)
+            off += DirHasher.FileIndex.HEADER_SIZE + self.__count * DirHasher.FileIndex.CACHE_ENTRY_SIZE
+            return self.__map[off:off+length]
+
+        def __entry(self, i):
+            return struct.unpack_from(DirHasher.FileIndex.CACHE_ENTRY_FMT,
+                self.__map, DirHasher.FileIndex.HEADER_SIZE
+                    + i * DirHasher.FileIndex.CACHE_ENTRY_SIZE)
+
+        def __lowerBound(self, name):
+            lo = 0
+            hi = self.__count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.__name(mid) < name:
+                    lo = mid + 1
                 else:
-                    self.__outFile.write(DirHasher.FileIndex.SIGNATURE)
-            self.__outFile.write(struct.pack(DirHasher.FileIndex.CACHE_ENTRY_FMT, float2ns(st.st_ctime),
-                float2ns(st.st_mtime), st.st_dev, st.st_ino, st.st_mode, st.st_size,
-                digest, len(name)))
-            self.__outFile.write(name)
-
-        def __match(self, name, st):
-            while self.__current.name < name:
-                if not self.__readEntry(): break
-            e = self.__current
-            res = ((e.name == name) and (e.ctime == float2ns(st.st_ctime)) and
-                (e.mtime == float2ns(st.st_mtime)) and (e.dev == st.st_dev) and
-                (e.ino == st.st_ino) and (e.mode == st.st_mode) and
-                (e.size == st.st_size))
-            #if not res: print("Mismatch", e.name, name, e, st)
-            return res
-
-        def check(self, prefix, name, st, process):
-            if self.__match(name, st):
-                digest = self.__current.digest
+                    hi = mid
+            return lo
+
+        def __find(self, name):
+            i = self.__lowerBound(name)
+            if i < self.__count and self.__name(i) == name:
+                return i
             else:
+                return -1
+
+        def __useSubtree(self, name):
+            """Mark all entries below directory 'name' as used."""
+            if name:
+                sep = os.fsencode(os.path.sep)
+                lo = self.__lowerBound(name + sep)
+                hi = self.__lowerBound(name + bytes([sep[0] + 1]))
+            else:
+                lo = 0
+                hi = self.__count
+            self.__used[lo:hi] = b'\x01' * (hi - lo)
+
+        def __update(self):
+            """Update changed entries in place.
+
+            The ctime is invalidated first and written last. If we are
+            interrupted the entry will not match and is hashed again on the
+            next run.
+            """
+            for (i, key, digest) in self.__updated:
+                digest = DirHasher.resolve(digest)
+                if self.__entry(i)[:7] == key + (digest,): continue
+                pos = DirHasher.FileIndex.HEADER_SIZE + i * DirHasher.FileIndex.CACHE_ENTRY_SIZE
+                struct.pack_into('=Q', self.__map, pos, 0)
+                struct.pack_into(DirHasher.FileIndex.CACHE_STAT_FMT + '20s', self.__map,
+                    pos, 0, *key[1:], digest)
+                struct.pack_into('=Q', self.__map, pos, key[0])
+            self.__updated = []
+
+        def __rewrite(self):
+            updated = { i : (key, digest) for (i, key, digest) in self.__updated }
+            entries = []
+            for i in range(self.__count):
+                if not self.__used[i]: continue
+                if i in updated:
+                    (key, digest) = updated[i]
+                    digest = DirHasher.resolve(digest)
+                else:
+                    e = self.__entry(i)
+                    (key, digest) = (e[:6], e[6])
+                entries.append((self.__name(i), key, digest))
+            entries.extend((name, key, DirHasher.resolve(digest))
+                           for (name, key, digest) in self.__added)
+            entries.sort(key=lambda e: e[0])
+
+            table = [ struct.pack(DirHasher.FileIndex.HEADER_FMT,
+                                  DirHasher.FileIndex.SIGNATURE, len(entries)) ]
+            heap = []
+            off = 0
+            for (name, key, digest) in entries:
+                table.append(struct.pack(DirHasher.FileIndex.CACHE_ENTRY_FMT, *key,
+                                         digest, off, len(name)))
+                heap.append(name)
+                off += len(name)
+
+            self.__release()
+            with NamedTemporaryFile(mode="wb", dir=self.__cacheDir, delete=False) as f:
+                f.write(b"".join(table))
+                f.write(b"".join(heap))
+            os.replace(f.name, self.__cachePath)
+
+        def check(self, prefix, name, st, process, force=False):
+            key = (float2ns(st.st_ctime), float2ns(st.st_mtime), st.st_dev,
+                   st.st_ino, st.st_mode, st.st_size)
+            i = self.__find(name) if self.__count else -1
+            if i >= 0:
+                self.__used[i] = 1
+                e = self.__entry(i)
+                if not force and e[:6] == key:
+                    if stat.S_ISDIR(st.st_mode): self.__useSubtree(name)
+                    return e[6]
                 digest = process(os.path.join(prefix, name) if name else prefix)
-                self.__mismatch = True
-            if self.__mismatch:
-                self.__writeEntry(name, st, digest)
+                self.__updated.append((i, key, digest))
+            else:
+                e = self.__legacy.get(name)
+                if not force and e is not None and e[0] == key:
+                    digest = e[1]
+                else:
+                    digest = process(os.path.join(prefix, name) if name else prefix)
+                self.__added.append((name, key, digest))
             return digest
 
     class NullIndex:
@@ -346,10 +457,31 @@ class DirHasher:
         def close(self):
             pass
 
-        def check(self, prefix, name, st, process):
+        def check(self, prefix, name, st, process, force=False):
             return process(os.path.join(prefix, name) if name else prefix)
 
-    def __init__(self, basePath=None, ignoreDirs=None):
+    class PendingDir:
+        """Directory whose digest depends on files that are still hashed."""
+
+        __slots__ = ('entries',)
+
+        def __init__(self, entries):
+            self.entries = entries
+
+        def result(self):
+            m = hashlib.sha1()
+            for (mode, digest, f) in self.entries:
+                m.update(mode)
+                m.update(DirHasher.resolve(digest))
+                m.update(f)
+            return m.digest()
+
+    @staticmethod
+    def resolve(digest):
+        """Get the final value of a possibly pending digest."""
+        return digest if isinstance(digest, bytes) else digest.result()
+
+    def __init__(self, basePath=None, ignoreDirs=None, jobs=1, changes=None):
         if basePath:
             self.__index = DirHasher.FileIndex(basePath)
         else:
@@ -358,12 +490,57 @@ class DirHasher:
             self.__ignoreDirs = DirHasher.IGNORE_DIRS | frozenset(os.fsencode(i) for i in ignoreDirs)
         else:
             self.__ignoreDirs = DirHasher.IGNORE_DIRS
+        self.__jobs = jobs
+        self.__hashFile = hashFile
+        self.__bytesHashed = 0
+        if changes is not None:
+            # A directory has to be hashed again if something changed in it
+            # or in any of its sub-directories.
+            self.__dirty = set()
+            for path in changes:
+                while path not in self.__dirty:
+                    self.__dirty.add(path)
+                    if not path: break
+                    path = os.path.dirname(path)
+        else:
+            self.__dirty = None
+
+    def __enter(self):
+        """Prepare hashing run.
+
+        If more than one job was requested the files are hashed concurrently
+        by a thread pool. The directory walk and the index lookups stay in the
+        calling thread. Only the content of changed files is hashed by the
+        pool.
+        """
+        self.__index.open()
+        if self.__jobs > 1:
+            import concurrent.futures
+            self.__executor = concurrent.futures.ThreadPoolExecutor(self.__jobs)
+            self.__hashFile = lambda path: self.__executor.submit(hashFile, path)
+        else:
+            self.__executor = None
+            self.__hashFile = hashFile
+
+    def __leave(self):
+        try:
+            if self.__executor is not None:
+                self.__executor.shutdown()
+                self.__executor = None
+        finally:
+            self.__index.close()
+
+    def __hashRegular(self, path, size):
+        self.__bytesHashed += size
+        return self.__hashFile(path)
 
     def __hashEntry(self, prefix, entry, s):
         if stat.S_ISREG(s.st_mode):
-            digest = self.__index.check(prefix, entry, s, hashFile)
+            digest = self.__index.check(prefix, entry, s,
+                lambda p: self.__hashRegular(p, s.st_size))
         elif stat.S_ISDIR(s.st_mode):
-            digest = self.__hashDir(prefix, entry)
+            digest = self.__index.check(prefix, entry, s,
+                lambda p: self.__hashDir(prefix, entry), self.__isDirty(entry))
         elif stat.S_ISLNK(s.st_mode):
             digest = self.__index.check(prefix, entry, s, DirHasher.__hashLink)
         elif stat.S_ISBLK(s.st_mode) or stat.S_ISCHR(s.st_mode):
@@ -397,6 +574,9 @@ class DirHasher:
                 logging.getLogger(__name__).warning("Cannot hash link: %s", str(e))
             return m.digest()
 
+    def __isDirty(self, path):
+        return (self.__dirty is None) or (path in self.__dirty)
+
     def __hashDir(self, prefix, path=b''):
         entries = []
         try:
@@ -422,20 +602,34 @@ class DirHasher:
                 logging.getLogger(__name__).warning("Cannot stat '%s': %s", e, str(err))
         entries = sorted(entries, key=lambda x: x[1])
         dirList = [
-            (struct.pack("=L", s.st_mode) + self.__hashEntry(prefix, e, s) + f)
+            (struct.pack("=L", s.st_mode), self.__hashEntry(prefix, e, s), f)
             for (e, f, s) in entries
         ]
-        dirBlob = b"".join(dirList)
+        if not all(isinstance(digest, bytes) for (mode, digest, f) in dirList):
+            return DirHasher.PendingDir(dirList)
+        dirBlob = b"".join(mode + digest + f for (mode, digest, f) in dirList)
         m = hashlib.sha1()
         m.update(dirBlob)
         return m.digest()
 
     def hashDirectory(self, path):
-        self.__index.open()
+        path = os.fsencode(path)
+        self.__enter()
         try:
-            return self.__hashDir(os.fsencode(path))
+            try:
+                s = os.stat(path)
+            except OSError:
+                digest = self.__hashDir(path)
+            else:
+                digest = self.__index.check(path, b'', s,
+                    lambda p: self.__hashDir(path), self.__isDirty(b''))
+            return DirHasher.resolve(digest)
         finally:
-            self.__index.close()
+            self.__leave()
+
+    def getBytesHashed(self):
+        """Return the size of all files whose content was actually hashed."""
+        return self.__bytesHashed
 
     def hashPath(self, path):
         path = os.fsencode(path)
@@ -445,18 +639,18 @@ class DirHasher:
             logging.getLogger(__name__).warning("Cannot stat '%s': %s", path, str(err))
             return b''
 
-        self.__index.open()
+        self.__enter()
         try:
-            return self.__hashEntry(path, b'', s)
+            return DirHasher.resolve(self.__hashEntry(path, b'', s))
         finally:
-            self.__index.close()
+            self.__leave()
 
 
-def hashDirectory(path, index=None, ignoreDirs=None):
-    return DirHasher(index, ignoreDirs).hashDirectory(path)
+def hashDirectory(path, index=None, ignoreDirs=None, jobs=1, changes=None):
+    return DirHasher(index, ignoreDirs, jobs, changes).hashDirectory(path)
 
-def hashPath(path, index=None, ignoreDirs=None):
-    return DirHasher(index, ignoreDirs).hashPath(path)
+def hashPath(path, index=None, ignoreDirs=None, jobs=1):
+    return DirHasher(index, ignoreDirs, jobs).hashPath(path)
 
 def binStat(path):
     st = os.stat(path)
@@ -0,0 +1,459 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""Change journal of workspaces.
+
+On Linux a watcher process can monitor the workspaces of a project with
+inotify. It records every directory where something was changed. When the
+workspace is hashed the next time only these directories and their parents
+need to be hashed again. All other directories are taken from the hash index.
+
+The watcher is started on demand and stays in the background until it was not
+used for some time. All files are kept in the ``.bob-watch`` directory of the
+project root. Workspaces are registered by placing a request file there. Once
+the watches are in place the watcher writes an activation id for the
+workspace. Changed directories are appended to the ``watch.dirty`` file next to
+the workspace. The workspace journal is only trusted if the previous hash of
+the workspace was calculated while the same activation was in place.
+"""
+
+from .utils import DirHasher
+import hashlib
+import os
+import select
+import struct
+import subprocess
+import sys
+import time
+
+WATCH_DIR = ".bob-watch"
+
+# Stop watching if nobody used the journal for this long.
+IDLE_TIMEOUT = 12 * 60 * 60
+
+# Maximum time to wait for the watcher to catch up with the workspace.
+SYNC_TIMEOUT = 2.0
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_DONT_FOLLOW  = 0x02000000
+IN_ISDIR        = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+    IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT_FMT = "=iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FMT)
+
+# Records in the dirty file are NUL terminated. The first byte tells if the
+# record is a changed path, an acknowledged sync marker or if the journal of
+# the workspace was lost.
+RECORD_PATH = b'+'
+RECORD_SYNC = b'='
+RECORD_INVALID = b'!'
+
+# Name prefix of the sync marker files in the workspace root directory.
+SYNC_PREFIX = b'.bob-watch-sync-'
+
+def _workspaceKey(workspace):
+    return hashlib.sha1(os.fsencode(workspace)).hexdigest()
+
+def _dirtyFile(workspace):
+    return os.path.join(workspace, "..", "watch.dirty")
+
+def _baseFile(workspace):
+    return os.path.join(workspace, "..", "watch.base")
+
+def _readFile(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _writeFile(path, content):
+    tmp = path + ".new"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+def _appendLocked(path, content):
+    """Append to file while holding a lock on it.
+
+    The file might be taken away while we wait for the lock. Retry on the new
+    file in this case.
+    """
+    import fcntl
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino != os.fstat(fd).st_ino: continue
+            except FileNotFoundError:
+                continue
+            os.write(fd, content)
+            return
+        finally:
+            os.close(fd)
+
+def _readSession(root):
+    """Return token of running watcher or None."""
+    session = _readFile(os.path.join(root, WATCH_DIR, "session"))
+    if not session: return None
+    try:
+        pid = int(session.split()[0])
+        os.kill(pid, 0)
+    except (ValueError, IndexError, ProcessLookupError):
+        return None
+    except PermissionError:
+        pass
+    return session
+
+
+class Inotify:
+    """Minimal ctypes binding of the Linux inotify API."""
+
+    def __init__(self):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.__get_errno = ctypes.get_errno
+        self.__add = libc.inotify_add_watch
+        self.__add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.__rm = libc.inotify_rm_watch
+        self.__rm.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.__fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0: self.__raise()
+
+    def __raise(self):
+        err = self.__get_errno()
+        raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.__fd
+
+    def close(self):
+        os.close(self.__fd)
+
+    def add(self, path):
+        wd = self.__add(self.__fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0: self.__raise()
+        return wd
+
+    def remove(self, wd):
+        self.__rm(self.__fd, wd)
+
+    def read(self):
+        try:
+            buf = os.read(self.__fd, 65536)
+        except BlockingIOError:
+            return []
+        ret = []
+        pos = 0
+        while pos < len(buf):
+            (wd, mask, cookie, nameLen) = struct.unpack_from(EVENT_FMT, buf, pos)
+            pos += EVENT_SIZE
+            name = buf[pos:pos+nameLen].rstrip(b'\0')
+            pos += nameLen
+            ret.append((wd, mask, name))
+        return ret
+
+
+class Watcher:
+    """Watch the registered workspaces of a project."""
+
+    def __init__(self, root):
+        self.__root = root
+        self.__dir = os.path.join(root, WATCH_DIR)
+        self.__inotify = Inotify()
+        self.__token = "{} {}".format(os.getpid(), time.time()).encode("ascii")
+        self.__activations = 0
+        self.__workspaces = {}  # key -> (workspace, set of wd)
+        self.__wds = {}         # wd -> (key, relative path)
+        self.__requestsWd = None
+
+    def start(self):
+        os.makedirs(os.path.join(self.__dir, "requests"), exist_ok=True)
+        os.makedirs(os.path.join(self.__dir, "active"), exist_ok=True)
+        for i in os.listdir(os.path.join(self.__dir, "active")):
+            os.unlink(os.path.join(self.__dir, "active", i))
+        self.__requestsWd = self.__inotify.add(os.path.join(self.__dir, "requests"))
+        _writeFile(os.path.join(self.__dir, "session"), self.__token)
+        self.__processRequests()
+
+    def stop(self):
+        for key in list(self.__workspaces):
+            self.__dropWorkspace(key)
+        if _readSession(self.__root) == self.__token:
+            os.unlink(os.path.join(self.__dir, "session"))
+        self.__inotify.close()
+
+    def fileno(self):
+        return self.__inotify.fileno()
+
+    def idle(self):
+        try:
+            st = os.stat(os.path.join(self.__dir, "session"))
+        except OSError:
+            return True
+        return (time.time() - st.st_mtime) > IDLE_TIMEOUT
+
+    def __processRequests(self):
+        requests = os.path.join(self.__dir, "requests")
+        for key in os.listdir(requests):
+            if key.endswith(".new"): continue
+            workspace = _readFile(os.path.join(requests, key))
+            try:
+                os.unlink(os.path.join(requests, key))
+            except OSError:
+                pass
+            if workspace and key not in self.__workspaces:
+                self.__addWorkspace(key, os.fsdecode(workspace))
+
+    def __addWorkspace(self, key, workspace):
+        self.__workspaces[key] = (workspace, set())
+        try:
+            self.__addTree(key, b'')
+        except OSError:
+            self.__dropWorkspace(key)
+            return
+        self.__activations += 1
+        _writeFile(os.path.join(self.__dir, "active", key),
+                   self.__token + " {}".format(self.__activations).encode("ascii"))
+
+    def __addTree(self, key, path):
+        workspace, wds = self.__workspaces[key]
+        workspace = os.fsencode(workspace)
+        for (dirpath, dirnames, filenames) in os.walk(os.path.join(workspace, path) if path else workspace):
+            dirnames[:] = [ d for d in dirnames if d not in DirHasher.IGNORE_DIRS ]
+            wd = self.__inotify.add(dirpath)
+            wds.add(wd)
+            self.__wds[wd] = (key, os.path.relpath(dirpath, workspace) if dirpath != workspace else b'')
+
+    def __dropWorkspace(self, key):
+        (workspace, wds) = self.__workspaces.pop(key)
+        for wd in wds:
+            self.__inotify.remove(wd)
+            del self.__wds[wd]
+        try:
+            os.unlink(os.path.join(self.__dir, "active", key))
+        except OSError:
+            pass
+        try:
+            _appendLocked(_dirtyFile(workspace), RECORD_INVALID + b'\0')
+        except OSError:
+            pass
+
+    def process(self):
+        """Process pending events.
+
+        Returns False if events were lost and the watcher must be stopped.
+        """
+        dirty = {}
+        synced = {}
+        dropped = set()
+        for (wd, mask, name) in self.__inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if wd == self.__requestsWd:
+                self.__processRequests()
+                continue
+            (key, path) = self.__wds.get(wd, (None, None))
+            if key is None or key in dropped:
+                continue
+            if mask & IN_IGNORED:
+                self.__workspaces[key][1].discard(wd)
+                del self.__wds[wd]
+                if not path: dropped.add(key)
+                continue
+            if mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                # Moved directories would keep their now stale path. Give up
+                # on the whole workspace if this happens.
+                if (mask & IN_MOVE_SELF) or not path: dropped.add(key)
+                continue
+            if not path and name.startswith(SYNC_PREFIX):
+                # The marker is removed right away. It does not change the
+                # workspace.
+                if mask & IN_CREATE: synced.setdefault(key, []).append(name)
+                continue
+            if (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO)) and \
+               name not in DirHasher.IGNORE_DIRS:
+                try:
+                    self.__addTree(key, os.path.join(path, name) if path else name)
+                except OSError:
+                    dropped.add(key)
+                    continue
+            dirty.setdefault(key, set()).add(path)
+
+        for key in dropped:
+            if key in self.__workspaces:
+                self.__dropWorkspace(key)
+        for key in dirty.keys() | synced.keys():
+            if key in dropped: continue
+            records = [ RECORD_PATH + p for p in sorted(dirty.get(key, ())) ]
+            records.extend(RECORD_SYNC + n for n in synced.get(key, ()))
+            try:
+                _appendLocked(_dirtyFile(self.__workspaces[key][0]),
+                              b"".join(r + b'\0' for r in records))
+            except OSError:
+                self.__dropWorkspace(key)
+        return True
+
+    def run(self):
+        while not self.idle():
+            (r, w, x) = select.select([self], [], [], 60)
+            if r and not self.process():
+                break
+
+
+class WorkspaceJournal:
+    """Access the change journal of a workspace.
+
+    Call :meth:`begin` before hashing the workspace. It returns the set of
+    changed directories or None if the whole workspace must be hashed. After
+    the workspace was hashed successfully :meth:`commit` must be called.
+
+    :meth:`begin` blocks until the watcher has processed all changes of the
+    workspace that happened so far. If the watcher does not catch up in time
+    the whole workspace is hashed.
+    """
+
+    def __init__(self, workspace, root="."):
+        self.__workspace = workspace
+        self.__root = root
+        self.__key = _workspaceKey(workspace)
+        self.__activation = None
+
+    def begin(self):
+        self.__activation = None
+        if sys.platform != "linux": return None
+
+        session = _readSession(self.__root)
+        if session is None:
+            startWatcher(self.__root)
+            return None
+        watchDir = os.path.join(self.__root, WATCH_DIR)
+        try:
+            os.utime(os.path.join(watchDir, "session"))
+        except OSError:
+            return None
+
+        # Make sure the watcher knows about us
+        activation = _readFile(os.path.join(watchDir, "active", self.__key))
+        if activation is None or not activation.startswith(session + b' '):
+            try:
+                _writeFile(os.path.join(watchDir, "requests", self.__key),
+                           os.fsencode(self.__workspace))
+            except OSError:
+                pass
+            return None
+
+        # Wait until the watcher has seen all changes up to now
+        dirty = _dirtyFile(self.__workspace)
+        if not self.__sync(dirty):
+            return None
+
+        # Take all recorded changes. The lock waits for the watcher to finish
+        # any pending write.
+        import fcntl
+        taken = dirty + ".taken"
+        try:
+            os.replace(dirty, taken)
+            with open(taken, "rb") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                records = f.read().split(b'\0')
+            os.unlink(taken)
+        except FileNotFoundError:
+            records = []
+        except OSError:
+            return None
+
+        # The changes are only complete if the last hash was done while the
+        # same activation was in place. Remove the base in case we are
+        # interrupted.
+        base = _readFile(_baseFile(self.__workspace))
+        if base is not None:
+            try:
+                os.unlink(_baseFile(self.__workspace))
+            except OSError:
+                return None
+        self.__activation = activation
+        if base != activation or RECORD_INVALID in records:
+            return None
+        return frozenset(r[1:] for r in records if r.startswith(RECORD_PATH))
+
+    def __sync(self, dirty):
+        marker = SYNC_PREFIX + os.urandom(8).hex().encode("ascii")
+        path = os.path.join(os.fsencode(self.__workspace), marker)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | os.O_CLOEXEC, 0o644))
+            os.unlink(path)
+        except OSError:
+            return False
+
+        deadline = time.monotonic() + SYNC_TIMEOUT
+        while True:
+            records = (_readFile(dirty) or b'').split(b'\0')
+            if RECORD_SYNC + marker in records: return True
+            if RECORD_INVALID in records: return False
+            if time.monotonic() > deadline: return False
+            time.sleep(0.005)
+
+    def commit(self):
+        if self.__activation is None: return
+        try:
+            _writeFile(_baseFile(self.__workspace), self.__activation)
+        except OSError:
+            pass
+        self.__activation = None
+
+
+def startWatcher(root="."):
+    """Start the watcher process of the project in the background."""
+    import bob
+    pym = os.path.dirname(os.path.dirname(os.path.abspath(bob.__file__)))
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join([pym] + ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+    try:
+        subprocess.Popen([sys.executable, "-m", "bob.watch", os.path.abspath(root)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, env=env, start_new_session=True)
+    except OSError:
+        pass
+
+def main(argv):
+    import fcntl
+    root = argv[0]
+    os.chdir(root)
+    os.makedirs(WATCH_DIR, exist_ok=True)
+    lock = open(os.path.join(WATCH_DIR, "lock"), "wb")
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return 0 # already running
+
+    import signal
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    watcher = Watcher(".")
+    try:
+        watcher.start()
+        watcher.run()
+    finally:
+        watcher.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -146,6 +146,8 @@ setup(
     # Optional dependencies that are not needed by default
     extras_require = {
         'azure' : [ 'azure-storage-blob' ],
+        'lz4' : [ 'lz4' ],
+        'zstd' : [ 'zstandard>=0.15' ],
     },
 
     # Installation time dependencies only needed by setup.py
@@ -8,7 +8,10 @@ from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 import asyncio
+import concurrent.futures
+import hashlib
 import http.server
+import importlib
 import os, os.path
 import socketserver
 import stat
@@ -16,8 +19,10 @@ import subprocess
 import tarfile
 import threading
 
-from bob.archive import DummyArchive, SimpleHttpArchive, getArchiver
+from bob.archive import BlobCache, CasArchive, DummyArchive, SimpleHttpArchive, getArchiver
+from bob.audit import Audit, AuditStore, isStoredAudit
 from bob.errors import BuildError
+from bob.utils import removePath
 
 DOWNLOAD_ARITFACT = b'\x00'*20
 NOT_EXISTS_ARTIFACT = b'\x01'*20
@@ -28,6 +33,7 @@ BROKEN_ARTIFACT = b'\xba\xdc\x0f\xfe'*5
 
 UPLOAD1_ARTIFACT = b'\x10'*20
 UPLOAD2_ARTIFACT = b'\x11'*20
+UPLOAD3_ARTIFACT = b'\x12'*20
 
 class DummyPackage:
     def getName(self):
@@ -51,6 +57,9 @@ def callJenkinsScript(script, workspace):
 
 class BaseTester:
 
+    # Whether the backend can tell that an artifact does not exist
+    exactQuery = True
+
     def __createArtifact(self, bid, version="1"):
         bid = hexlify(bid).decode("ascii")
         name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
@@ -119,6 +128,10 @@ class BaseTester:
         with open(name, "rb") as f:
             self.assertEqual(f.read(), content)
 
+    def __sidecarName(self, bid):
+        bid = hexlify(bid).decode("ascii")
+        return os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.audit.json.gz")
+
     def __testWorkspace(self, audit, workspace):
         with open(audit, "rb") as f:
             self.assertEqual(f.read(), b'AUDIT')
@@ -136,6 +149,7 @@ class BaseTester:
         recipes.archiveSpec.return_value = [ { 'backend' : 'none' }, spec ]
         recipes.envWhiteList = MagicMock()
         recipes.envWhiteList.return_value = []
+        recipes.archiveCacheSpec.return_value = None
         return getArchiver(recipes)
 
     def __getSingleArchiveInstance(self, spec):
@@ -146,6 +160,7 @@ class BaseTester:
         recipes.archiveSpec.return_value = spec
         recipes.envWhiteList = MagicMock()
         recipes.envWhiteList.return_value = []
+        recipes.archiveCacheSpec.return_value = None
         return getArchiver(recipes)
 
     def setUp(self):
@@ -312,6 +327,23 @@ class BaseTester:
             with self.assertRaises(BuildError):
                 run(archive.downloadPackage(DummyStep(), WRONG_VERSION_ARTIFACT, audit, content))
 
+    def testQueryPackages(self):
+        """Query the existence of multiple artifacts at once"""
+
+        archive = self.__getArchiveInstance({})
+        self.assertEqual(run(archive.queryPackages({DOWNLOAD_ARITFACT})), set())
+
+        archive.wantDownload(True)
+        self.assertEqual(run(archive.queryPackages(set())), set())
+        ret = run(archive.queryPackages({DOWNLOAD_ARITFACT, NOT_EXISTS_ARTIFACT,
+                                         BROKEN_ARTIFACT}))
+        self.assertIn(DOWNLOAD_ARITFACT, ret)
+        self.assertIn(BROKEN_ARTIFACT, ret)
+        if self.exactQuery:
+            self.assertNotIn(NOT_EXISTS_ARTIFACT, ret)
+        else:
+            self.assertIn(NOT_EXISTS_ARTIFACT, ret)
+
     def testUploadPackageNormal(self):
         """Local upload tests"""
 
@@ -355,6 +387,98 @@ class BaseTester:
         with self.assertRaises(BuildError):
             run(archive.uploadLocalLiveBuildId(DummyStep(), ERROR_UPLOAD_ARTIFACT, b'\x00'))
 
+    def testUploadCompressed(self):
+        """Artifacts can be compressed with other codecs"""
+
+        for (codec, module, magic) in [("zstd", "zstandard", b'\x28\xb5\x2f\xfd'),
+                                       ("lz4", "lz4.frame", b'\x04\x22\x4d\x18')]:
+            with self.subTest(codec=codec):
+                try:
+                    importlib.import_module(module)
+                except ImportError:
+                    self.skipTest(module + " not installed")
+
+                archive = self.__getArchiveInstance({"compression" : codec,
+                    "flags" : ["download", "upload", "nojenkins"]})
+                archive.wantUpload(True)
+                archive.wantDownload(True)
+                with TemporaryDirectory() as tmp:
+                    audit = os.path.join(tmp, "audit.json.gz")
+                    content = os.path.join(tmp, "workspace")
+                    with open(audit, "wb") as f:
+                        f.write(b"AUDIT")
+                    os.mkdir(content)
+                    with open(os.path.join(content, "data"), "wb") as f:
+                        f.write(b"DATA")
+                    run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content))
+
+                    bid = hexlify(UPLOAD1_ARTIFACT).decode("ascii")
+                    name = os.path.join(self.repo.name, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+                    with open(name, "rb") as f:
+                        self.assertEqual(f.read(4), magic)
+
+                    audit = os.path.join(tmp, "audit2.json.gz")
+                    content = os.path.join(tmp, "workspace2")
+                    self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                        UPLOAD1_ARTIFACT, audit, content)))
+                    self.__testWorkspace(audit, content)
+                    os.unlink(name)
+
+        # gzip is still the default
+        archive = self.__getArchiveInstance({})
+        archive.wantDownload(True)
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                DOWNLOAD_ARITFACT, audit, content)))
+            self.__testWorkspace(audit, content)
+
+        with self.assertRaises(BuildError):
+            self.__getArchiveInstance({"compression" : "zstd", "compressionLevel" : 42})
+        # Jenkins cannot extract lz4 artifacts
+        with self.assertRaises(BuildError):
+            self.__getArchiveInstance({"compression" : "lz4"})
+
+    def testUploadAuditSidecar(self):
+        """The audit trail is optionally published next to the artifact"""
+
+        archive = self.__getArchiveInstance({"auditSidecar" : True})
+        archive.wantUpload(True)
+        with TemporaryDirectory() as tmp:
+            audit = os.path.join(tmp, "audit.json.gz")
+            content = os.path.join(tmp, "workspace")
+            with open(audit, "wb") as f:
+                f.write(b"AUDIT")
+            os.mkdir(content)
+            with open(os.path.join(content, "data"), "wb") as f:
+                f.write(b"DATA")
+            run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT, audit, content))
+            with open(self.__sidecarName(UPLOAD1_ARTIFACT), "rb") as f:
+                self.assertEqual(f.read(), b"AUDIT")
+
+    def testUploadJenkinsAudit(self):
+        """Jenkins uploads publish the audit trail sidecar too"""
+
+        archive = self.__getArchiveInstance({"auditSidecar" : True})
+        archive.wantUpload(True)
+        with TemporaryDirectory() as tmp:
+            bid = b'\x03'*20
+            with open(os.path.join(tmp, "test.buildid"), "wb") as f:
+                f.write(bid)
+            with open(os.path.join(tmp, "audit.json.gz"), "wb") as f:
+                f.write(b"AUDIT")
+            script = archive.uploadJenkinsAudit(DummyStep(), "test.buildid", "audit.json.gz")
+            callJenkinsScript(script, tmp)
+            with open(self.__sidecarName(bid), "rb") as f:
+                self.assertEqual(f.read(), b"AUDIT")
+
+        # disabled by default
+        archive = self.__getArchiveInstance({})
+        archive.wantUpload(True)
+        self.assertEqual(archive.uploadJenkinsAudit(DummyStep(), "test.buildid",
+                                                    "audit.json.gz"), "")
+
     def testUploadPackageNoFail(self):
         """The nofail option must prevent fatal error on upload failures"""
 
@@ -481,28 +605,40 @@ class TestDummyArchive(TestCase):
     def testDownloadLocal(self):
         run(DummyArchive().downloadPackage(DummyStep(), b'\x00'*20, "unused", "unused"))
         self.assertEqual(run(DummyArchive().downloadLocalLiveBuildId(DummyStep(), b'\x00'*20)), None)
+        self.assertEqual(run(DummyArchive().queryPackages({b'\x00'*20})), set())
 
     def testUploadJenkins(self):
         ret = DummyArchive().upload(b'\x00'*20, "unused", "unused")
         self.assertEqual(ret, "")
         ret = DummyArchive().uploadJenkinsLiveBuildId(None, "unused", "unused", False)
         self.assertEqual(ret, "")
+        ret = DummyArchive().uploadJenkinsAudit(None, "unused", "unused")
+        self.assertEqual(ret, "")
 
     def testUploadLocal(self):
         run(DummyArchive().uploadPackage(DummyStep(), b'\x00'*20, "unused", "unused"))
         run(DummyArchive().uploadLocalLiveBuildId(DummyStep(), b'\x00'*20, b'\x00'*20))
 
 
-def createHttpHandler(repoPath):
+def createHttpHandler(repoPath, connections=None):
 
     class Handler(http.server.BaseHTTPRequestHandler):
 
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            if connections is not None: connections.append(self.client_address)
+
         def getCommon(self):
             path = repoPath + self.path
             try:
                 f = open(path, "rb")
             except FileNotFoundError:
-                self.send_error(404, "not found")
+                # keep connection open unlike send_error()
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
                 return None
             except OSError:
                 self.send_error(500, "internal error")
@@ -510,6 +646,7 @@ def createHttpHandler(repoPath):
 
             self.send_response(200)
             self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
             self.end_headers()
             return f
 
@@ -532,6 +669,7 @@ def createHttpHandler(repoPath):
             if os.path.exists(path):
                 if "If-None-Match" in self.headers:
                     self.send_response(412)
+                    self.send_header("Content-Length", "0")
                     self.end_headers()
                     return
                 else:
@@ -542,6 +680,7 @@ def createHttpHandler(repoPath):
                 with open(path, "wb") as f:
                     f.write(content)
                 self.send_response(200 if exists else 201)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
             except OSError:
                 self.send_error(500, "internal error")
@@ -559,7 +698,10 @@ class TestHttpArchive(BaseTester, TestCase):
 
     def setUp(self):
         super().setUp()
-        self.httpd = socketserver.ThreadingTCPServer(("localhost", 0), createHttpHandler(self.repo.name))
+        self.connections = []
+        self.httpd = socketserver.ThreadingTCPServer(("localhost", 0),
+            createHttpHandler(self.repo.name, self.connections))
+        self.httpd.daemon_threads = True
         self.ip, self.port = self.httpd.server_address
         self.server = threading.Thread(target=self.httpd.serve_forever)
         self.server.daemon = True
@@ -574,6 +716,46 @@ class TestHttpArchive(BaseTester, TestCase):
         spec['backend'] = "http"
         spec["url"] = "http://{}:{}".format(self.ip, self.port)
 
+    def testConnectionReuse(self):
+        """Concurrent transfers share a limited number of connections"""
+
+        spec = { 'url' : "http://{}:{}".format(self.ip, self.port),
+                 'connections' : 2 }
+        archive = SimpleHttpArchive(spec, None)
+        archive.wantDownload(True)
+
+        buildIds = { bytes([i])*20 for i in range(0x20, 0x30) } | {DOWNLOAD_ARITFACT}
+        self.assertEqual(run(archive.queryPackages(buildIds)), {DOWNLOAD_ARITFACT})
+        with TemporaryDirectory() as tmp:
+            for i in range(4):
+                audit = os.path.join(tmp, "audit{}.json.gz".format(i))
+                content = os.path.join(tmp, "workspace{}".format(i))
+                self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                    DOWNLOAD_ARITFACT, audit, content)))
+        self.assertLessEqual(len(self.connections), 2)
+
+    def testProcessPool(self):
+        """Transfers run in the process pool and keep their connections there"""
+
+        spec = { 'url' : "http://{}:{}".format(self.ip, self.port),
+                 'connections' : 2 }
+        archive = SimpleHttpArchive(spec, None)
+        archive.wantDownload(True)
+        self.assertEqual(run(archive.queryPackages({DOWNLOAD_ARITFACT})), {DOWNLOAD_ARITFACT})
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor, \
+             patch.object(SimpleHttpArchive, "_getExecutor", return_value=executor):
+            with TemporaryDirectory() as tmp:
+                for i in range(3):
+                    audit = os.path.join(tmp, "audit{}.json.gz".format(i))
+                    content = os.path.join(tmp, "workspace{}".format(i))
+                    self.assertTrue(run(archive.downloadPackage(DummyStep(),
+                        DOWNLOAD_ARITFACT, audit, content)))
+                    with open(os.path.join(content, "data"), "rb") as f:
+                        self.assertEqual(f.read(), b'DATA')
+        # One connection of the query and one of the worker process
+        self.assertEqual(len(self.connections), 2)
+
     def testInvalidServer(self):
         """Test download on non-existent server"""
 
@@ -585,6 +767,7 @@ class TestHttpArchive(BaseTester, TestCase):
         # Local
         run(archive.downloadPackage(DummyStep(), b'\x00'*20, "unused", "unused"))
         self.assertEqual(run(archive.downloadLocalLiveBuildId(DummyStep(), b'\x00'*20)), None)
+        self.assertEqual(run(archive.queryPackages({b'\x00'*20})), {b'\x00'*20})
 
         # Jenkins
         with TemporaryDirectory() as workspace:
@@ -595,8 +778,246 @@ class TestHttpArchive(BaseTester, TestCase):
 
 class TestCustomArchive(BaseTester, TestCase):
 
+    exactQuery = False
+
     def _setArchiveSpec(self, spec):
         spec['backend'] = "shell"
         spec["download"] = "cp {}/$BOB_REMOTE_ARTIFACT $BOB_LOCAL_ARTIFACT".format(self.repo.name)
         spec["upload"] = "mkdir -p {P}/${{BOB_REMOTE_ARTIFACT%/*}} && cp $BOB_LOCAL_ARTIFACT {P}/$BOB_REMOTE_ARTIFACT".format(P=self.repo.name)
 
+
+class TestCasArchive(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.repo = os.path.join(self.tmp.name, "repo")
+        self.cache = os.path.join(self.tmp.name, "cache")
+        self.archive = CasArchive({ "path" : self.repo, "cache" : self.cache })
+        self.archive.wantDownload(True)
+        self.archive.wantUpload(True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def createWorkspace(self, name, data):
+        audit = os.path.join(self.tmp.name, name + ".json.gz")
+        with open(audit, "wb") as f:
+            f.write(b"AUDIT")
+        content = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.join(content, "bin"))
+        with open(os.path.join(content, "bin", "tool"), "wb") as f:
+            f.write(b"TOOL")
+        os.chmod(os.path.join(content, "bin", "tool"), 0o755)
+        with open(os.path.join(content, "data"), "wb") as f:
+            f.write(data)
+        os.symlink("bin/tool", os.path.join(content, "link"))
+        return (audit, content)
+
+    def listBlobs(self, root, suffix):
+        return sorted(f for (_, _, files) in os.walk(root) for f in files
+                      if f.endswith(suffix) and not f.startswith("index.sqlite3"))
+
+    def cachedBlob(self, data):
+        name = hashlib.sha1(data).hexdigest()
+        return os.path.join(self.cache, name[0:2], name[2:])
+
+    def testRoundTrip(self):
+        """Identical files are stored only once and are restored completely"""
+        run(self.archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                                       *self.createWorkspace("ws1", b"DATA1")))
+        run(self.archive.uploadPackage(DummyStep(), UPLOAD2_ARTIFACT,
+                                       *self.createWorkspace("ws2", b"DATA2")))
+        self.assertEqual(len(self.listBlobs(self.repo, ".manifest")), 2)
+        # audit, tool, DATA1, DATA2
+        self.assertEqual(len(self.listBlobs(self.repo, ".blob")), 4)
+        self.assertEqual(run(self.archive.queryPackages({UPLOAD1_ARTIFACT,
+            NOT_EXISTS_ARTIFACT})), {UPLOAD1_ARTIFACT})
+
+        audit = os.path.join(self.tmp.name, "dl.json.gz")
+        content = os.path.join(self.tmp.name, "dl")
+        self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD2_ARTIFACT, audit, content)))
+        with open(audit, "rb") as f:
+            self.assertEqual(f.read(), b"AUDIT")
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), b"DATA2")
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(content, "bin", "tool")).st_mode), 0o755)
+        self.assertEqual(os.readlink(os.path.join(content, "link")), "bin/tool")
+        self.assertEqual(len(self.listBlobs(self.cache, "")), 3)
+
+        self.assertFalse(run(self.archive.downloadPackage(DummyStep(),
+            NOT_EXISTS_ARTIFACT, audit, content)))
+
+    def testCachedBlobs(self):
+        """Downloads take blobs from the local cache"""
+        run(self.archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                                       *self.createWorkspace("ws1", b"DATA1")))
+        audit = os.path.join(self.tmp.name, "dl.json.gz")
+        content = os.path.join(self.tmp.name, "dl")
+        self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD1_ARTIFACT, audit, content)))
+
+        # remove all blobs from the archive
+        for (root, _, files) in os.walk(self.repo):
+            for f in files:
+                if f.endswith(".blob"): os.unlink(os.path.join(root, f))
+        self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD1_ARTIFACT, audit, content)))
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), b"DATA1")
+
+        # Incomplete artifacts are not used
+        removePath(self.cache)
+        self.assertFalse(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD1_ARTIFACT, audit, content)))
+
+    def testAuditRecords(self):
+        """Shared audit records are stored once and restored self-contained"""
+        lib = Audit.create(b'\x01'*20, b'\x01'*20, b'\x01'*20)
+        lib.addDefine("step", "dist")
+        libName = os.path.join(self.tmp.name, "lib.json.gz")
+        lib.save(libName)
+
+        store = AuditStore.open(os.path.join(self.tmp.name, "store"))
+        for (bid, data) in [(UPLOAD1_ARTIFACT, b"DATA1"), (UPLOAD2_ARTIFACT, b"DATA2")]:
+            (audit, content) = self.createWorkspace(bid.hex(), data)
+            app = Audit.create(bid, bid, bid)
+            app.addArg(libName)
+            app.save(audit, store)
+            run(self.archive.uploadPackage(DummyStep(), bid, audit, content))
+        # lib, app1, app2, tool, DATA1, DATA2
+        self.assertEqual(len(self.listBlobs(self.repo, ".blob")), 6)
+
+        audit = os.path.join(self.tmp.name, "dl.json.gz")
+        content = os.path.join(self.tmp.name, "dl")
+        self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD2_ARTIFACT, audit, content)))
+        self.assertFalse(isStoredAudit(audit))
+        self.assertEqual(Audit.fromFile(audit).getReferencedBuildIds(), [b'\x01'*20])
+
+    def testCacheQuota(self):
+        """Least recently used blobs are evicted if the cache quota is exceeded"""
+        archive = CasArchive({ "path" : self.repo, "cache" : self.cache, "cacheQuota" : 1 })
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        data1 = os.urandom(600*1024)
+        data2 = os.urandom(600*1024)
+        run(archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                                  *self.createWorkspace("ws1", data1)))
+        run(archive.uploadPackage(DummyStep(), UPLOAD2_ARTIFACT,
+                                  *self.createWorkspace("ws2", data2)))
+
+        audit = os.path.join(self.tmp.name, "dl.json.gz")
+        content = os.path.join(self.tmp.name, "dl")
+        self.assertTrue(run(archive.downloadPackage(DummyStep(),
+            UPLOAD1_ARTIFACT, audit, content)))
+        self.assertTrue(os.path.exists(self.cachedBlob(data1)))
+        self.assertTrue(run(archive.downloadPackage(DummyStep(),
+            UPLOAD2_ARTIFACT, audit, content)))
+        self.assertFalse(os.path.exists(self.cachedBlob(data1)))
+        self.assertTrue(os.path.exists(self.cachedBlob(data2)))
+        self.assertTrue(os.path.exists(self.cachedBlob(b"TOOL")))
+
+    def testConcurrentEviction(self):
+        """Blobs that are evicted by another process do not fail the download"""
+        run(self.archive.uploadPackage(DummyStep(), UPLOAD1_ARTIFACT,
+                                       *self.createWorkspace("ws1", b"DATA1")))
+        audit = os.path.join(self.tmp.name, "dl.json.gz")
+        content = os.path.join(self.tmp.name, "dl")
+        self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD1_ARTIFACT, audit, content)))
+
+        # Evicted between the lookup and the copy of the blob
+        get = BlobCache.get
+        def evict(cache, digest):
+            ret = get(cache, digest)
+            if ret is not None: os.unlink(ret.name)
+            return ret
+        with patch.object(BlobCache, "get", autospec=True, side_effect=evict):
+            self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+                UPLOAD1_ARTIFACT, audit, content)))
+        with open(os.path.join(content, "data"), "rb") as f:
+            self.assertEqual(f.read(), b"DATA1")
+
+        # Evicted blobs are fetched again
+        self.assertFalse(os.path.exists(self.cachedBlob(b"DATA1")))
+        self.assertTrue(run(self.archive.downloadPackage(DummyStep(),
+            UPLOAD1_ARTIFACT, audit, content)))
+        self.assertTrue(os.path.exists(self.cachedBlob(b"DATA1")))
+
+class TestArtifactCache(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.repo = os.path.join(self.tmp.name, "repo")
+        self.cache = os.path.join(self.tmp.name, "cache")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def getArchive(self, quota=None):
+        recipes = MagicMock()
+        recipes.archiveSpec.return_value = { "backend" : "file", "path" : self.repo }
+        cacheSpec = { "path" : self.cache }
+        if quota is not None: cacheSpec["quota"] = quota
+        recipes.archiveCacheSpec.return_value = cacheSpec
+        archive = getArchiver(recipes)
+        archive.wantDownload(True)
+        archive.wantUpload(True)
+        return archive
+
+    def upload(self, archive, bid, data):
+        audit = os.path.join(self.tmp.name, "audit.json.gz")
+        with open(audit, "wb") as f:
+            f.write(b"AUDIT")
+        content = os.path.join(self.tmp.name, "ws")
+        removePath(content)
+        os.mkdir(content)
+        with open(os.path.join(content, "data"), "wb") as f:
+            f.write(data)
+        run(archive.uploadPackage(DummyStep(), bid, audit, content))
+
+    def download(self, archive, bid):
+        audit = os.path.join(self.tmp.name, "dl.json.gz")
+        content = os.path.join(self.tmp.name, "dl")
+        return run(archive.downloadPackage(DummyStep(), bid, audit, content))
+
+    def cachedName(self, bid):
+        bid = hexlify(bid).decode("ascii")
+        return os.path.join(self.cache, bid[0:2], bid[2:4], bid[4:] + "-1.tgz")
+
+    def testReadThrough(self):
+        """Downloaded artifacts are served from the cache later"""
+        archive = self.getArchive()
+        self.upload(archive, UPLOAD1_ARTIFACT, b"DATA")
+        self.assertFalse(os.path.exists(self.cachedName(UPLOAD1_ARTIFACT)))
+
+        self.assertTrue(self.download(archive, UPLOAD1_ARTIFACT))
+        self.assertTrue(os.path.exists(self.cachedName(UPLOAD1_ARTIFACT)))
+        self.assertFalse(self.download(archive, UPLOAD2_ARTIFACT))
+
+        removePath(self.repo)
+        self.assertTrue(self.download(archive, UPLOAD1_ARTIFACT))
+        with open(os.path.join(self.tmp.name, "dl", "data"), "rb") as f:
+            self.assertEqual(f.read(), b"DATA")
+        self.assertEqual(run(archive.queryPackages({UPLOAD1_ARTIFACT, UPLOAD2_ARTIFACT})),
+                         {UPLOAD1_ARTIFACT})
+
+    def testEviction(self):
+        """Least recently used artifacts are evicted if the quota is exceeded"""
+        archive = self.getArchive(quota=1)
+        for bid in (UPLOAD1_ARTIFACT, UPLOAD2_ARTIFACT, UPLOAD3_ARTIFACT):
+            self.upload(archive, bid, os.urandom(400*1024))
+
+        self.assertTrue(self.download(archive, UPLOAD1_ARTIFACT))
+        self.assertTrue(self.download(archive, UPLOAD2_ARTIFACT))
+        removePath(self.repo)
+        self.assertTrue(self.download(archive, UPLOAD1_ARTIFACT))
+        os.makedirs(self.repo)
+        self.upload(archive, UPLOAD3_ARTIFACT, os.urandom(400*1024))
+        self.assertTrue(self.download(archive, UPLOAD3_ARTIFACT))
+
+        self.assertTrue(os.path.exists(self.cachedName(UPLOAD1_ARTIFACT)))
+        self.assertFalse(os.path.exists(self.cachedName(UPLOAD2_ARTIFACT)))
+        self.assertFalse(os.path.exists(self.cachedName(UPLOAD2_ARTIFACT)[:-4] + ".audit.json.gz"))
+        self.assertTrue(os.path.exists(self.cachedName(UPLOAD3_ARTIFACT)))
@@ -0,0 +1,99 @@
+# Bob build tool
+# Copyright (C) 2017  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import io
+import os
+import shutil
+
+from bob.audit import Audit
+from bob.cmds.archive import doArchiveClean, doArchiveScan
+from bob.errors import BobError
+
+TOOL = b'\x01' * 20
+APP = b'\x02' * 20
+OTHER = b'\x03' * 20
+
+class TestArchiveClean(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = TemporaryDirectory()
+        self.audits = os.path.join(self.tmpdir.name, "audits")
+        self.repo = os.path.join(self.tmpdir.name, "repo")
+        os.mkdir(self.audits)
+        os.mkdir(self.repo)
+        os.chdir(self.repo)
+
+        tool = self.createArtifact(TOOL, "tool")
+        self.createArtifact(APP, "app", {"TYPE" : "alpha"}, [tool])
+        self.createArtifact(OTHER, "other", {"TYPE" : "bravo"})
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def createArtifact(self, bid, package, metaEnv={}, args=[]):
+        """Create empty artifact with an audit trail sidecar."""
+        audit = Audit.create(bid, bid, bid)
+        audit.addDefine("package", package)
+        audit.addDefine("step", "dist")
+        for (var, value) in metaEnv.items():
+            audit.addMetaEnv(var, value)
+        for arg in args:
+            audit.addArg(arg)
+        auditName = os.path.join(self.audits, package + ".json.gz")
+        audit.save(auditName)
+
+        bid = bid.hex()
+        path = os.path.join(self.repo, bid[0:2], bid[2:4])
+        os.makedirs(path)
+        open(os.path.join(path, bid[4:] + "-1.tgz"), "wb").close()
+        shutil.copy(auditName, os.path.join(path, bid[4:] + "-1.audit.json.gz"))
+        return auditName
+
+    def exists(self, bid):
+        bid = bid.hex()
+        return os.path.exists(os.path.join(self.repo, bid[0:2], bid[2:4], bid[4:] + "-1.tgz"))
+
+    def clean(self, *args):
+        with patch('sys.stdout', new=io.StringIO()) as stdout:
+            doArchiveClean(["-j", "2"] + list(args))
+        return stdout.getvalue().split()
+
+    def testRetainReferences(self):
+        """Referenced artifacts of retained artifacts are kept too"""
+        self.clean("meta.package == \"app\"")
+        self.assertTrue(self.exists(TOOL))
+        self.assertTrue(self.exists(APP))
+        self.assertFalse(self.exists(OTHER))
+        self.assertFalse(os.path.exists(os.path.join(self.repo, "03", "03",
+            "03"*18 + "-1.audit.json.gz")))
+
+    def testDryRun(self):
+        """Nothing is deleted in a dry run"""
+        self.assertEqual(self.clean("--dry-run", "metaEnv.TYPE != \"alpha\" && !(\"z\" < meta.package)"),
+                         [os.path.join("02", "02", "02"*18 + "-1.tgz")])
+        self.assertTrue(self.exists(APP))
+
+    def testMissingFields(self):
+        """Missing fields are unequal to everything and compare as false"""
+        self.assertEqual(len(self.clean("--dry-run", "metaEnv.TYPE == \"alpha\"")), 1)
+        self.assertEqual(len(self.clean("--dry-run", "metaEnv.TYPE != \"alpha\"")), 1)
+        self.assertEqual(len(self.clean("--dry-run", "metaEnv.TYPE >= \"b\"")), 2)
+        self.assertEqual(len(self.clean("--dry-run", "metaEnv.TYPE == metaEnv.FOO")), 2)
+        self.assertEqual(len(self.clean("--dry-run", "metaEnv.FOO == metaEnv.BAR")), 0)
+
+    def testInvalidExpression(self):
+        """Type errors in the expression are detected"""
+        doArchiveScan([])
+        for expr in ["meta == \"app\"", "meta.package", "\"app\"",
+                     "!meta.package", "(\"a\" == \"a\") < \"b\""]:
+            with self.subTest(expr=expr):
+                with self.assertRaises(BobError):
+                    self.clean("-n", expr)
+        self.assertTrue(self.exists(OTHER))
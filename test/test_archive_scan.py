@@ -0,0 +1,151 @@
+# Bob build tool
+# Copyright (C) 2017  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import concurrent.futures
+import io
+import os
+import shutil
+import sqlite3
+
+from bob.audit import Audit
+from bob.cmds.archive import ArchiveScanner
+
+def bid(n):
+    return bytes([n]) * 20
+
+class TestArchiveScan(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = TemporaryDirectory()
+        self.audits = os.path.join(self.tmpdir.name, "audits")
+        self.repo = os.path.join(self.tmpdir.name, "repo")
+        os.mkdir(self.audits)
+        os.mkdir(self.repo)
+        os.chdir(self.repo)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def createArtifact(self, bid, package, args=[]):
+        """Create empty artifact with an audit trail sidecar."""
+        audit = Audit.create(bid, bid, bid)
+        audit.addDefine("package", package)
+        audit.addDefine("step", "dist")
+        for arg in args:
+            audit.addArg(arg)
+        auditName = os.path.join(self.audits, package + ".json.gz")
+        audit.save(auditName)
+
+        bid = bid.hex()
+        path = os.path.join(self.repo, bid[0:2], bid[2:4])
+        os.makedirs(path, exist_ok=True)
+        open(os.path.join(path, bid[4:] + "-1.tgz"), "wb").close()
+        shutil.copy(auditName, self.sidecar(bytes.fromhex(bid)))
+        return auditName
+
+    def sidecar(self, bid):
+        bid = bid.hex()
+        return os.path.join(self.repo, bid[0:2], bid[2:4], bid[4:] + "-1.audit.json.gz")
+
+    def age(self):
+        """Make all directories old enough to be skipped by later scans."""
+        for (root, dirs, files) in os.walk(self.repo):
+            for d in dirs:
+                os.utime(os.path.join(root, d), (0, 0))
+
+    def recordedDirs(self):
+        con = sqlite3.connect(".bob-archive.sqlite3")
+        try:
+            return sorted(r[0] for r in con.execute("SELECT name FROM dirs"))
+        finally:
+            con.close()
+
+    def scan(self, jobs=1):
+        with patch('sys.stdout', new=io.StringIO()), patch('sys.stderr', new=io.StringIO()):
+            with ArchiveScanner() as scanner:
+                scanner.scan(False, jobs)
+                return (sorted(scanner.getBuildIds()),
+                        { b : scanner.getReferencedBuildIds(b) for b in scanner.getBuildIds() })
+
+    def testSkipUnchanged(self):
+        """Unchanged directories are not read again"""
+        self.createArtifact(bid(1), "a")
+        self.createArtifact(bid(2), "b")
+        self.age()
+        self.assertEqual(self.scan()[0], [bid(1), bid(2)])
+
+        with patch('bob.cmds.archive.readArtifact') as readArtifact:
+            self.assertEqual(self.scan()[0], [bid(1), bid(2)])
+            readArtifact.assert_not_called()
+
+    def testRecentNotRecorded(self):
+        """Directories that were modified just now are scanned again"""
+        self.createArtifact(bid(1), "a")
+        self.assertEqual(self.scan()[0], [bid(1)])
+        self.assertEqual(self.recordedDirs(), [])
+        self.age()
+        self.assertEqual(self.scan()[0], [bid(1)])
+        self.assertEqual(self.recordedDirs(), [os.path.join("01", "01")])
+
+    def testAddRemove(self):
+        """Added and removed artifacts are detected"""
+        a = self.createArtifact(bid(1), "a")
+        self.createArtifact(bid(2), "b", [a])
+        self.age()
+        (bids, refs) = self.scan()
+        self.assertEqual(bids, [bid(1), bid(2)])
+        self.assertEqual(refs[bid(2)], [bid(1)])
+
+        shutil.rmtree(os.path.join(self.repo, "02"))
+        self.createArtifact(bid(3), "c", [a])
+        os.unlink(os.path.join(self.repo, "01", "01", "01"*18 + "-1.tgz"))
+        self.age()
+        (bids, refs) = self.scan()
+        self.assertEqual(bids, [bid(3)])
+        self.assertEqual(refs[bid(3)], [bid(1)])
+
+        # The references of removed artifacts are pruned too
+        with ArchiveScanner() as scanner:
+            self.assertEqual(scanner.getReferencedBuildIds(bid(2)), [])
+
+    def testRetryFailed(self):
+        """Directories with unreadable artifacts are scanned again"""
+        self.createArtifact(bid(1), "a")
+        self.createArtifact(bid(2), "b")
+        with open(self.sidecar(bid(2)), "r+b") as f:
+            good = f.read()
+            f.seek(0)
+            f.write(b"garbage")
+            f.truncate()
+        self.age()
+        self.assertEqual(self.scan()[0], [bid(1)])
+        self.assertEqual(self.recordedDirs(), [os.path.join("01", "01")])
+
+        # Repair the artifact in place. The directory stat does not change.
+        with open(self.sidecar(bid(2)), "wb") as f:
+            f.write(good)
+        self.assertEqual(self.scan()[0], [bid(1), bid(2)])
+
+    def testParallel(self):
+        """Many new artifacts are read by a process pool"""
+        for i in range(100):
+            self.createArtifact(bid(i), "p{}".format(i))
+        self.age()
+        with patch('concurrent.futures.ProcessPoolExecutor',
+                   wraps=concurrent.futures.ProcessPoolExecutor) as executor:
+            self.assertEqual(self.scan(jobs=2)[0], [bid(i) for i in range(100)])
+            executor.assert_called_once_with(max_workers=2)
+
+        # Only a few changed artifacts are read directly
+        with patch('concurrent.futures.ProcessPoolExecutor') as executor:
+            self.createArtifact(bid(200), "q")
+            self.age()
+            self.assertEqual(len(self.scan(jobs=2)[0]), 101)
+            executor.assert_not_called()
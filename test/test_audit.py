@@ -0,0 +1,174 @@
+# Bob build tool
+# Copyright (C) 2017  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import gzip
+import io
+import json
+import os
+import shutil
+
+from bob.audit import Audit, AuditStore, exportAudit, isStoredAudit
+from bob.errors import ParseError
+
+class TestAuditStore(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+        self.storePath = os.path.join(self.tmpdir.name, "store")
+        # Not shared with the stores that are opened when loading audits
+        self.store = AuditStore(self.storePath)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def createAudit(self, name, bid, args=[], store=None):
+        audit = Audit.create(bid, bid, bid)
+        audit.addDefine("package", name)
+        audit.addDefine("step", "dist")
+        for arg in args:
+            audit.addArg(arg)
+        fileName = os.path.join(self.tmpdir.name, name, "audit.json.gz")
+        os.makedirs(os.path.dirname(fileName))
+        audit.save(fileName, store)
+        return (fileName, audit)
+
+    def createTree(self, store):
+        (lib, _) = self.createAudit("lib", b'\x01'*20, store=store)
+        (tool, _) = self.createAudit("tool", b'\x02'*20, [lib], store=store)
+        return self.createAudit("app", b'\x03'*20, [lib, tool], store=store)
+
+    def testRoundTrip(self):
+        """Stored audit trails only hold the ids of their references"""
+        (app, audit) = self.createTree(self.store)
+        self.assertTrue(isStoredAudit(app))
+        with gzip.open(app) as f:
+            tree = json.load(f)
+        self.assertEqual(tree["store"], os.path.join("..", "store"))
+        self.assertEqual(len(tree["references"]), 2)
+        self.assertTrue(all(isinstance(r, str) for r in tree["references"]))
+        self.assertEqual(sum(len(f) for (_, _, f) in os.walk(self.storePath)), 3)
+
+        loaded = Audit.fromFile(app)
+        self.assertEqual(loaded.getId(), audit.getId())
+        self.assertEqual(loaded.getReferencedBuildIds(), [b'\x01'*20, b'\x02'*20])
+        self.assertEqual(sorted(a.getMetaData()["package"] for a in loaded.getReferencedArtifacts()),
+                         ["lib", "tool"])
+
+    def testExport(self):
+        """Stored audit trails can be exported to the self-contained format"""
+        (app, audit) = self.createTree(self.store)
+        exported = Audit.fromByteStream(io.BytesIO(gzip.decompress(exportAudit(app))), "app")
+        self.assertEqual(exported.getId(), audit.getId())
+        self.assertEqual(exported.getReferencedBuildIds(), [b'\x01'*20, b'\x02'*20])
+
+        # Self-contained audits are not touched
+        self.tmpdir.cleanup()
+        os.mkdir(self.tmpdir.name)
+        (app, _) = self.createTree(None)
+        self.assertFalse(isStoredAudit(app))
+        with open(app, "rb") as f:
+            self.assertEqual(exportAudit(app), f.read())
+
+    def testMixed(self):
+        """Self-contained references are added to the store"""
+        (lib, _) = self.createAudit("lib", b'\x01'*20)
+        (app, _) = self.createAudit("app", b'\x03'*20, [lib], store=self.store)
+        self.assertEqual(sum(len(f) for (_, _, f) in os.walk(self.storePath)), 2)
+        self.assertEqual([ a.getMetaData()["package"] for a in
+                           Audit.fromFile(app).getReferencedArtifacts() ], ["lib"])
+
+    def testMissingRecord(self):
+        """Missing records are detected when they are needed"""
+        (app, audit) = self.createTree(self.store)
+        # The store is found relative to the audit trail
+        moved = os.path.join(self.tmpdir.name, "moved", "app", "audit.json.gz")
+        os.makedirs(os.path.dirname(moved))
+        shutil.copy(app, moved)
+        app = moved
+        loaded = Audit.fromFile(app)
+        self.assertEqual(loaded.getId(), audit.getId())
+        with self.assertRaises(ParseError):
+            loaded.getReferencedArtifacts()
+        with self.assertRaises(ParseError):
+            exportAudit(app)
+
+    def testPrune(self):
+        """Only records that are referenced by the audit trails are kept"""
+        (app, _) = self.createTree(self.store)
+        self.createAudit("other", b'\x04'*20, store=self.store)
+        tool = os.path.join(self.tmpdir.name, "tool", "audit.json.gz")
+        missing = os.path.join(self.tmpdir.name, "missing", "audit.json.gz")
+        self.assertEqual(sum(len(f) for (_, _, f) in os.walk(self.storePath)), 4)
+
+        pruned = self.store.prune([tool, missing], True)
+        self.assertEqual(len(pruned), 2)
+        self.assertEqual(sum(len(f) for (_, _, f) in os.walk(self.storePath)), 4)
+
+        self.assertEqual(sorted(self.store.prune([tool, missing])), sorted(pruned))
+        self.assertEqual(sum(len(f) for (_, _, f) in os.walk(self.storePath)), 2)
+        self.assertEqual(sorted(a.getMetaData()["package"] for a in
+                                Audit.fromFile(tool).getReferencedArtifacts()),
+                         ["lib"])
+        self.assertFalse(any(os.path.exists(r) for r in pruned))
+        self.assertEqual(self.store.prune([app, tool]), [])
+
+class TestAuditCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def createAudit(self, name, bid, args=[]):
+        audit = Audit.create(bid, bid, bid)
+        audit.addDefine("package", name)
+        audit.addDefine("step", "dist")
+        for arg in args:
+            audit.addArg(arg)
+        fileName = os.path.join(self.tmpdir.name, name + ".json.gz")
+        audit.save(fileName)
+        return (fileName, audit)
+
+    def testReuse(self):
+        """Loaded and saved audits are kept as long as the file is unchanged"""
+        (lib, audit) = self.createAudit("lib", b'\x01'*20)
+        self.assertIs(Audit.fromFile(lib), audit)
+
+        (lib, audit) = self.createAudit("lib", b'\x02'*20)
+        self.assertIs(Audit.fromFile(lib), audit)
+        self.assertEqual(audit.getArtifact().getBuildId(), b'\x02'*20)
+
+    def testValidatedRecords(self):
+        """Records are not validated again"""
+        (lib, _) = self.createAudit("lib", b'\x01'*20)
+        (app1, _) = self.createAudit("app1", b'\x02'*20, [lib])
+        (app2, _) = self.createAudit("app2", b'\x03'*20, [lib])
+
+        # Copies are not in the cache and must be loaded again
+        audits = []
+        for name in (app1, app2):
+            copy = name + ".copy"
+            shutil.copy(name, copy)
+            audits.append(Audit.fromFile(copy))
+        libId = Audit.fromFile(lib).getId()
+        self.assertIs(audits[0].getArtifact(libId), audits[1].getArtifact(libId))
+
+    def testTamperedRecord(self):
+        """Records that only claim a validated id are rejected"""
+        (lib, _) = self.createAudit("lib", b'\x01'*20)
+        (app, _) = self.createAudit("app", b'\x02'*20, [lib])
+        Audit.fromFile(lib)
+
+        with gzip.open(app) as f:
+            tree = json.load(f)
+        tree["references"][0]["meta"]["package"] = "evil"
+        tampered = os.path.join(self.tmpdir.name, "tampered.json.gz")
+        with gzip.open(tampered, "wt") as f:
+            json.dump(tree, f)
+        with self.assertRaises(ParseError):
+            Audit.fromFile(tampered)
@@ -0,0 +1,108 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import MagicMock
+import asyncio
+import json
+import os
+
+from bob.cmds.build.profile import BuildProfile
+from bob.state import BobState, finalize
+from bob.tty import DummyTUIAction
+
+def mockStep(name, variantId):
+    ret = MagicMock()
+    ret.getPackage().getName.return_value = name
+    ret.getPackage().getRecipe().getName.return_value = name
+    ret.getVariantId.return_value = variantId
+    ret.isCheckoutStep.return_value = False
+    ret.isBuildStep.return_value = True
+    return ret
+
+class TestBuildProfile(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        finalize()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def testTimings(self):
+        """Nested actions only add their byte counters to the step"""
+        profile = BuildProfile()
+        step = mockStep("foo", b"\x01")
+        with profile.profileAction(step, "BUILD", DummyTUIAction()) as a:
+            a.addBytesTransferred(10)
+            with profile.profileAction(step, "HASH", DummyTUIAction()) as b:
+                b.addBytesHashed(42)
+        self.assertEqual([ s for (s, _, _) in profile.getExecutedSteps() ], [step])
+        profile.saveTimings()
+
+        timing = BobState().getStepTiming(b"\x01")
+        self.assertEqual(timing["recipe"], "foo")
+        self.assertEqual(timing["step"], "build")
+        self.assertEqual(timing["hashed"], 42)
+        self.assertEqual(timing["transferred"], 10)
+        self.assertGreaterEqual(timing["wall"], 0.0)
+        self.assertGreaterEqual(timing["cpu"], 0.0)
+
+    def testNotExecuted(self):
+        """Steps that were only hashed keep their previous timing"""
+        profile = BuildProfile()
+        step = mockStep("foo", b"\x01")
+        with profile.profileAction(step, "HASH", DummyTUIAction()) as a:
+            a.addBytesHashed(42)
+        self.assertEqual(profile.getExecutedSteps(), [])
+        profile.saveTimings()
+        self.assertEqual(BobState().getStepTiming(b"\x01"), None)
+
+    def testLanes(self):
+        """Concurrent actions are put into separate lanes"""
+        profile = BuildProfile()
+
+        async def job(name, delay):
+            step = mockStep(name, name.encode("ascii"))
+            await asyncio.sleep(delay)
+            with profile.profileAction(step, "BUILD", DummyTUIAction()):
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(job("a", 0), job("b", 0), job("c", 0.05))
+
+        asyncio.new_event_loop().run_until_complete(run())
+        profile.dump("profile.json")
+        with open("profile.json") as f:
+            events = json.load(f)["traceEvents"]
+
+        lanes = { e["args"]["package"] : e["tid"] for e in events if e["ph"] == "X" }
+        self.assertEqual(len(lanes), 3)
+        self.assertNotEqual(lanes["a"], lanes["b"])
+        self.assertEqual(lanes["c"], 0)
+        self.assertEqual(sorted(e["tid"] for e in events if e["ph"] == "M"), [0, 1])
+
+    def testOverlappingCpu(self):
+        """No CPU time is recorded for actions that overlap other tasks"""
+        profile = BuildProfile()
+
+        async def job(name, delay):
+            step = mockStep(name, name.encode("ascii"))
+            await asyncio.sleep(delay)
+            with profile.profileAction(step, "BUILD", DummyTUIAction()):
+                await asyncio.sleep(0.02)
+
+        async def run():
+            await asyncio.gather(job("a", 0), job("b", 0.01), job("c", 0.1))
+
+        asyncio.new_event_loop().run_until_complete(run())
+        profile.saveTimings()
+        self.assertEqual(BobState().getStepTiming(b"a")["cpu"], None)
+        self.assertEqual(BobState().getStepTiming(b"b")["cpu"], None)
+        self.assertGreaterEqual(BobState().getStepTiming(b"c")["cpu"], 0.0)
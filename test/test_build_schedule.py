@@ -0,0 +1,179 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import asyncio
+import os
+
+from bob.cmds.build.schedule import CriticalPathSchedule, JobSlots, DEFAULT_DURATION
+from bob.state import BobState, finalize
+
+class MockStep:
+    def __init__(self, name, deps=[], valid=True):
+        self.name = name
+        self.deps = deps
+        self.valid = valid
+
+    def getWorkspacePath(self):
+        return "work/" + self.name
+
+    def getVariantId(self):
+        return self.name.encode("ascii")
+
+    def isValid(self):
+        return self.valid
+
+    def getAllDepSteps(self):
+        return self.deps
+
+class TestJobSlots(TestCase):
+
+    def testPriority(self):
+        """Free slots are granted to the waiter with the highest priority"""
+        order = []
+        async def job(slots, name, prio):
+            await slots.acquire(prio)
+            order.append(name)
+            await asyncio.sleep(0)
+            slots.release()
+
+        async def run():
+            slots = JobSlots(1)
+            await slots.acquire()
+            tasks = [ asyncio.ensure_future(job(slots, n, p))
+                      for (n, p) in [("a", 1.0), ("b", 3.0), ("c", 2.0), ("d", 3.0)] ]
+            await asyncio.sleep(0)
+            slots.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.new_event_loop().run_until_complete(run())
+        self.assertEqual(order, ["b", "d", "c", "a"])
+
+    def testCancel(self):
+        """Cancelled waiters do not leak slots"""
+        async def run():
+            slots = JobSlots(1)
+            await slots.acquire()
+            waiter = asyncio.ensure_future(slots.acquire())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            slots.release()
+            async with slots.slot(1.0):
+                pass
+            await slots.acquire()
+
+        asyncio.new_event_loop().run_until_complete(run())
+
+    def testWeight(self):
+        """Weighted jobs wait until enough slots are free and are not starved"""
+        order = []
+        async def job(slots, name, weight):
+            async with slots.slot(0.0, weight):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        async def run():
+            slots = JobSlots(2)
+            await slots.acquire()
+            tasks = [ asyncio.ensure_future(job(slots, n, w))
+                      for (n, w) in [("big", 2), ("small", 1)] ]
+            await asyncio.sleep(0)
+            # The small job would fit but must wait behind the big one
+            self.assertEqual(order, [])
+            slots.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.new_event_loop().run_until_complete(run())
+        self.assertEqual(order, ["big", "small"])
+
+    def testMemory(self):
+        """Memory requests are clamped to the budget or ignored without one"""
+        async def run():
+            slots = JobSlots(4, 1000)
+            await slots.acquire(0.0, 1, 600)
+            waiter = asyncio.ensure_future(slots.acquire(0.0, 1, 5000))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            slots.release(1, 600)
+            await waiter
+            slots.release(1, 5000)
+
+            slots = JobSlots(1)
+            await slots.acquire(0.0, 8, 5000)
+            slots.release(8, 5000)
+            await slots.acquire()
+
+        asyncio.new_event_loop().run_until_complete(run())
+
+class TestCriticalPathSchedule(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        finalize()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def setDuration(self, name, duration):
+        BobState().setStepTiming(name.encode("ascii"), { "recipe" : name,
+            "step" : "package", "wall" : duration, "cpu" : 0.0, "hashed" : 0,
+            "transferred" : 0 })
+
+    def testPriorities(self):
+        """Steps on long chains get higher priorities"""
+        self.setDuration("toolchain", 10.0)
+        self.setDuration("lib", 5.0)
+        self.setDuration("small", 1.0)
+        self.setDuration("app", 2.0)
+
+        toolchain = MockStep("toolchain")
+        lib = MockStep("lib", [toolchain])
+        small = MockStep("small")
+        invalid = MockStep("invalid", valid=False)
+        app = MockStep("app", [lib, small, invalid])
+
+        sched = CriticalPathSchedule([app], 2)
+        self.assertEqual(sched.getPriority(app), 2.0)
+        self.assertEqual(sched.getPriority(lib), 7.0)
+        self.assertEqual(sched.getPriority(small), 3.0)
+        self.assertEqual(sched.getPriority(toolchain), 17.0)
+        self.assertEqual(sched.getPriority(invalid), 0.0)
+
+        # Sequential builds do not need priorities
+        sched = CriticalPathSchedule([app], 1)
+        self.assertEqual(sched.getPriority(toolchain), 0.0)
+
+    def testMakespan(self):
+        """Predicted makespan is based on the previous durations"""
+        a = MockStep("a")
+        b = MockStep("b")
+        c = MockStep("c", [a, b])
+
+        sched = CriticalPathSchedule([c], 2)
+        self.assertEqual(sched.getMakespan(), None)
+        sched.stepExecuted(a, 10.0, 14.0)
+        sched.stepExecuted(b, 10.0, 11.0)
+        sched.stepExecuted(c, 14.0, 16.0)
+        self.assertEqual(sched.getMakespan(), (2*DEFAULT_DURATION, 6.0))
+
+        # Recorded durations are used by the next build
+        self.setDuration("a", 4.0)
+        self.setDuration("b", 1.0)
+        self.setDuration("c", 2.0)
+        sched = CriticalPathSchedule([c], 2)
+        self.assertEqual(sched.getPriority(a), 6.0)
+        sched.stepExecuted(a, 0.0, 4.0)
+        sched.stepExecuted(b, 0.0, 1.0)
+        sched.stepExecuted(c, 4.0, 6.0)
+        self.assertEqual(sched.getMakespan(), (6.0, 6.0))
+
+        sched = CriticalPathSchedule([c], 1)
+        sched.stepExecuted(a, 0.0, 4.0)
+        sched.stepExecuted(b, 4.0, 5.0)
+        self.assertEqual(sched.getMakespan(), (5.0, 5.0))
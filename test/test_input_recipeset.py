@@ -6,12 +6,13 @@
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest import TestCase
 from unittest.mock import Mock
+import asyncio
 import os
 import textwrap
 import yaml
 
 from bob import DEBUG
-from bob.input import RecipeSet
+from bob.input import CorePackageStep, CoreSandbox, RecipeSet
 from bob.errors import ParseError, BobError
 
 DEBUG['ngd'] = True
@@ -423,6 +424,178 @@ class TestDependencies(RecipesTmp, TestCase):
         self.assertRaises(ParseError, packages.getRootPackage)
 
 
+    def testVariantReuse(self):
+        """Identical variants are reused, different ones are kept apart"""
+        self.writeRecipe("root", """\
+            root: True
+            depends:
+                - name: a
+                  environment: { FOO: "1", BAR: "x" }
+                - name: b
+                  environment: { FOO: "1", BAR: "y" }
+                - name: c
+                  environment: { FOO: "2", BAR: "x" }
+            buildScript: "true"
+            packageScript: "true"
+            """)
+        for i in ("a", "b", "c"):
+            self.writeRecipe(i, """\
+                depends: [lib]
+                buildScript: "true"
+                packageScript: "true"
+                """)
+        self.writeRecipe("lib", """\
+            packageVars: [FOO]
+            packageScript: "true"
+            """)
+
+        recipes = RecipeSet()
+        recipes.parse()
+        packages = recipes.generatePackages(lambda x,y: "unused")
+        a = packages.walkPackagePath("root/a/lib").getPackageStep()
+        b = packages.walkPackagePath("root/b/lib").getPackageStep()
+        c = packages.walkPackagePath("root/c/lib").getPackageStep()
+        self.assertEqual(a.getVariantId(), b.getVariantId())
+        self.assertNotEqual(a.getVariantId(), c.getVariantId())
+
+
+class TestPackageStore(RecipesTmp, TestCase):
+    """Test the persisted package graph"""
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecipe("root", """\
+            root: True
+            depends:
+                - name: toolchain
+                  use: [tools, sandbox]
+                  forward: True
+                - name: app1
+                  environment: { FOO: "1" }
+                - name: app2
+                  environment: { FOO: "2" }
+            buildScript: "true"
+            packageScript: "true"
+            """)
+        self.writeRecipe("toolchain", """\
+            packageScript: "true"
+            provideTools:
+                cc: "bin"
+            provideSandbox:
+                paths: ["/bin"]
+            """)
+        for app in ("app1", "app2"):
+            self.writeRecipe(app, """\
+                depends: [lib]
+                buildTools: [cc]
+                buildVars: [FOO]
+                buildScript: "true"
+                packageScript: "true"
+                """)
+        self.writeRecipe("lib", """\
+            buildTools: [cc]
+            buildVars: [FOO]
+            buildScript: "true"
+            packageScript: "true"
+            """)
+
+    def collect(self, packages):
+        ret = {}
+        for path in ("root/app1/lib", "root/app2/lib", "root/app1", "root/toolchain"):
+            step = packages.walkPackagePath(path).getPackageStep()
+            ret[path] = (step.getVariantId(), step.getPackage().getStack(),
+                sorted(step.getTools().keys()), step.getSandbox() is not None)
+        return ret
+
+    def testReload(self):
+        """Packages loaded from the store are identical"""
+        packages = self.generate(True)
+        first = self.collect(packages)
+        self.assertTrue(os.path.exists(".bob-packages-sb.pickle"))
+        packages = self.generate(True)
+        self.assertEqual(first, self.collect(packages))
+        self.assertEqual(
+            packages.walkPackagePath("root/app1/lib").getPackageStep()
+                .getTools()["cc"].getStep().getVariantId(),
+            first["root/toolchain"][0])
+
+    def testSharedEnv(self):
+        """Identical environments are shared between variants"""
+        for i in range(2):
+            packages = self.generate(True)
+            lib1 = packages.walkPackagePath("root/app1/lib")
+            lib2 = packages.walkPackagePath("root/app2/lib")
+            self.assertEqual(lib1.getBuildStep().getEnv(), {"FOO" : "1"})
+            self.assertEqual(lib2.getBuildStep().getEnv(), {"FOO" : "2"})
+            self.assertIs(lib1.getCheckoutStep().getEnv(), lib2.getCheckoutStep().getEnv())
+
+    def testLazyObjects(self):
+        """Objects of records that were not loaded yet are the real objects"""
+        self.generate(True).walkPackagePath("root")
+        packages = self.generate(True)
+        root = packages.walkPackagePath("root").getPackageStep()._coreStep.corePackage
+        deps = [ ref._CoreRef__destination for ref in root.directDepSteps ]
+        self.assertTrue(all(isinstance(d, CorePackageStep) for d in deps))
+        self.assertEqual(len(set(deps)), 3)
+
+        # Once loaded they are the same objects that the walk returns
+        lib1 = packages.walkPackagePath("root/app1/lib").getPackageStep()
+        lib2 = packages.walkPackagePath("root/app2/lib").getPackageStep()
+        app1 = packages.walkPackagePath("root/app1").getPackageStep()
+        self.assertIn(app1._coreStep, deps)
+        self.assertIsInstance(lib1.getSandbox().coreSandbox.coreStep, CorePackageStep)
+        self.assertEqual(lib1.getSandbox(), lib2.getSandbox())
+
+class TestStepDigest(RecipesTmp, TestCase):
+    """Test digest calculation of steps"""
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecipe("root", """\
+            root: True
+            depends:
+                - name: toolchain
+                  use: [tools]
+                  forward: True
+                - lib
+            buildTools: [cc]
+            buildScript: "true"
+            packageScript: "true"
+            """)
+        self.writeRecipe("toolchain", """\
+            packageScript: "true"
+            provideTools:
+                cc: "bin"
+            """)
+        self.writeRecipe("lib", """\
+            buildTools: [cc]
+            buildScript: "true"
+            packageScript: "true"
+            """)
+
+    def testVariantId(self):
+        """Digest over variant-ids of dependencies yields variant-id"""
+        packages = self.generate()
+        step = packages.walkPackagePath("root").getBuildStep()
+        self.assertEqual(step.getDigest(lambda s: s.getVariantId()), step.getVariantId())
+        self.assertNotEqual(step.getDigest(lambda s: b'\x00' * 20), step.getVariantId())
+        self.assertNotEqual(step.getDigest(lambda s: s.getVariantId(), platform=b'p'),
+                            step.getVariantId())
+
+    def testCoroBatched(self):
+        """All dependencies are calculated by one call"""
+        packages = self.generate()
+        step = packages.walkPackagePath("root").getBuildStep()
+        calls = []
+        async def calculate(deps):
+            calls.append(deps)
+            return [ d.getVariantId() for d in deps ]
+        ret = asyncio.get_event_loop().run_until_complete(step.getDigestCoro(calculate))
+        self.assertEqual(ret, step.getVariantId())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(d.getPackage().getName() for d in calls[0]),
+                         ["lib", "toolchain"])
+
 class TestNetAccess(RecipesTmp, TestCase):
 
     def testOldPolicy(self):
@@ -521,6 +694,53 @@ class TestNetAccess(RecipesTmp, TestCase):
         self.assertTrue(p.getPackageStep().hasNetAccess())
 
 
+class TestResources(RecipesTmp, TestCase):
+
+    def testDefault(self):
+        """Steps take a single job slot and no memory by default"""
+        self.writeRecipe("root", """\
+            root: True
+            checkoutScript: "true"
+            buildScript: "true"
+            packageScript: "true"
+            """)
+        p = self.generate().walkPackagePath("root")
+        self.assertEqual(p.getCheckoutStep().getResources(), (1, 0))
+        self.assertEqual(p.getBuildStep().getResources(), (1, 0))
+        self.assertEqual(p.getPackageStep().getResources(), (1, 0))
+
+    def testInherit(self):
+        """Resources are inherited from classes unless set by the recipe"""
+        self.writeClass("big", """\
+            buildResources:
+                jobs: 4
+                memory: 2048
+            packageResources:
+                memory: 512
+            """)
+        self.writeRecipe("root", """\
+            root: True
+            inherit: [big]
+            buildScript: "true"
+            packageScript: "true"
+            packageResources:
+                jobs: 2
+            """)
+        p = self.generate().walkPackagePath("root")
+        self.assertEqual(p.getBuildStep().getResources(), (4, 2048))
+        self.assertEqual(p.getPackageStep().getResources(), (2, 0))
+
+    def testInvalid(self):
+        """Job counts must be positive"""
+        self.writeRecipe("root", """\
+            root: True
+            buildScript: "true"
+            buildResources:
+                jobs: 0
+            """)
+        self.assertRaises(ParseError, self.generate)
+
+
 class TestToolEnvironment(RecipesTmp, TestCase):
 
     def testEnvDefine(self):
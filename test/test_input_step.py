@@ -6,7 +6,8 @@
 from unittest import TestCase
 from unittest.mock import Mock
 
-from bob.input import Env, CoreCheckoutStep, CoreBuildStep, CorePackageStep
+from bob.input import Env, CoreCheckoutStep, CoreBuildStep, CorePackageStep, \
+    GraphInterner
 
 class Empty:
     pass
@@ -15,6 +16,9 @@ class MockRecipeSet:
     def scmOverrides(self):
         return []
 
+    def _getInterner(self):
+        return GraphInterner()
+
     sandboxInvariant = True
 
 class MockRecipe:
@@ -0,0 +1,71 @@
+# Bob build tool
+# Copyright (C) 2016  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import os
+import schema
+
+from bob.input import YamlCache
+
+class TestYamlCache(TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        os.chdir(self.cwd)
+
+    def writeFile(self, name, content):
+        with open(name, "w") as f:
+            f.write(content)
+
+    def load(self, *names):
+        cache = YamlCache()
+        cache.open()
+        try:
+            ret = [ cache.loadYaml(n, schema.Schema(dict), {}) for n in names ]
+        finally:
+            cache.close()
+        return (ret, cache.getDigest())
+
+    def testHot(self):
+        """Unchanged files are taken from the cache"""
+        self.writeFile("a.yaml", "foo: 1\n")
+        self.writeFile("b.yaml", "bar: 2\n")
+        (data1, digest1) = self.load("a.yaml", "b.yaml")
+        self.assertEqual(data1, [{"foo" : 1}, {"bar" : 2}])
+
+        with patch('bob.input.yaml.safe_load') as safe_load:
+            (data2, digest2) = self.load("a.yaml", "b.yaml")
+            safe_load.assert_not_called()
+        self.assertEqual(data1, data2)
+        self.assertEqual(digest1, digest2)
+
+    def testChanged(self):
+        """Changed files are parsed again"""
+        self.writeFile("a.yaml", "foo: 1\n")
+        (data1, digest1) = self.load("a.yaml")
+
+        self.writeFile("a.yaml", "foo: 12\n")
+        (data2, digest2) = self.load("a.yaml")
+        self.assertEqual(data2, [{"foo" : 12}])
+        self.assertNotEqual(digest1, digest2)
+
+    def testManyFiles(self):
+        """Many files are validated concurrently"""
+        names = [ "f{}.yaml".format(i) for i in range(100) ]
+        for n in names: self.writeFile(n, "n: " + n + "\n")
+        (data1, digest1) = self.load(*names)
+
+        self.writeFile("f42.yaml", "n: changed\n")
+        os.unlink("f7.yaml")
+        names.remove("f7.yaml")
+        (data2, digest2) = self.load(*names)
+        self.assertEqual(data2[41], {"n" : "changed"})
+        self.assertEqual(data2[42], {"n" : "f43.yaml"})
@@ -0,0 +1,139 @@
+# Bob build tool
+# Copyright (C) 2020  Jan Klötzke
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import os
+import pickle
+
+from bob.errors import ParseError
+from bob.state import BobState, finalize
+
+class TestBobState(TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        finalize()
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def reopen(self):
+        finalize()
+        return BobState()
+
+    def testPersist(self):
+        """Changed keys are persisted and deletions are honored"""
+        s = BobState()
+        s.setResultHash("work/a", b"\x01")
+        s.setInputHashes("work/a", [b"\x02"])
+        s.setResultHash("work/b", b"\x03")
+        s.setVariantId("work/b", b"\x04")
+        s.resetWorkspaceState("work/b", None)
+
+        s = self.reopen()
+        self.assertEqual(s.getResultHash("work/a"), b"\x01")
+        self.assertEqual(s.getInputHashes("work/a"), [b"\x02"])
+        self.assertEqual(s.getResultHash("work/b"), None)
+        self.assertEqual(s.getVariantId("work/b"), None)
+
+    def testAsynchronous(self):
+        """Changes are committed when switching back to synchronous mode"""
+        s = BobState()
+        s.setAsynchronous()
+        s.setDirectoryState("work/a", b"\x01")
+        s.setAtticDirectoryState("work/attic", { "foo" : 1 })
+        s.setSynchronous()
+
+        s = self.reopen()
+        self.assertEqual(s.getDirectoryState("work/a", False), b"\x01")
+        self.assertEqual(s.getAtticDirectoryState("work/attic"), { "foo" : 1 })
+
+    def testBuildState(self):
+        """Removed build state keys vanish from the persisted state"""
+        s = BobState()
+        s.setBuildState({ "wasRun" : { "a" : 1 }, "predictedBuidId" : {} })
+        s.setBuildState({ "wasRun" : { "b" : 2 } })
+
+        s = self.reopen()
+        self.assertEqual(s.getBuildState(), { "wasRun" : { "b" : 2 } })
+
+    def testStepTiming(self):
+        """Step timings are persisted per variant-id"""
+        s = BobState()
+        self.assertEqual(s.getStepTiming(b"\x01"), None)
+        self.assertEqual(s.getStepDuration(b"\x01"), None)
+        timing = { "recipe" : "foo", "step" : "build", "wall" : 4.0,
+                   "cpu" : 3.0, "hashed" : 100, "transferred" : 0 }
+        s.setStepTiming(b"\x01", timing)
+
+        s = self.reopen()
+        self.assertEqual(s.getStepTiming(b"\x01"), dict(timing, lastWall=4.0))
+        self.assertEqual(s.getStepDuration(b"\x01"), 4.0)
+        self.assertEqual(s.getStepDuration(b"\x02"), None)
+
+        # The expected duration is averaged
+        s.setStepTiming(b"\x01", dict(timing, wall=2.0))
+        s = self.reopen()
+        self.assertEqual(s.getStepTiming(b"\x01")["lastWall"], 2.0)
+        self.assertEqual(s.getStepDuration(b"\x01"), 3.0)
+
+    def testMigratePickle(self):
+        """The legacy pickle state is migrated transparently"""
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({
+                "version" : 8,
+                "byNameDirs" : { "work/a" : 1, "1234" : ("work/a/1", True) },
+                "results" : { "work/a/1/workspace" : b"\x01" },
+                "inputs" : {},
+                "buildState" : { "wasRun" : {}, "predictedBuidId" : {} },
+                "createdWithVersion" : 8,
+            }, f)
+
+        s = BobState()
+        self.assertEqual(s.getExistingByNameDirectory("1234"), "work/a/1")
+        self.assertEqual(s.getResultHash("work/a/1/workspace"), b"\x01")
+
+        # The pickle is only a stub that keeps older versions away
+        with open(".bob-state.pickle", "rb") as f:
+            self.assertEqual(pickle.load(f)["version"], 9)
+
+        s = self.reopen()
+        self.assertEqual(s.getByNameDirectory("work/a", "5678", False), "work/a/2")
+        self.assertEqual(s.getResultHash("work/a/1/workspace"), b"\x01")
+
+    def testTooNew(self):
+        """Refuse to work on state of newer versions"""
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({ "version" : 9999 }, f)
+        self.assertRaises(ParseError, BobState)
+
+    def testMissingDatabase(self):
+        """A migrated workspace without database is detected"""
+        with open(".bob-state.pickle", "wb") as f:
+            pickle.dump({ "version" : 8, "byNameDirs" : {}, "results" : {},
+                          "inputs" : {} }, f)
+        self.reopen()
+        os.unlink(".bob-state.sqlite3")
+        with self.assertRaises(ParseError) as e:
+            self.reopen()
+        self.assertIn("missing", str(e.exception))
+
+    def testSaveRollback(self):
+        """A failed save does not leave the transaction open"""
+        s = BobState()
+        s.setResultHash("work/a", b"\x01")
+        with self.assertRaises((AttributeError, pickle.PicklingError)):
+            s.setResultHash("work/b", lambda: None)
+        s.setResultHash("work/b", b"\x02")
+        s.setResultHash("work/c", b"\x03")
+
+        s = self.reopen()
+        self.assertEqual(s.getResultHash("work/a"), b"\x01")
+        self.assertEqual(s.getResultHash("work/b"), b"\x02")
+        self.assertEqual(s.getResultHash("work/c"), b"\x03")
@@ -9,8 +9,9 @@ from unittest.mock import MagicMock, mock_open, patch
 import binascii
 
 import os
+import struct
 import sys
-from bob.utils import hashFile, hashDirectory
+from bob.utils import hashFile, hashDirectory, DirHasher
 
 class TestHashFile(TestCase):
     def testBigFile(self):
@@ -95,17 +96,134 @@ class TestHashDir(TestCase):
                 sum1 = hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB2'
 
                 with open(os.path.join(tmp, "foo"), 'wb') as f:
                     f.write(b'qwer')
                 sum2 = hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB2'
 
                 assert sum1 != sum2
 
+    def testParallel(self):
+        """Hashing files concurrently must not change the hash sum"""
+
+        with NamedTemporaryFile() as index:
+            with TemporaryDirectory() as tmp:
+                for d in ("a", "b", os.path.join("b", "c")):
+                    os.mkdir(os.path.join(tmp, d))
+                    for i in range(10):
+                        with open(os.path.join(tmp, d, "f"+str(i)), 'wb') as f:
+                            f.write(b'abc' * i)
+
+                sum1 = hashDirectory(tmp)
+                assert sum1 == hashDirectory(tmp, jobs=4)
+                assert sum1 == hashDirectory(tmp, index.name, jobs=4)
+                assert sum1 == hashDirectory(tmp, index.name, jobs=4)
+                assert sum1 == hashDirectory(tmp, index.name)
+
+                with open(os.path.join(tmp, "b", "c", "f3"), 'wb') as f:
+                    f.write(b'qwer')
+                sum2 = hashDirectory(tmp, index.name, jobs=4)
+                assert sum1 != sum2
+                assert sum2 == hashDirectory(tmp)
+
+    def testUpdateInPlace(self):
+        """Changed files are updated in the index without rewriting it"""
+
+        with TemporaryDirectory() as tmp:
+            index = os.path.join(tmp, "cache.bin")
+            os.mkdir(os.path.join(tmp, "ws"))
+            for i in range(10):
+                with open(os.path.join(tmp, "ws", "f"+str(i)), 'wb') as f:
+                    f.write(b'abc')
+            sum1 = hashDirectory(os.path.join(tmp, "ws"), index)
+            ino = os.stat(index).st_ino
+
+            with open(os.path.join(tmp, "ws", "f3"), 'wb') as f:
+                f.write(b'qwer')
+            sum2 = hashDirectory(os.path.join(tmp, "ws"), index)
+            assert sum1 != sum2
+            assert os.stat(index).st_ino == ino
+            assert sum2 == hashDirectory(os.path.join(tmp, "ws"), index)
+            assert sum2 == hashDirectory(os.path.join(tmp, "ws"))
+
+            # new files require a rewrite
+            with open(os.path.join(tmp, "ws", "new"), 'wb') as f:
+                f.write(b'abc')
+            sum3 = hashDirectory(os.path.join(tmp, "ws"), index)
+            assert os.stat(index).st_ino != ino
+            assert sum3 == hashDirectory(os.path.join(tmp, "ws"), index)
+            assert sum3 == hashDirectory(os.path.join(tmp, "ws"))
+
+    def testLegacyIndex(self):
+        """Digests of the old index format are still used"""
+
+        with TemporaryDirectory() as tmp:
+            index = os.path.join(tmp, "cache.bin")
+            os.mkdir(os.path.join(tmp, "ws"))
+            with open(os.path.join(tmp, "ws", "foo"), 'wb') as f:
+                f.write(b'abc')
+            st = os.lstat(os.path.join(tmp, "ws", "foo"))
+            with open(index, "wb") as f:
+                f.write(b'BOB1')
+                f.write(struct.pack('=QQLQLQ20sH', int(st.st_ctime * 1000000000),
+                    int(st.st_mtime * 1000000000), st.st_dev, st.st_ino,
+                    st.st_mode, st.st_size, b'\x55' * 20, 3))
+                f.write(b'foo')
+
+            sum1 = hashDirectory(os.path.join(tmp, "ws"), index)
+            assert sum1 != hashDirectory(os.path.join(tmp, "ws"))
+            assert sum1 == hashDirectory(os.path.join(tmp, "ws"), index)
+            with open(index, "rb") as f:
+                assert f.read(4) == b'BOB2'
+
+    def testChanges(self):
+        """Only changed directories are hashed again"""
+
+        with TemporaryDirectory() as tmp:
+            index = os.path.join(tmp, "cache.bin")
+            ws = os.path.join(tmp, "ws")
+            for d in ("a", "b", os.path.join("b", "c")):
+                os.makedirs(os.path.join(ws, d))
+                with open(os.path.join(ws, d, "f"), 'wb') as f:
+                    f.write(b'abc')
+            sum1 = hashDirectory(ws, index)
+
+            with open(os.path.join(ws, "b", "c", "f"), 'wb') as f:
+                f.write(b'qwer')
+            sum2 = hashDirectory(ws)
+            assert sum1 != sum2
+
+            # Nothing reported -> everything is taken from the index
+            assert sum1 == hashDirectory(ws, index, changes=frozenset())
+            assert sum1 == hashDirectory(ws, index, changes=frozenset([b'a']))
+            assert sum2 == hashDirectory(ws, index,
+                changes=frozenset([os.path.join(b'b', b'c')]))
+            assert sum2 == hashDirectory(ws, index, changes=frozenset())
+
+    def testBytesHashed(self):
+        """Only files whose content is hashed are accounted"""
+
+        with TemporaryDirectory() as tmp:
+            index = os.path.join(tmp, "cache.bin")
+            ws = os.path.join(tmp, "ws")
+            os.makedirs(os.path.join(ws, "a"))
+            with open(os.path.join(ws, "a", "f"), 'wb') as f:
+                f.write(b'abc')
+            with open(os.path.join(ws, "g"), 'wb') as f:
+                f.write(b'qwertz')
+
+            hasher = DirHasher(index)
+            hasher.hashDirectory(ws)
+            assert hasher.getBytesHashed() == 9
+
+            hasher = DirHasher(index)
+            hasher.hashDirectory(ws)
+            assert hasher.getBytesHashed() == 0
+
     def testBigIno(self):
         """Test that index handles big inode numbers as found on Windows"""
 
@@ -132,7 +250,7 @@ class TestHashDir(TestCase):
                     hashDirectory(tmp, index.name)
 
                 with open(index.name, "rb") as f:
-                    assert f.read(4) == b'BOB1'
+                    assert f.read(4) == b'BOB2'
 
     def testBlockDev(self):
         """Test that index handles block devices"""
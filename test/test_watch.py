@@ -0,0 +1,115 @@
+# Bob build tool
+# Copyright (C) 2016  TechniSat Digital GmbH
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+import os
+import select
+import sys
+import threading
+import time
+
+from bob.watch import Watcher, WorkspaceJournal
+
+@skipUnless(sys.platform == "linux", "requires inotify")
+class TestWatch(TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.root = self.tmp.name
+        self.ws = os.path.join(self.root, "ws", "workspace")
+        os.makedirs(os.path.join(self.ws, "a"))
+        os.makedirs(os.path.join(self.ws, "b"))
+        self.startWatcher()
+        self.journal = WorkspaceJournal(self.ws, self.root)
+
+    def tearDown(self):
+        self.stopWatcher()
+        self.tmp.cleanup()
+
+    def startWatcher(self):
+        """Run the watcher concurrently like the real background process"""
+        self.watcher = Watcher(self.root)
+        self.watcher.start()
+        self.running = True
+        self.thread = threading.Thread(target=self.runWatcher)
+        self.thread.start()
+
+    def runWatcher(self):
+        while self.running:
+            (r, w, x) = select.select([self.watcher], [], [], 0.01)
+            if r: self.watcher.process()
+
+    def stopWatcher(self):
+        if self.watcher is None: return
+        self.running = False
+        self.thread.join()
+        self.watcher.stop()
+        self.watcher = None
+
+    def activate(self):
+        """Register workspace and do initial full hash"""
+        self.assertIsNone(self.journal.begin())
+        active = os.path.join(self.root, ".bob-watch", "active")
+        while not os.listdir(active):
+            time.sleep(0.01)
+        self.assertIsNone(self.journal.begin())
+        self.journal.commit()
+        self.assertEqual(self.journal.begin(), frozenset())
+        self.journal.commit()
+
+    def testChanges(self):
+        self.activate()
+
+        # Changes are not lost even if the watcher lags behind
+        with open(os.path.join(self.ws, "b", "f"), "wb") as f:
+            f.write(b"abc")
+        self.assertEqual(self.journal.begin(), frozenset([b"b"]))
+        self.journal.commit()
+        self.assertEqual(self.journal.begin(), frozenset())
+        self.journal.commit()
+
+        # new directories are watched too
+        os.mkdir(os.path.join(self.ws, "a", "c"))
+        self.assertEqual(self.journal.begin(), frozenset([b"a"]))
+        self.journal.commit()
+        with open(os.path.join(self.ws, "a", "c", "f"), "wb") as f:
+            f.write(b"abc")
+        self.assertEqual(self.journal.begin(),
+                         frozenset([os.path.join(b"a", b"c")]))
+        self.journal.commit()
+
+    def testInterrupted(self):
+        """Changes are lost if the hash was not commited"""
+        self.activate()
+
+        with open(os.path.join(self.ws, "a", "f"), "wb") as f:
+            f.write(b"abc")
+        self.assertEqual(self.journal.begin(), frozenset([b"a"]))
+        self.assertIsNone(self.journal.begin())
+
+    def testMovedDirectory(self):
+        """Moving directories invalidates the journal"""
+        self.activate()
+
+        os.rename(os.path.join(self.ws, "a"), os.path.join(self.ws, "c"))
+        self.assertIsNone(self.journal.begin())
+
+    def testStopped(self):
+        self.activate()
+        self.stopWatcher()
+        with patch('bob.watch.startWatcher') as start:
+            self.assertIsNone(self.journal.begin())
+            start.assert_called_once_with(self.root)
+
+    def testSyncTimeout(self):
+        """Fall back to a full hash if the watcher does not respond"""
+        self.activate()
+        self.running = False
+        self.thread.join()
+        with patch('bob.watch.SYNC_TIMEOUT', 0.1):
+            self.assertIsNone(self.journal.begin())
+        self.assertEqual(sorted(os.listdir(self.ws)), ["a", "b"])